@@ -0,0 +1,970 @@
+# coding=<utf-8>
+import argparse
+import ast
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from contextlib import contextmanager
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import islice
+from urllib.parse import parse_qs, urlsplit
+from time import perf_counter
+
+from settings import settings
+import operations
+import initiate_schema
+
+
+def timed(func, repeats):
+    """Runs func repeats times and returns the total time in seconds"""
+    start = perf_counter()
+    for _ in range(repeats):
+        func()
+    return perf_counter() - start
+
+
+def report(title, rows):
+    """Prints a small table of (label, seconds, repeats) rows"""
+    print(title)
+    for label, seconds, repeats in rows:
+        print(f'\t{label:<30} {seconds:9.4f}s '
+              f'{1e6 * seconds / repeats:10.1f}us/call')
+
+
+def bench_connections(repeats=1000):
+    """Compares connecting per query with the pooled connection
+
+    Runs the same small lookup, as made by toponym_main.source_available,
+    against the seeded database from the settings.
+    """
+    query = 'select name from source where name == :source'
+    values = {'source': 'none'}
+
+    def per_call():
+        # The way every query was executed before the connection pool.
+        conn = sqlite3.connect(settings.database_path)
+        with conn:
+            conn.set_trace_callback(logging.debug)
+            conn.execute(query, values).fetchall()
+        conn.close()
+
+    def pooled():
+        operations.execute(query, values=values, status='benchmark')
+
+    pooled()
+    report(f'Connections: {settings.database_path}',
+           [('connect per call', timed(per_call, repeats), repeats),
+            ('pooled connection', timed(pooled, repeats), repeats)])
+
+
+@contextmanager
+def database_copy():
+    """Points the settings to a temporary copy of the seeded database
+
+    For the benchmarks changing the schema, so that the database from the
+    settings is left as it was.
+
+    Yields:
+        str, the path of the copy
+    """
+    path = settings.database_path
+    operations.flush_writes()
+    operations.close_connection()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            copy = os.path.join(directory, os.path.basename(path))
+            source, target = sqlite3.connect(path), sqlite3.connect(copy)
+            with target:
+                source.backup(target)
+            source.close()
+            target.close()
+            settings.database_path = copy
+            try:
+                yield copy
+                operations.flush_writes()
+            finally:
+                operations.close_connection()
+    finally:
+        settings.database_path = path
+
+
+def sample_toponyms(n):
+    """Samples added toponyms, or any toponyms if none have been added"""
+    query = 'select toponym_id, name, pattern, language from toponym '\
+            '{} order by random() limit :n'
+    sample = operations.execute(query.format('where length(source_fk) > 6'),
+                                values={'n': n})
+    if len(sample) == 0:
+        sample = operations.execute(query.format(''), values={'n': n})
+    return sample
+
+
+def time_matching_queries(sample):
+    """Times the perfect, pattern and disambiguation queries on a sample"""
+    import matchers
+    from toponym_main import goto_disambiguator
+
+    m = matchers.matcher()
+    pattern_query = 'select toponym_id, position_fk, name from toponym '\
+                    'where name like :pattern and position_fk is not NULL '\
+                    'and toponym_id not in ( select stable_toponym_fk from '\
+                    'suggestion where outcome == 0 and added_toponym_fk '\
+                    '== :target_id) and source_fk not in ( '\
+                    'select source_fk from toponym where '\
+                    'toponym_id == :target_id) group by position_fk'
+
+    def perfect():
+        for toponym_id, name, pattern, language in sample:
+            m.perfect_matches(target_id=toponym_id, target=name,
+                              languages=language)
+
+    def pattern():
+        for toponym_id, name, pattern, language in sample:
+            operations.execute(pattern_query, values={'pattern': pattern,
+                                                      'target_id': toponym_id})
+
+    def disambiguation():
+        for n in range(len(sample)):
+            goto_disambiguator(n)
+
+    return [(label, timed(func, 1), len(sample)) for label, func in
+            (('perfect', perfect), ('pattern', pattern),
+             ('disambiguation', disambiguation))]
+
+
+def bench_indexes(repeats=100):
+    """Times the matching queries without and with the secondary indexes
+
+    The indexes are dropped from a copy of the database first, so that the
+    same database gives the before and after timings, and are then restored
+    by the migration.
+    """
+    with database_copy():
+        sample = sample_toponyms(min(repeats, 100))
+
+        conn = operations.get_connection()
+        initiate_schema.drop_indexes(conn)
+        conn.commit()
+        report('Without secondary indexes', time_matching_queries(sample))
+
+        start = perf_counter()
+        initiate_schema.migrate()
+        print(f'Migration took {perf_counter() - start:.2f}s')
+        report('With secondary indexes', time_matching_queries(sample))
+
+
+def bench_token_index(repeats=100):
+    """Compares the all_in_one stage by full scan and through the postings
+
+    Runs the stage on a sample of the toponyms of the seeded database, once
+    against all the options and once against the toponym_token postings.
+
+    Returns:
+        False when the two give different matches for any toponym
+    """
+    import matchers
+
+    m = matchers.matcher()
+    targets = [m.get_target_data(toponym_id) for toponym_id, *_ in
+               sample_toponyms(min(repeats, 100))]
+    functions = (matchers.matcher.all_in_one, )
+    results = {}
+
+    def scan():
+        results['scan'] = [m.distance_matches(target, m.get_options(
+            target.toponym_id, languages=target.language), functions)
+            for target in targets]
+
+    def postings():
+        results['postings'] = [m.distance_matches(target,
+                                                  functions=functions)
+                               for target in targets]
+
+    report('Matching all_in_one',
+           [('full scan', timed(scan, 1), len(targets)),
+            ('token postings', timed(postings, 1), len(targets))])
+    differences = sum(a != b for a, b in zip(results['scan'],
+                                             results['postings']))
+    matched = sum(len(matches) > 0 for matches, _ in results['scan'])
+    print(f'\t{matched} of {len(targets)} toponyms matched, '
+          f'{differences} with different matches')
+    return differences == 0
+
+
+def bench_distance_index(repeats=100):
+    """Compares the hamming1 and jairo9 stages by full scan and by index
+
+    Runs each stage on a sample of the toponyms of the seeded database, once
+    against all the options and once against the options found through the
+    halves of the names, for hamming1, and toponym_gram, for jairo9, and
+    counts the matches the index lost.
+
+    Returns:
+        False when the index lost, or added, any match
+    """
+    import matchers
+
+    m = matchers.matcher()
+    targets = [m.get_target_data(toponym_id) for toponym_id, *_ in
+               sample_toponyms(min(repeats, 100))]
+    matchers.gram_frequencies()
+    passed = True
+
+    for func in (matchers.matcher.hamming1, matchers.matcher.jairo9):
+        results = {}
+
+        def scan():
+            results['scan'] = [m.distance_matches(target, m.get_options(
+                target.toponym_id, languages=target.language), (func, ))[0]
+                for target in targets]
+
+        def index():
+            results['index'] = [m.distance_matches(
+                target, functions=(func, ))[0] for target in targets]
+
+        report(f'Matching {func.__name__}',
+               [('full scan', timed(scan, 1), len(targets)),
+                ('index', timed(index, 1), len(targets))])
+        found = sum(len(matches) for matches in results['scan'])
+        lost = sum(len(a - b) for a, b in zip(results['scan'],
+                                              results['index']))
+        added = sum(len(b - a) for a, b in zip(results['scan'],
+                                               results['index']))
+        print(f'\t{found} matches, {lost} lost and {added} added by the '
+              'index')
+        passed = passed and lost == added == 0
+    return passed
+
+
+def time_position_joins(sample):
+    """Times the joins between toponyms and positions on a sample"""
+    from toponym_main import toponym_data
+
+    def toponym_rows():
+        toponym_data([(toponym_id, ) for toponym_id, *_ in sample])
+
+    def full_join():
+        operations.execute('select count(*), avg(latitude) from toponym '
+                           'join position on position_id == position_fk')
+
+    def grouped_join():
+        # The core of the exports, which works on either schema.
+        operations.execute('select position_id, count(*), avg(longitude) '
+                           'from toponym join position on '
+                           'position_id == position_fk '
+                           'group by position_id')
+
+    return [(label, timed(func, 1), repeats) for label, func, repeats in
+            (('toponym_data', toponym_rows, len(sample)),
+             ('toponym join position', full_join, 1),
+             ('grouped by position', grouped_join, 1))]
+
+
+def bench_position_keys(repeats=100):
+    """Times the position joins, before and after the integer key migration
+
+    The migration is made on a copy of the database. On a database that has
+    already been migrated only the current timings are reported.
+    """
+    with database_copy():
+        sample = sample_toponyms(min(repeats, 100))
+        columns = initiate_schema.table_columns(operations.get_connection(),
+                                                'position')
+        if 'external_id' not in columns:
+            report('Positions keyed by external id',
+                   time_position_joins(sample))
+            start = perf_counter()
+            initiate_schema.migrate()
+            print(f'Migration took {perf_counter() - start:.2f}s')
+        report('Positions keyed by integer', time_position_joins(sample))
+
+
+def synthetic_names(n, seed=1):
+    """Makes n random, but repeatable, toponyms from a set of syllables"""
+    rng = random.Random(seed)
+    syllables = ['br', 'no', 'pra', 'ha', 'ost', 'ra', 'va', 'ple', 'zeň',
+                 'ko', 'lín', 'hrad', 'ec', 'mě', 'sto', 'dol', 'ná', 'vy']
+    return [''.join(rng.choice(syllables) for _ in range(rng.randint(2, 4)))
+            .title() for _ in range(n)]
+
+
+def seed_synthetic(n, chunk=1000):
+    """Seeds the database from the settings with n positions and toponyms
+
+    The rows are written in chunks, as seed.py does with the GeoNames files.
+    """
+    initiate_schema.create_tables()
+    operations.execute('INSERT INTO source (name, comment, year) values '
+                       '("geonxx", "synthetic", 2022)')
+    names = synthetic_names(n)
+    for start in range(1, n, chunk):
+        ids = range(start, min(n, start + chunk))
+        operations.execute('INSERT into position (position_id, external_id, '
+                           'source_fk, latitude, longitude, parent_fk, '
+                           'position_created) values (?, ?, ?, ?, ?, ?, '
+                           'datetime("NOW"))',
+                           values=[(i, str(i), 'geonxx', 48 + i % 997 / 199,
+                                    12 + i % 991 / 99, 'XX') for i in ids],
+                           many=True)
+        toponyms = []
+        for i in ids:
+            tokens, asciiname, asciitokens, pattern = \
+                operations.preprocess_toponym(names[i])
+            toponyms.append((i, 'geonxx', names[i], asciiname, pattern,
+                             tokens, asciitokens, '', 'GeoNames-Default'))
+        operations.add_toponym_list(toponyms)
+    operations.flush_writes()
+
+
+def time_profile_workload(n):
+    """Times seeding, matching and exporting n synthetic toponyms"""
+    import matchers
+
+    seeding = timed(lambda: seed_synthetic(n), 1)
+    sample = sample_toponyms(100)
+    m = matchers.matcher()
+
+    def perfect():
+        for toponym_id, name, pattern, language in sample:
+            m.perfect_matches(target_id=toponym_id, target=name,
+                              languages=language)
+
+    def options():
+        # A full scan of the options, as made by the distance matcher
+        for toponym_id, *_ in sample[:10]:
+            for _ in m.get_options(toponym_id, languages=''):
+                pass
+
+    def export():
+        for _ in operations.iterate(
+                'select position_id, count(*), min(name), avg(latitude) '
+                'from toponym join position on position_id == position_fk '
+                'group by position_id', profile=settings.storage_profile):
+            pass
+
+    return [(f'seed {n} toponyms', seeding, n),
+            ('perfect matches', timed(perfect, 1), len(sample)),
+            ('option scans', timed(options, 1), len(sample[:10])),
+            ('grouped export', timed(export, 1), 1)]
+
+
+def bench_profiles(repeats=1000):
+    """Times seeding, matching and exporting with each storage profile
+
+    Each profile gets a new temporary database, seeded with repeats * 100
+    synthetic toponyms, so the database from the settings is left alone.
+    """
+    path, profile = settings.database_path, settings.storage_profile
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for name in settings.storage_profiles:
+                settings.database_path = os.path.join(
+                    directory, name.replace(' ', '_') + '.sqlite3')
+                settings.storage_profile = name
+                report(f'Storage profile: {name}',
+                       time_profile_workload(repeats * 100))
+                operations.close_connection()
+    finally:
+        settings.database_path, settings.storage_profile = path, profile
+
+
+def bench_seed_memory(repeats=1000):
+    """Measures the peak memory of reading the alternate names dump
+
+    The streaming pipeline of seed.seed_alt_names: parse, filter, chunk and
+    preprocess, is run over growing parts of the file, nothing is written to
+    the database. Its peak should stay the same regardless of the number of
+    lines, unlike reading the lines all at once, as was done before, which
+    is only measured for the smaller parts.
+    """
+    import seed
+
+    path = seed.get_geonames_dump('alternateNamesV2')
+    with seed.open_geonames(path) as f:
+        total = sum(1 for _ in f)
+
+    def streamed(lines):
+        kept = 0
+        rows = islice(seed.read_geonames(path, seed.altname), lines)
+        for portion in seed.chunked(seed.filter_alt_names(rows),
+                                    settings.num_rows):
+            for is_wiki, alt_row in portion:
+                if not is_wiki:
+                    operations.preprocess_toponym(alt_row.name)
+            kept += len(portion)
+
+    def read_at_once(lines):
+        with seed.open_geonames(path) as f:
+            rows = list(islice(f, lines))
+        return len(rows)
+
+    print(f'Peak memory: {path} ({total} lines)')
+    for fraction in (0.01, 0.1, 1):
+        lines = int(total * fraction)
+        for label, func in (('streamed', streamed),
+                            ('read at once', read_at_once)):
+            if func is read_at_once and fraction == 1:
+                continue
+            tracemalloc.start()
+            start = perf_counter()
+            func(lines)
+            seconds = perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f'\t{label:<15} {lines:>10} lines {peak / 2**20:9.1f}MiB '
+                  f'{seconds:8.1f}s')
+
+
+def bench_preprocess(repeats=1000):
+    """Compares the throughput of serial and parallel preprocessing
+
+    Preprocesses repeats * 100 synthetic toponyms, in the main process and
+    with operations.preprocess_many at a growing number of workers, starting
+    from an empty name cache each time.
+    """
+    names = synthetic_names(repeats * 100)
+    workers = settings.preprocess_workers
+
+    def throughput(label, func):
+        operations.name_cache.clear()
+        seconds = timed(func, 1)
+        print(f'\t{label:<30} {seconds:9.4f}s '
+              f'{len(names) / seconds:12.0f} rows/s')
+
+    print(f'Preprocessing {len(names)} toponyms')
+    throughput('serial', lambda: [operations.preprocess_toponym(name)
+                                  for name in names])
+    try:
+        for n in sorted({2, 4, os.cpu_count() or 1}):
+            settings.preprocess_workers = n
+            # Starting the processes before the timing
+            operations.get_pool().submit(int).result()
+            throughput(f'{n} workers',
+                       lambda: operations.preprocess_many(names))
+    finally:
+        settings.preprocess_workers = workers
+
+
+def bench_name_cache(repeats=1000):
+    """Measures the name cache of preprocess_many on a real country dump
+
+    Preprocesses the names and the alternate names of the first country in
+    the settings, in portions of settings.num_rows like seeding does, twice:
+    starting from an empty cache, then from the cache left by the first pass.
+    """
+    import seed
+
+    country = settings.countries[0]
+    names = []
+    for geo_row in seed.read_geonames(seed.get_geonames_dump(country),
+                                      seed.geoname):
+        names.append(geo_row.name)
+        names.extend(name for name in geo_row.alternatenames.split(',')
+                     if name)
+    portions = [names[i:i + settings.num_rows]
+                for i in range(0, len(names), settings.num_rows)]
+
+    def run():
+        for portion in portions:
+            operations.preprocess_many(portion)
+
+    print(f'Preprocessing the {len(names)} names of {country}, '
+          f'{len(set(names))} distinct, with a cache of '
+          f'{operations.name_cache.stats()["size"]} names')
+    operations.name_cache.clear()
+    for label in ('cold cache', 'warm cache'):
+        seconds = timed(run, 1)
+        stats = operations.name_cache.stats(reset=True)
+        print(f'\t{label:<15} {seconds:9.4f}s '
+              f'{len(names) / seconds:12.0f} rows/s '
+              f'{100 * stats["hit_rate"]:6.1f}% hits')
+
+
+def bench_zip_io(repeats=1000):
+    """Compares extracting the GeoNames archives with streaming from them
+
+    Covers the archives of a full reseed: the countries and adjacents from
+    the settings and the alternate names, which are downloaded if
+    necessary. Extraction writes the whole .txt file and reads it back,
+    streaming only reads the archive. The extractions go to a temporary
+    directory, which is removed afterwards.
+    """
+    import seed
+
+    files = sorted(settings.countries) + sorted(settings.adjacents)
+    files.append('alternateNamesV2')
+
+    print('Reading the GeoNames archives')
+    extract_io = stream_io = extracted = 0
+    extract_total = stream_total = 0
+    with tempfile.TemporaryDirectory() as directory:
+        for file in files:
+            zip_path = seed.get_geonames_zip(file)
+            with zipfile.ZipFile(zip_path) as archive:
+                info = archive.getinfo(file + '.txt')
+
+            def extract():
+                with zipfile.ZipFile(zip_path) as archive:
+                    txt_path = archive.extract(info, directory)
+                with open(txt_path, 'r', encoding='utf8') as f:
+                    for _ in f:
+                        pass
+                os.remove(txt_path)
+
+            def stream():
+                with seed.open_geonames(zip_path) as f:
+                    for _ in f:
+                        pass
+
+            extract_seconds = timed(extract, 1)
+            stream_seconds = timed(stream, 1)
+            # Bytes read from and written to the disk by each approach
+            extract_bytes = info.compress_size + 2 * info.file_size
+            stream_bytes = info.compress_size
+            print(f'\t{file:<20} extract {extract_seconds:8.2f}s '
+                  f'{extract_bytes / 2**20:9.1f}MiB  stream '
+                  f'{stream_seconds:8.2f}s {stream_bytes / 2**20:9.1f}MiB')
+            extract_io += extract_bytes
+            extracted += info.file_size
+            stream_io += stream_bytes
+            extract_total += extract_seconds
+            stream_total += stream_seconds
+
+    print(f'\t{"total":<20} extract {extract_total:8.2f}s '
+          f'{extract_io / 2**20:9.1f}MiB  stream '
+          f'{stream_total:8.2f}s {stream_io / 2**20:9.1f}MiB')
+    print(f'\tDisk I/O saved: {(extract_io - stream_io) / 2**20:.1f}MiB, '
+          f'disk space saved: {extracted / 2**20:.1f}MiB')
+
+
+def bench_bulk_seed(repeats=1000):
+    """Compares the throughput of the default and the bulk seeding modes
+
+    Seeds the GeoNames files from the settings, without the Wikipedia links,
+    whose rate depends on WikiData, into a new temporary database for each
+    mode. The bulk time includes building the indexes at the end.
+    """
+    import seed
+
+    path = settings.database_path
+    print('Seeding the GeoNames files from the settings')
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for bulk in (False, True):
+                mode = 'bulk' if bulk else 'default'
+                settings.database_path = os.path.join(directory,
+                                                      mode + '.sqlite3')
+
+                def seeding():
+                    with seed.bulk_mode() if bulk else nullcontext():
+                        initiate_schema.create_tables()
+                        seed.seed_tables(bulk=bulk, links=False)
+
+                seconds = timed(seeding, 1)
+                rows = operations.execute(
+                    'select (select count(*) from position) + '
+                    '(select count(*) from toponym)')[0][0]
+                print(f'\t{mode:<30} {seconds:9.2f}s {rows:>10} rows '
+                      f'{rows / seconds:12.0f} rows/s')
+                operations.close_connection()
+    finally:
+        settings.database_path = path
+
+
+class StandInWikipedia(BaseHTTPRequestHandler):
+    """A local stand-in for the MediaWiki API and the WikiData SPARQL service
+
+    Every page exists, its WikiData item is derived from its title, every
+    item has two names in each language asked for, and each request takes
+    at least the latency of the server, in seconds. Beyond quota requests
+    per second, if any, requests are refused with a Retry-After.
+    """
+    latency = 0.02
+    quota = None
+    requests = 0
+    refused = 0
+    lock = threading.Lock()
+    window = (0, 0)
+
+    def do_GET(self):
+        handler = type(self)
+        with handler.lock:
+            handler.requests += 1
+            second, count = handler.window
+            now = int(time.monotonic())
+            handler.window = (now, count + 1 if now == second else 1)
+            refuse = handler.quota is not None and \
+                handler.window[1] > handler.quota
+            handler.refused += refuse
+        if refuse:
+            self.send_response(429)
+            self.send_header('Retry-After', '1')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        time.sleep(self.latency)
+        params = parse_qs(urlsplit(self.path).query)
+        if 'query' in params:
+            body = self.sparql(params['query'][0])
+        else:
+            body = self.pageprops(params['titles'][0].split('|'))
+        body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def pageprops(self, titles):
+        return {'query': {
+            'normalized': [{'from': title, 'to': title.replace('_', ' ')}
+                           for title in titles if '_' in title],
+            'pages': {str(-i): {'title': title.replace('_', ' '),
+                                'pageprops': {'wikibase_item':
+                                              f'Q{abs(hash(title))}'}}
+                      for i, title in enumerate(titles)}}}
+
+    def sparql(self, query):
+        items = re.findall(r'wd:(Q\d+)', query)
+        languages = re.findall(r"'(\w+)'", query.split('VALUES ?language')[1])
+        return {'results': {'bindings': [
+            {'item': {'value': f'http://www.wikidata.org/entity/{item}'},
+             'language': {'value': language},
+             'toponym': {'value': f'{item}{language}___Alt{item}'}}
+            for item in items for language in languages]}}
+
+    def log_message(self, *args):
+        pass
+
+
+def stand_in_wikipedia():
+    """Starts a StandInWikipedia server and points wiki_operations at it
+
+    Returns:
+        The function restoring wiki_operations and stopping the server
+    """
+    import wiki_operations
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInWikipedia)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    url = f'http://127.0.0.1:{server.server_port}'
+    previous = (wiki_operations.wikipedia_api,
+                wiki_operations.sparql_endpoint)
+    wiki_operations.wikipedia_api = url + '/{language}/w/api.php'
+    wiki_operations.sparql_endpoint = url + '/sparql'
+
+    def stop():
+        server.shutdown()
+        wiki_operations.wikipedia_api, wiki_operations.sparql_endpoint = \
+            previous
+    return stop
+
+
+def bench_wiki_titles(repeats=1000):
+    """Compares resolving Wikipedia links one at a time and in batches
+
+    Resolves repeats links, in two languages, against a local stand-in of
+    the MediaWiki API, with a new title cache in a temporary directory:
+    one link per request, as was done before, all the links in batches of
+    wiki_operations.max_titles, and the same links again from the cache.
+    """
+    import wiki_operations
+
+    links = [f'https://{language}.wikipedia.org/wiki/Place_{i}'
+             for i in range(repeats) for language in ('en', 'de')][:repeats]
+    stop = stand_in_wikipedia()
+    cache_path = wiki_operations.title_cache_path
+    print(f'Resolving {len(links)} Wikipedia links, '
+          f'{StandInWikipedia.latency * 1000:.0f}ms per request')
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            for label, func in (
+                    ('one link per request',
+                     lambda: [wiki_operations.fetch_base_item(link)
+                              for link in links]),
+                    ('batched', lambda: wiki_operations.fetch_base_items(
+                        links)),
+                    ('cached', lambda: wiki_operations.fetch_base_items(
+                        links))):
+                if label != 'cached':
+                    wiki_operations.title_cache_path = os.path.join(
+                        directory, label.replace(' ', '_') + '.sqlite3')
+                StandInWikipedia.requests = 0
+                seconds = timed(func, 1)
+                print(f'\t{label:<30} {seconds:9.4f}s '
+                      f'{StandInWikipedia.requests:>8} requests '
+                      f'{len(links) / seconds:12.0f} links/s')
+    finally:
+        stop()
+        wiki_operations.title_cache_path = cache_path
+
+
+def bench_wiki_fetch(repeats=1000):
+    """Times fetching the names of WikiData items, serially and concurrently
+
+    Fetches the names of repeats items, from a local stand-in of the
+    SPARQL service, which refuses the requests beyond its quota of 10 per
+    second. With the rate limit at the quota the throughput is set by the
+    quota, a rate limit beyond it is made up for by the Retry-After of the
+    refused requests.
+    """
+    import wiki_operations
+
+    identifiers = [f'q{i}' for i in range(1, repeats + 1)]
+    stop = stand_in_wikipedia()
+    workers, limiter = settings.wiki_workers, wiki_operations.limiter
+    StandInWikipedia.latency, StandInWikipedia.quota = 0.2, 10
+    print(f'Fetching the names of {len(identifiers)} WikiData items, '
+          f'{StandInWikipedia.latency * 1000:.0f}ms per request, at most '
+          f'{StandInWikipedia.quota} requests per second')
+    try:
+        for n, rate in ((1, 10), (4, 10), (8, 10), (8, 40)):
+            settings.wiki_workers = n
+            wiki_operations.limiter = wiki_operations.RateLimiter(rate, n)
+            StandInWikipedia.requests = StandInWikipedia.refused = 0
+            seconds = timed(lambda: wiki_operations.get_wiki_names(
+                identifiers, ['cs', 'en']), 1)
+            print(f'\t{n} workers, {rate:>3} requests/s {seconds:9.2f}s '
+                  f'{StandInWikipedia.requests:>6} requests '
+                  f'{StandInWikipedia.refused:>6} refused '
+                  f'{len(identifiers) / seconds:9.0f} items/s')
+    finally:
+        stop()
+        StandInWikipedia.latency, StandInWikipedia.quota = 0.02, None
+        settings.wiki_workers, wiki_operations.limiter = workers, limiter
+
+
+def bench_wiki_queue(repeats=1000):
+    """Times claiming a batch of the WikiData queue, by random and by cursor
+
+    Fills a new temporary database with a queue of repeats * 100 rows, of
+    which half are processed, and claims 50 rows repeats times the way it
+    used to be done, ordering the queue by random(), and with
+    operations.claim_wiki_queue.
+    """
+    path = settings.database_path
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            settings.database_path = os.path.join(directory, 'queue.sqlite3')
+            initiate_schema.create_tables()
+            n = repeats * 100
+            operations.execute('INSERT INTO wiki_queue (wiki_id, position_fk, '
+                               'source_fk, title, processed) values '
+                               '(?, ?, "WikDat", ?, ?)',
+                               values=[(f'q{i}', i, f'Place {i}', i < n / 2)
+                                       for i in range(n)], many=True)
+            cursor = iter(range(n // 2, n, 50))
+
+            def random_claim():
+                operations.execute('select wiki_id, position_fk, source_fk '
+                                   'from wiki_queue where processed == FALSE '
+                                   'and wiki_id is not NULL '
+                                   'order by random() limit 50')
+
+            report(f'Claiming 50 rows from a queue of {n} rows',
+                   [('order by random()', timed(random_claim, repeats),
+                     repeats),
+                    ('cursor', timed(lambda: operations.claim_wiki_queue(
+                        50, next(cursor, 0)), repeats), repeats)])
+            operations.close_connection()
+    finally:
+        settings.database_path = path
+
+
+# The entry points timed by bench_startup, the most seconds starting the
+# interpreter and importing each of them may take, and the modules too slow
+# to import before they are used.
+startup_modules = ('settings', 'operations', 'wiki_operations',
+                   'initiate_schema', 'toponym_main', 'seed',
+                   'configure_settings')
+startup_budget = 0.5
+startup_heavy = ('requests', 'tqdm', 'anvil', 'wget', 'yaml')
+
+# Imports a module, recording the files other than the sources opened, and
+# the databases connected to, meanwhile. It imports nothing of its own,
+# which would be left out of the import times of the module.
+import_script = '''
+import sys
+
+opened = []
+connected = []
+
+
+def audit(event, args):
+    if event == 'open' and isinstance(args[0], str) \\
+            and not args[0].endswith(('.py', '.pyc')):
+        opened.append(args[0])
+    elif event == 'sqlite3.connect':
+        connected.append(str(args[0]))
+
+
+sys.addaudithook(audit)
+import {module}
+print(repr({{'opened': opened, 'connected': connected}}))
+'''
+
+
+def import_times(stderr):
+    """Reads the output of python -X importtime
+
+    Lines of "import time: self [us] | cumulative | imported package", each
+    module comes after the modules it imports, indented one level deeper.
+
+    Returns:
+        list of (name, cumulative seconds, depth) of the imported modules
+    """
+    times = []
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| ( *)(.*)$', line)
+        if match is not None:
+            times.append((match[3], int(match[1]) / 1e6, len(match[2]) // 2))
+    return times
+
+
+def import_module(module, directory):
+    """Imports a module in a new interpreter with python -X importtime
+
+    The interpreter runs in directory, with the repository on its path.
+
+    Returns:
+        dict of
+            returncode, stderr - of the interpreter
+            times - the import_times of all the modules imported
+            seconds - the cumulative seconds of importing the module
+            total - the seconds of all the imports, the interpreter's and
+                site's included
+            imports - list of the (cumulative seconds, name) of the modules
+                the module imports itself
+            opened - list of the files opened while importing it
+            connected - list of the databases connected to meanwhile
+    """
+    repository = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [repository, env.get('PYTHONPATH')]))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             import_script.format(module=module)],
+                            cwd=directory, env=env,
+                            capture_output=True, text=True)
+    imported = {'returncode': result.returncode, 'stderr': result.stderr,
+                'times': import_times(result.stderr), 'seconds': 0,
+                'opened': [], 'connected': []}
+    if result.returncode == 0:
+        imported.update(ast.literal_eval(result.stdout.splitlines()[-1]))
+
+    # The modules at the top level before the module are imported by the
+    # interpreter and site
+    imported['total'] = sum(cumulative for _, cumulative, depth
+                            in imported['times'] if depth == 0)
+    imports = []
+    for name, cumulative, depth in imported['times']:
+        if depth == 0 and name == module:
+            imported['seconds'] = cumulative
+            break
+        if depth == 0:
+            imports = []
+        elif depth == 1:
+            imports.append((cumulative, name))
+    imported['imports'] = imports
+    return imported
+
+
+def bench_startup(repeats=1000):
+    """Checks that the entry points import quickly and without side effects
+
+    Imports each of startup_modules in a new interpreter with
+    python -X importtime, from an empty temporary directory, and reports the
+    time spent importing it and its slowest imports. Fails when the imports,
+    the interpreter's included, take longer than startup_budget, when any of
+    startup_heavy is imported, or when the import leaves any file behind.
+
+    Returns:
+        False when any module is over the budget or has side effects
+    """
+    passed = True
+
+    print(f'Importing the entry points, within {startup_budget}s each')
+    for module in startup_modules:
+        with tempfile.TemporaryDirectory() as directory:
+            imported = import_module(module, directory)
+            created = os.listdir(directory)
+        slowest = sorted(imported['imports'], reverse=True)[:3]
+        heavy = sorted({name for name, _, _ in imported['times']
+                        if name.split('.')[0] in startup_heavy})
+
+        problems = []
+        if imported['returncode'] != 0:
+            problems.append(imported['stderr'].strip().splitlines()[-1])
+        if imported['total'] > startup_budget:
+            problems.append(f'over the budget, {imported["total"]:.3f}s '
+                            'in all')
+        if heavy:
+            problems.append(f'imports {", ".join(heavy)}')
+        if created:
+            problems.append(f'created {", ".join(created)}')
+        passed = passed and not problems
+        print(f'\t{module:<20} {imported["seconds"]:9.4f}s  '
+              + ', '.join(f'{name} {cumulative:.3f}s'
+                          for cumulative, name in slowest)
+              + ''.join(f'\n\t\tFAILED: {problem}' for problem in problems))
+    return passed
+
+
+benchmarks = {'connections': bench_connections,
+              'indexes': bench_indexes,
+              'token_index': bench_token_index,
+              'distance_index': bench_distance_index,
+              'position_keys': bench_position_keys,
+              'profiles': bench_profiles,
+              'seed_memory': bench_seed_memory,
+              'preprocess': bench_preprocess,
+              'name_cache': bench_name_cache,
+              'zip_io': bench_zip_io,
+              'bulk_seed': bench_bulk_seed,
+              'wiki_titles': bench_wiki_titles,
+              'wiki_fetch': bench_wiki_fetch,
+              'wiki_queue': bench_wiki_queue,
+              'startup': bench_startup}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the database layer against the seeded '
+                    'database from the settings file.')
+    parser.add_argument('benchmarks', metavar='benchmark', type=str,
+                        nargs='+',
+                        help='The benchmark(s) to run, one or more of: '
+                        + ', '.join(benchmarks))
+    parser.add_argument('-d', '--db_path', metavar='database_path', type=str,
+                        nargs='?', default=None,
+                        help='Run against another seeded database.')
+    parser.add_argument('-r', '--repeats', metavar='repeats', type=int,
+                        nargs='?', default=1000,
+                        help='The number of times each query is repeated.')
+
+    args = parser.parse_args()
+
+    if args.db_path is not None:
+        settings.database_path = args.db_path
+
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error(f'Unknown benchmark: {name}')
+
+    failed = [name for name in args.benchmarks
+              if benchmarks[name](repeats=args.repeats) is False]
+    if failed:
+        parser.exit(1, f'Failed: {", ".join(failed)}\n')
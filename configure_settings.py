@@ -61,7 +61,7 @@ if __name__ == '__main__':
                         'These names will be mapped to the same single point'
                         'to help filter out them from.')
     parser.add_argument('-n', '--num-rows', metavar='num_rows', type=int,
-                        nargs='?', default=1e100,
+                        nargs='?', default=settings.num_rows,
                         help='The number of rows of toponyms to batch add to '
                         'database, may be necessary for machines with less '
                         'memory.')
@@ -69,10 +69,36 @@ if __name__ == '__main__':
                         nargs='?', default=500,
                         help='Set the size of the query to wikidata for more '
                         'topnym variants. Defaults to 500, 0 turns this off.')
+    parser.add_argument('--wiki-workers', metavar='wiki_workers', type=int,
+                        nargs='?', default=settings.wiki_workers,
+                        help='The number of concurrent requests to Wikipedia '
+                        f'and WikiData. Defaults to {settings.wiki_workers}.')
+    parser.add_argument('--wiki-rate', metavar='wiki_requests_per_second',
+                        type=float, nargs='?',
+                        default=settings.wiki_requests_per_second,
+                        help='The most requests made to Wikipedia and '
+                        'WikiData per second. Defaults to '
+                        f'{settings.wiki_requests_per_second}.')
+    parser.add_argument('--wiki-user-agent', metavar='wiki_user_agent',
+                        type=str, nargs='?',
+                        default=settings.wiki_user_agent,
+                        help='The User-Agent of the requests to Wikipedia '
+                        'and WikiData, which Wikimedia asks to include a way '
+                        'to contact you. Defaults to '
+                        f'"{settings.wiki_user_agent}".')
+    parser.add_argument('-s', '--storage-profile', metavar='storage_profile',
+                        type=str, nargs='?', default=settings.storage_profile,
+                        choices=list(settings.storage_profiles),
+                        help='The SQLite settings used when serving the GUI: '
+                        + ', '.join(settings.storage_profiles))
 
     args = parser.parse_args()
 
     settings.num_rows = args.num_rows
+    settings.storage_profile = args.storage_profile
+    settings.wiki_workers = max(1, args.wiki_workers)
+    settings.wiki_requests_per_second = args.wiki_rate
+    settings.wiki_user_agent = args.wiki_user_agent
 
     db_path = args.db_path
     token = args.token
@@ -129,7 +155,7 @@ if __name__ == '__main__':
             token = 'Replace this text with your server token'
     settings.server_token = token
 
-    settings.wiki_rows = min(0, abs(args.wiki_rows))
+    settings.wiki_rows = min(500, abs(args.wiki_rows))
 
     settings.save()
     print('Settings saved.')
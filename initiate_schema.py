@@ -1,8 +1,460 @@
 # coding=<utf-8>
-
-from settings import settings
+import argparse
+import re
 import sqlite3
 
+from operations import apply_profile
+from operations import get_connection
+from operations import transaction
+
+
+# Secondary indexes for the lookups made by the matcher, the disambiguation
+# and the exports, by name and indexed columns.
+indexes = {'toponym_position_fk': 'toponym (position_fk)',
+           'toponym_name': 'toponym (name)',
+           'toponym_asciiname': 'toponym (asciiname)',
+           'toponym_tokens': 'toponym (tokens)',
+           'toponym_asciitokens': 'toponym (asciitokens)',
+           'toponym_source_fk': 'toponym (source_fk)',
+           'toponym_language': 'toponym (language)',
+           # Only the added toponyms have a match_state
+           'toponym_match_state': 'toponym (match_state) '
+                                  'WHERE match_state IS NOT NULL',
+           'toponym_event_toponym': 'toponym_event (toponym_fk)',
+           # The postings of a toponym, updated along with the toponym
+           'toponym_token_toponym': 'toponym_token (toponym_id)',
+           'toponym_gram_toponym': 'toponym_gram (toponym_id)',
+           'toponym_geonames_alt_id': 'toponym (geonames_alt_id) '
+                                      'WHERE geonames_alt_id IS NOT NULL',
+           # The rows of the WikiData queue still to be processed
+           'wiki_queue_pending': 'wiki_queue (processed) '
+                                 'WHERE wiki_id IS NOT NULL',
+           'suggestion_added': 'suggestion (added_toponym_fk, outcome)',
+           'suggestion_pair': 'suggestion (added_toponym_fk, '
+                              'stable_toponym_fk)',
+           'suggestion_stable': 'suggestion (stable_toponym_fk, outcome)',
+           'nemo_added': 'nemo (added_toponym_fk, outcome)',
+           'nemo_pair': 'nemo (added_toponym_fk, stable_toponym_fk)',
+           'nemo_stable': 'nemo (stable_toponym_fk, outcome)',
+           }
+
+# The first and the second half of a name, in SQL. Two names of the same
+# length a hamming distance of 1 apart have one of the halves in common.
+name_halves = ('substr({0}, 1, length({0}) / 2)',
+               'substr({0}, length({0}) / 2 + 1)')
+
+# The names by their length and either half, for the hamming1 matcher
+for field in ('name', 'asciiname'):
+    for half, expression in zip(('head', 'tail'), name_halves):
+        indexes[f'toponym_{field}_{half}'] = \
+            f'toponym (length({field}), {expression.format(field)})'
+
+# Each pair is only suggested once, which the upserts of the matcher rely on
+unique_indexes = {'suggestion_pair', 'nemo_pair'}
+
+
+def create_indexes(conn):
+    """Creates any of the secondary indexes that do not exist yet"""
+    for name, columns in indexes.items():
+        unique = 'UNIQUE' if name in unique_indexes else ''
+        conn.execute(f'CREATE {unique} INDEX IF NOT EXISTS {name} '
+                     f'ON {columns}')
+
+
+def drop_indexes(conn):
+    """Drops the secondary indexes, e.g. for timing queries without them"""
+    for name in indexes:
+        if name not in unique_indexes:
+            conn.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+def table_columns(conn, table):
+    """Lists the names of the columns of a table, empty if it is missing"""
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def primary_key(conn, table):
+    """Lists the columns of the primary key of a table, in order"""
+    return [name for _, name in sorted(
+        (row[5], row[1]) for row in conn.execute(f'PRAGMA table_info({table})')
+        if row[5] > 0)]
+
+
+def migrate_position_keys(conn):
+    """Moves the positions over to integer keys
+
+    Positions used to be keyed directly by their GeoNames or manual id, e.g.
+    "M_123", which is now kept as the external_id. GeoNames ids keep their
+    value as key, while the other positions are given new keys, and all the
+    references to the positions are updated to match.
+    """
+    if 'external_id' in table_columns(conn, 'position') or \
+            len(table_columns(conn, 'position')) == 0:
+        return
+
+    # The triggers are recreated by create_tables, after the references have
+    # been updated, so that the edit dates are left as they were.
+    conn.execute('DROP TRIGGER IF EXISTS set_position_edit')
+    conn.execute('DROP TRIGGER IF EXISTS set_toponym_edit')
+    conn.execute('ALTER TABLE position RENAME TO position_old')
+    conn.execute(position_table)
+
+    copy_query = 'INSERT INTO position (position_id, external_id, '\
+                 'source_fk, latitude, longitude, parent_fk, comment, '\
+                 'position_created, position_edited) '\
+                 'SELECT {}, CAST(position_id AS TEXT), source_fk, latitude, '\
+                 'longitude, parent_fk, comment, position_created, '\
+                 'position_edited FROM position_old WHERE {}'
+    numeric = 'CAST(CAST(position_id AS INTEGER) AS TEXT) == '\
+              'CAST(position_id AS TEXT)'
+    # GeoNames ids first, so that the new keys are numbered after them.
+    conn.execute(copy_query.format('CAST(position_id AS INTEGER)', numeric))
+    conn.execute(copy_query.format('NULL', 'NOT ' + numeric))
+
+    for table, column in (('toponym', 'position_fk'),
+                          ('wiki_queue', 'position_fk')):
+        conn.execute(f'UPDATE {table} SET {column} = (SELECT position_id '
+                     'FROM position WHERE external_id == '
+                     f'CAST({table}.{column} AS TEXT)) '
+                     f'WHERE {column} IS NOT NULL')
+
+    conn.execute('DROP TABLE position_old')
+    # The clusters are recalculated for every export anyway.
+    conn.execute('DROP TABLE IF EXISTS cluster')
+
+
+def migrate_position_fk(conn):
+    """Gives the references to the positions INTEGER affinity
+
+    The position_fk of toponym and wiki_queue used to be declared without a
+    type, so position ids bound as text were stored, and compared, as text,
+    and never equal to the integer position_id. Both tables are made anew
+    from their own schema with the column as INTEGER, which turns the ids
+    back into integers as they are copied. Their triggers and indexes, which
+    are dropped along with them, are recreated by create_tables.
+    """
+    for table in ('toponym', 'wiki_queue'):
+        info = conn.execute(f'PRAGMA table_info({table})').fetchall()
+        types = {name: declared for _, name, declared, *_ in info}
+        if types.get('position_fk', 'INTEGER').upper() == 'INTEGER':
+            continue
+        (schema, ) = conn.execute('SELECT sql FROM sqlite_master WHERE '
+                                  'type == "table" AND name == ?',
+                                  (table, )).fetchone()
+        schema = re.sub(rf'^CREATE TABLE\s+["`\[]?{table}["`\]]?',
+                        f'CREATE TABLE {table}_typed', schema)
+        schema = re.sub(r'\bposition_fk\b[^,)]*', 'position_fk INTEGER',
+                        schema, count=1)
+        conn.execute(schema)
+        # The tables without a primary key keep their rowids, wiki_queue is
+        # processed in their order.
+        columns = ', '.join(types)
+        if not any(row[5] for row in info):
+            columns = 'rowid, ' + columns
+        conn.execute(f'INSERT INTO {table}_typed ({columns}) '
+                     f'SELECT {columns} FROM {table}')
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {table}_typed RENAME TO {table}')
+
+
+def migrate_match_state(conn):
+    """Adds the match_state of the added toponyms
+
+    The state is read from the comments left by the matcher and the
+    endpoints, which stay in place as the history before the events.
+    """
+    if 'match_state' in table_columns(conn, 'toponym') or \
+            len(table_columns(conn, 'toponym')) == 0:
+        return
+
+    # Recreated by create_tables, so that the edit dates are left as they were
+    conn.execute('DROP TRIGGER IF EXISTS set_toponym_edit')
+    conn.execute('ALTER TABLE toponym ADD COLUMN match_state')
+    conn.execute('UPDATE toponym SET match_state = CASE '
+                 'WHEN position_fk IS NULL AND comment LIKE "multiple_%" '
+                 'THEN "multiple" '
+                 'WHEN position_fk IS NULL THEN "unmatched" '
+                 'WHEN position_fk == 0 THEN "foreign" '
+                 'WHEN comment LIKE "Disambiguated to%" THEN "disambiguated" '
+                 'WHEN comment LIKE "single_%" '
+                 'OR comment LIKE "All remaining suggestions%" '
+                 'THEN "auto-single" '
+                 'ELSE "manual" END '
+                 'WHERE length(source_fk) > 6')
+
+
+def migrate_postings(conn):
+    """Adds the missing postings of the toponyms
+
+    The postings of all the toponyms seeded so far are filled in at once,
+    the triggers made by create_tables keep them up to date from then on.
+    Postings with another primary key than the current one, like the
+    toponym_gram of one row per character, are made anew, and so are the
+    triggers filling them.
+    """
+    if len(table_columns(conn, 'toponym')) == 0:
+        return
+    create_numbers(conn)
+    current = sqlite3.connect(':memory:')
+    for table, (create_table, _, _) in postings.items():
+        current.execute(create_table)
+        if primary_key(conn, table) not in ([], primary_key(current, table)):
+            for action in ('add', 'update', 'delete'):
+                conn.execute(f'DROP TRIGGER IF EXISTS {action}_{table}s')
+            conn.execute(f'DROP TABLE {table}')
+        if len(table_columns(conn, table)) == 0:
+            conn.execute(create_table)
+            fill_postings(conn, table)
+    current.close()
+
+
+def migrate_geonames_alt_id(conn):
+    """Adds the column for the GeoNames alternateNameId of the toponyms
+
+    Only names seeded after it was added have an id, seed.py --update
+    fills it in for the older names that are modified.
+    """
+    columns = table_columns(conn, 'toponym')
+    if 'geonames_alt_id' in columns or len(columns) == 0:
+        return
+    conn.execute('ALTER TABLE toponym ADD COLUMN geonames_alt_id INTEGER')
+
+
+def compact_suggestions(conn):
+    """Removes the repeated pairs from the suggestion and nemo tables
+
+    Older versions of the matcher inserted the same pair in every round,
+    only one row is kept per pair: a rejection, else an acceptance, else the
+    one with the highest score. The scores are first filled in from the
+    comments, for the tables that predate them.
+
+    Returns:
+        The number of rows removed
+    """
+    from matchers import matcher_scores
+
+    removed = 0
+    for table in ('suggestion', 'nemo'):
+        columns = table_columns(conn, table)
+        if len(columns) == 0:
+            continue
+        if 'score' not in columns:
+            conn.execute(f'ALTER TABLE {table} ADD COLUMN score REAL')
+            conn.execute(f'UPDATE {table} SET score = CASE '
+                         'WHEN comment LIKE "Nemo_ %" '
+                         'THEN CAST(substr(comment, 7) AS REAL) '
+                         + ' '.join(f'WHEN comment LIKE "multiple_{prefix}%" '
+                                    f'THEN {score}' for prefix, score in
+                                    matcher_scores.items())
+                         + ' END')
+
+        removed += conn.execute(
+            f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM '
+            '(SELECT rowid, row_number() OVER (PARTITION BY '
+            'added_toponym_fk, stable_toponym_fk ORDER BY '
+            'outcome IS FALSE DESC, outcome IS TRUE DESC, score DESC, rowid) '
+            'AS n FROM ' + table + ') WHERE n > 1)').rowcount
+    return removed
+
+
+def migrate_unique_indexes(conn):
+    """Drops the unique_indexes which an older schema made as plain indexes
+
+    CREATE UNIQUE INDEX IF NOT EXISTS leaves an index of the same name as it
+    is, so they are dropped, once compact_suggestions has removed the
+    repeated pairs, for create_indexes to make them anew.
+    """
+    for table in {indexes[name].split()[0] for name in unique_indexes}:
+        for _, name, unique, *_ in conn.execute(
+                f'PRAGMA index_list({table})').fetchall():
+            if name in unique_indexes and not unique:
+                conn.execute(f'DROP INDEX {name}')
+
+
+def migrate():
+    """Brings an existing database up to date with the current schema
+
+    Safe to run repeatedly, it only adds what is missing and then runs
+    ANALYZE so that the query planner knows the sizes of the indexes.
+    """
+    with transaction() as conn:
+        migrate_position_keys(conn)
+        migrate_match_state(conn)
+        migrate_geonames_alt_id(conn)
+        migrate_position_fk(conn)
+        migrate_postings(conn)
+        removed = compact_suggestions(conn)
+        migrate_unique_indexes(conn)
+    if removed > 0:
+        print(f'Removed {removed} repeated suggestions.')
+    create_tables()
+    conn = get_connection()
+    conn.execute('ANALYZE')
+    conn.commit()
+
+
+def maintain(vacuum=False):
+    """Routine upkeep of a database in use
+
+    Takes:
+        vacuum - bool, if True the whole database is rebuilt, which also
+            applies the page_size and auto_vacuum of the storage profile.
+
+    Refreshes the statistics of the query planner and returns the free pages
+    to the file system, which only works incrementally for databases with
+    auto_vacuum = INCREMENTAL. The write-ahead log is truncated last.
+    """
+    conn = get_connection()
+    conn.execute('ANALYZE')
+    conn.execute('PRAGMA optimize')
+    conn.commit()
+    if vacuum:
+        # The page_size and auto_vacuum given when connecting are used by
+        # the VACUUM, though the page_size cannot be changed in WAL mode.
+        conn.execute('PRAGMA journal_mode = DELETE')
+        conn.execute('VACUUM')
+        apply_profile(conn)
+    else:
+        conn.execute('PRAGMA incremental_vacuum')
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+# position - keyed by an integer, which is the GeoNames id for positions from
+# GeoNames, while the external_id holds their GeoNames or manual id.
+position_table = 'CREATE TABLE IF NOT EXISTS position '\
+                 '(position_id INTEGER primary key, '\
+                 'external_id TEXT not NULL UNIQUE, '\
+                 'source_fk not NULL, latitude REAL not NULL, '\
+                 'longitude REAL not NULL, '\
+                 'parent_fk not null, '\
+                 'comment text, '\
+                 'position_created datetime not null, '\
+                 'position_edited datetime '\
+                 ')'
+
+
+# toponym_token - the postings of the tokens and asciitokens of the toponyms,
+# one row per distinct token, field being the column they come from. The
+# toponyms sharing tokens with a name are found through the primary key.
+toponym_token_table = 'CREATE TABLE IF NOT EXISTS toponym_token '\
+                      '(field text not NULL, '\
+                      'token text not NULL, '\
+                      'toponym_id INTEGER not NULL, '\
+                      'primary key (field, token, toponym_id)) '\
+                      'WITHOUT ROWID'
+
+# The columns of the toponyms with postings
+token_fields = ('tokens', 'asciitokens')
+
+
+def token_array(column):
+    """SQL turning a column of space separated tokens into a JSON array
+
+    The tokens are made of word characters and commas only, so they never
+    need escaping.
+    """
+    return f"""'["' || replace({column}, ' ', '","') || '"]'"""
+
+
+def token_rows(toponym):
+    """SQL selecting the token postings of toponym
+
+    toponym is either new, within a trigger, or toponym for all of them.
+    """
+    source = 'toponym, ' if toponym == 'toponym' else ''
+    return ' UNION ALL '.join(
+        f"SELECT '{field}', value, {toponym}.toponym_id "
+        f'FROM {source}json_each({token_array(f"{toponym}.{field}")})'
+        for field in token_fields)
+
+
+# toponym_gram - the distinct characters of the names and asciinames of the
+# toponyms, n being the number of times the character is in the name, and
+# length the length of the name. The matcher looks up the names of similar
+# lengths sharing the rarest characters of a name through the primary key.
+toponym_gram_table = 'CREATE TABLE IF NOT EXISTS toponym_gram '\
+                     '(field text not NULL, '\
+                     'gram text not NULL, '\
+                     'n INTEGER not NULL, '\
+                     'length INTEGER not NULL, '\
+                     'toponym_id INTEGER not NULL, '\
+                     'primary key (field, gram, length, n, toponym_id)) '\
+                     'WITHOUT ROWID'
+
+# The columns of the toponyms with characters in toponym_gram
+gram_fields = ('name', 'asciiname')
+
+# The asciinames equal to the names, most of them, are only posted as names
+gram_shared = {'asciiname': 'name'}
+
+# The numbers from 1 to numbers_max, to split the names into characters,
+# which are only added to toponym_gram for as many characters.
+numbers_max = 1000
+
+
+def create_numbers(conn):
+    """Creates and fills the numbers table"""
+    conn.execute('CREATE TABLE IF NOT EXISTS numbers (k INTEGER primary key)')
+    conn.execute('WITH RECURSIVE counter (k) AS (SELECT 1 UNION ALL '
+                 f'SELECT k + 1 FROM counter WHERE k < {numbers_max}) '
+                 'INSERT OR IGNORE INTO numbers (k) SELECT k FROM counter')
+
+
+def gram_rows(toponym):
+    """SQL selecting the characters of toponym, like token_rows"""
+    source = 'toponym, ' if toponym == 'toponym' else ''
+    selects = []
+    for field in gram_fields:
+        where = f'k <= length({toponym}.{field})'
+        if field in gram_shared:
+            where += f' AND {toponym}.{field} != '\
+                     f'{toponym}.{gram_shared[field]}'
+        selects.append(
+            f"SELECT '{field}', gram, count(*), length, toponym_id "
+            f'FROM (SELECT {toponym}.toponym_id AS toponym_id, '
+            f'substr({toponym}.{field}, k, 1) AS gram, '
+            f'length({toponym}.{field}) AS length FROM {source}numbers '
+            f'WHERE {where}) GROUP BY toponym_id, gram')
+    return ' UNION ALL '.join(selects)
+
+
+# The postings of the toponyms, by table: the SQL creating the table, the
+# columns of the toponyms they are made from and the SQL selecting them.
+postings = {'toponym_token': (toponym_token_table, token_fields, token_rows),
+            'toponym_gram': (toponym_gram_table, gram_fields, gram_rows)}
+
+
+def fill_postings(conn, table):
+    """Fills the postings of all the toponyms in a table anew
+
+    Used when the postings were not kept up to date by the triggers, e.g.
+    when seeding in bulk.
+    """
+    _, _, rows = postings[table]
+    conn.execute(f'DELETE FROM {table}')
+    conn.execute(f'INSERT OR IGNORE INTO {table} {rows("toponym")}')
+
+
+def create_posting_triggers(conn):
+    """Creates the triggers keeping the postings up to date
+
+    The postings follow the toponyms as they are added, renamed and deleted,
+    the trigger adding them is named add_<table>s.
+    """
+    for table, (_, fields, rows) in postings.items():
+        delete = f'delete from {table} where toponym_id == old.toponym_id'
+        conn.execute('CREATE TRIGGER IF NOT EXISTS '
+                     f'add_{table}s after insert on toponym '
+                     f'begin INSERT OR IGNORE INTO {table} {rows("new")}; '
+                     'end;')
+        conn.execute('CREATE TRIGGER IF NOT EXISTS '
+                     f'update_{table}s after update of {", ".join(fields)} '
+                     f'on toponym begin {delete}; '
+                     f'INSERT OR IGNORE INTO {table} {rows("new")}; end;')
+        conn.execute('CREATE TRIGGER IF NOT EXISTS '
+                     f'delete_{table}s after delete on toponym '
+                     f'begin {delete}; end;')
+
 
 def create_tables():
     '''
@@ -10,7 +462,7 @@ def create_tables():
     creates and configures the database at the intended location.
 
     '''
-    conn = sqlite3.connect(settings.database_path)
+    conn = get_connection()
     # 6 chars should be enough to create unique enough names for quick
     # AND intuitive identification of the various sources ...
     # there are not that many sources after all
@@ -31,7 +483,7 @@ def create_tables():
     # the toponym table contains all the available toponyms!
     conn.execute('CREATE TABLE IF NOT EXISTS toponym '
                  '(toponym_id integer primary key, '
-                 'position_fk, '
+                 'position_fk INTEGER, '
                  'source_fk char(6) not null, '
                  'name not null, '
                  'asciiname not null, '
@@ -41,29 +493,40 @@ def create_tables():
                  'asciitokens, '
                  'comment text, '
                  'toponym_created_date datetime, '
-                 'toponym_edited datetime '
+                 'toponym_edited datetime, '
+                 'match_state, '
+                 'geonames_alt_id INTEGER '
                  ')')
-    # position key will probably not be set, I will need int for GeoNames,
-    # perhaps using the negative GeoNames ID for "main" name.
-    # And I want to leave the possibility open for importing WikiData positions
+    # position_fk refers to the integer position_id, not the external_id.
+    # match_state is NULL for seeded toponyms, for added toponyms it is one of:
+    # unmatched - waiting for the matcher
+    # auto-single - connected by the matcher to the only match found
+    # multiple - waiting for the suggestions to be disambiguated
+    # disambiguated - connected to one of the suggestions in the app
+    # foreign - declared irrelevant, connected to the dummy position 0
+    # manual - connected to a position given on upload or made in the app
+    # recheck - connected, but the position has since changed in GeoNames
+    # geonames_alt_id is the alternateNameId of names from GeoNames.
 
     conn.execute('CREATE TRIGGER IF  NOT EXISTS '
                  'set_toponym_edit after update on toponym '
                  'begin update toponym set toponym_edited = datetime("now") '
                  'where toponym_id == old.toponym_id; end;')
 
-    # position - pk is open for the same reson toponym key is
-    conn.execute('CREATE TABLE IF NOT EXISTS position '
-                 '(position_id primary key, '
-                 'source_fk not NULL, latitude REAL not NULL, '
-                 'longitude REAL not NULL, '
-                 # 'abandoned bool, '
-                 # 'parent_name not null, '
-                 'parent_fk not null, '
+    create_numbers(conn)
+    for create_table, _, _ in postings.values():
+        conn.execute(create_table)
+    create_posting_triggers(conn)
+
+    # The append-only history of the matching of each toponym
+    conn.execute('CREATE TABLE IF NOT EXISTS toponym_event '
+                 '(event_id integer primary key, '
+                 'toponym_fk INTEGER not null, '
+                 'match_state, '
                  'comment text, '
-                 'position_created datetime not null, '
-                 'position_edited datetime '
-                 ')')
+                 'event_created datetime not null)')
+
+    conn.execute(position_table)
 # TODO : Geonames : feature class and name.
 # Parent name is taken either from GeoNames or WikiData, so their id fields type need to remain open ended.  # noqa: E501
 
@@ -75,15 +538,16 @@ def create_tables():
     # The suggestions table
     conn.execute('CREATE TABLE IF NOT EXISTS suggestion '
                  '(added_toponym_fk, '
-                 'stable_toponym_fk, comment text, outcome bool)')
+                 'stable_toponym_fk, comment text, outcome bool, score REAL)')
     # keeping track of the outcome in a bool:
     # null means not investigated
     # true means accepted match,
     # FALSE means denied match -- keeping track of this prevents adding the
     #  same pairs again.
+    # score - how strong the match is, only the strongest is kept per pair
     conn.execute('CREATE TABLE IF NOT EXISTS nemo '
                  '(added_toponym_fk, '
-                 'stable_toponym_fk, comment text, outcome bool)')
+                 'stable_toponym_fk, comment text, outcome bool, score REAL)')
 
     # The admin regions table
     conn.execute('CREATE TABLE IF NOT EXISTS parent_region '
@@ -91,9 +555,42 @@ def create_tables():
                  'name text)'
                  )
 
-    # WikiData bookkeeping
+    # WikiData bookkeeping, processed is NULL for the titles whose WikiData
+    # item is still to be looked up
     conn.execute('CREATE TABLE IF NOT EXISTS wiki_queue '
-                 ''
-                 '(wiki_id , position_fk, source_fk, title, processed)')
+                 '(wiki_id , position_fk INTEGER, source_fk, title, '
+                 'processed)')
+
+    # Seeding checkpoints, one row per stage
+    # rows - the number of rows of the input file already committed
+    # completed - TRUE once the whole stage is committed
+    conn.execute('CREATE TABLE IF NOT EXISTS seed_progress '
+                 '(stage text primary key, '
+                 'rows INTEGER not null default 0, '
+                 'completed bool not null default FALSE, '
+                 'progress_edited datetime)')
+
+    create_indexes(conn)
 
     conn.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Brings the database from the settings file up to date '
+                    'with the current schema.')
+    parser.add_argument('-m', '--maintenance', action='store_true',
+                        help='Also refresh the query planner statistics and '
+                        'release unused pages, e.g. after large changes.')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='Rebuild the whole database during the '
+                        'maintenance, slow for large databases.')
+
+    args = parser.parse_args()
+
+    migrate()
+    print('Database schema is up to date.')
+
+    if args.maintenance or args.vacuum:
+        maintain(vacuum=args.vacuum)
+        print('Maintenance done.')
@@ -2,13 +2,22 @@
 
 from Levenshtein import hamming
 from Levenshtein import jaro
+import heapq
+import json
+import math
 import sqlite3
 
 from operations import execute
+from operations import iterate
 from operations import connect_toponym
+from operations import log_event
 from operations import merge_suggestions
+from initiate_schema import gram_shared
+from initiate_schema import name_halves
+from initiate_schema import numbers_max
 
 from collections.abc import Iterable
+from collections import Counter
 from collections import namedtuple
 
 import logging
@@ -23,6 +32,82 @@ ToponymTuple = namedtuple('ToponymTuple',
                            'asciitokens', 'pattern', 'language',
                            'position_fk'])
 
+# The strength of the suggestions from each matcher, by the start of their
+# messages, as each matcher is looser than the ones before it.
+matcher_scores = {'perfect': 5, 'pattern': 4, 'hamming1': 3, 'jairo9': 2,
+                  'all_in_one': 1}
+
+# The similarity of the names suggested by jairo9
+jaro_level = 0.9
+
+# The characters of this many names are counted, to find the rarest
+# characters of the names looked up in toponym_gram.
+gram_sample_size = 20000
+gram_counts = None
+
+
+def gram_keys(name):
+    """The characters of a name, as (character, repeat)
+
+    The toponym_gram row of a character with a count of n stands for its
+    keys with repeats 1 to n.
+    """
+    seen = Counter()
+    keys = []
+    for char in name:
+        seen[char] += 1
+        keys.append((char, seen[char]))
+    return keys
+
+
+def gram_blocking(length, level=jaro_level):
+    """Limits the names which can be within jaro level of a name
+
+    The m matching characters of two names within jaro level of each other
+    make for m / length + m / other_length >= 3 * level - 1.
+
+    Takes:
+        length - int, the length of the name
+        level - float, the lowest jaro similarity
+
+    Returns:
+        (shortest, longest, shared) - the range of the lengths of the names
+            which can match, and the fewest characters, counting repeats,
+            they share with the name. None when names sharing no character
+            could match, or when the names can be longer than numbers_max.
+    """
+    bound = 3 * level - 1
+    if bound <= 1:
+        return None
+    lengths = {}
+    for other in range(1, int(length / (bound - 1)) + 2):
+        # Rounding down the errors of the floats, to stay on the safe side
+        shared = math.ceil(bound * length * other / (length + other) - 1e-9)
+        if shared <= min(length, other):
+            lengths[other] = shared
+
+    if len(lengths) == 0 or min(lengths.values()) < 1 or \
+            max(lengths) > numbers_max:
+        return None
+    return min(lengths), max(lengths), min(lengths.values())
+
+
+def gram_frequencies():
+    """Counts the characters of a sample of the names, once per process
+
+    The counts only decide which characters are looked up first, they do
+    not have to keep up with the toponyms.
+    """
+    global gram_counts
+    if gram_counts is None:
+        counts = Counter()
+        for name, asciiname in execute('select name, asciiname from toponym '
+                                       'limit :n', {'n': gram_sample_size}):
+            counts.update(gram_keys(name))
+            counts.update(gram_keys(asciiname))
+        gram_counts = counts
+    return gram_counts
+
 
 # later: homogenize the use of target, target_id, new_toponym etc.
 class matcher():
@@ -46,8 +131,9 @@ class matcher():
         database.
 
         Whenever a toponym is automatically resolved, or multiple suggestions
-        are found, a short short message is left in the relevant comment field
-        to explain the level and (when relevant) the strength of the pairing.
+        are found, its match_state is updated and a short short message is
+        left in its history to explain the level and (when relevant) the
+        strength of the pairing.
 
 
             perfect_suggestions - searches for perfect matches across the name
@@ -62,20 +148,25 @@ class matcher():
             distance_matcher - Calulates the distance fromt he toponym to each
                 of the viable options and returns suggestions only if the
                 distance/similarity measure is below/above a preset limit.
+                The options are limited to the names of the same length
+                sharing a half with the toponym for Hamming, and to the
+                names of similar length sharing enough characters with it,
+                through the toponym_gram table, for Jaro. Neither can leave
+                out any match.
                 Hamming - 1 (one characted difference for equally long strings)
                 Jaro - 0.9, ~90% similarity. This very high level makes sure
                     that the suggestions are not cluttered and when it does
                     match something it is a very high chance that it is the
                     best available option.
                 all_in_one - checks if either toponym's tokens can all be found
-                    among the other's tokens.
+                    among the other's tokens. The candidates are found through
+                    the toponym_token postings rather than by a full scan.
 
         # later: improve docstring
         """
 
         unmatched_query = 'select toponym_id, language from toponym where '\
-                          'position_fk is null and comment not like '\
-                          ' "multiple_%" '
+                          'match_state == "unmatched" '
         if source is not None:
             unmatched_query += f' and source_fk == "{source}" '
 
@@ -83,14 +174,35 @@ class matcher():
         self.execute = execute_function
         self.toponym_fields = ', '.join(fld for fld in ToponymTuple._fields)
 
-
+        # The positioned toponyms from other sources, which have not been
+        # rejected for the new toponym.
+        self.options_query = f'select {self.toponym_fields} from toponym '\
+                             'where position_fk is not null and '\
+                             'toponym_id not in ( '\
+                             'select stable_toponym_fk from suggestion where '\
+                             'added_toponym_fk == :new_toponym and '\
+                             'outcome == FALSE ) '\
+                             ' and toponym_id not in ( '\
+                             'select stable_toponym_fk from nemo where '\
+                             'added_toponym_fk == :new_toponym and '\
+                             'outcome == FALSE ) '\
+                             'and source_fk not in ( '\
+                             'select source_fk from toponym where '\
+                             'toponym_id == :new_toponym) '
+
+        # Repeated pairs only keep the strongest suggestion, and rejected
+        # pairs are left as they are.
         self.suggest_query = 'insert into suggestion '\
-                        '(added_toponym_fk, stable_toponym_fk, comment) '\
-                        'values (?, ?, ?)'
-        self.mark_query = 'update toponym set comment = :comment || " \n " || '\
-                     'comment where toponym_id == :toponym_id'
-
-
+                             '(added_toponym_fk, stable_toponym_fk, '\
+                             'comment, score) values (?, ?, ?, ?) '\
+                             'on conflict (added_toponym_fk, '\
+                             'stable_toponym_fk) do update set '\
+                             'comment = excluded.comment, '\
+                             'score = excluded.score '\
+                             'where outcome is not FALSE '\
+                             'and ifnull(score, -1) < excluded.score'
+        # The match_state of toponyms given suggestions
+        self.suggest_state = 'multiple'
 
     def format_languages(func):
         """Decorator to make sure that any supplied languages are formatted"""
@@ -123,25 +235,127 @@ class matcher():
             new_toponym - toponym_id for the toponym seeking geolocating
 
         Returns:
-            A list of all viable candidates as ToponymTuple (NamedTuple)
+            A generator of all viable candidates as ToponymTuple (NamedTuple),
+            read from the database as they are consumed.
         """
 
-        query = f'select {self.toponym_fields} from toponym where '\
-                'position_fk is not null and '\
-                'toponym_id not in ( '\
-                'select stable_toponym_fk from suggestion where '\
-                'added_toponym_fk == :new_toponym and outcome == FALSE ) '\
-                ' and toponym_id not in ( '\
-                'select stable_toponym_fk from nemo where '\
-                'added_toponym_fk == :new_toponym and outcome == FALSE ) '\
-                'and source_fk not in ( '\
-                'select source_fk from toponym where '\
-                'toponym_id == :new_toponym) '
+        query = self.options_query
+        if len(languages) > 0:
+            query += languages
+
+        return (ToponymTuple(*toponym) for toponym in iterate(
+            query, values={'new_toponym': new_toponym}, name='get_options'))
+
+    @format_languages
+    def hamming_options(self, new_toponym, field, name, languages=''):
+        """Queries the options of the same length sharing a half of a name
+
+        Names a hamming distance of 1 apart differ in a single character, so
+        either their first or their second halves are the same, which makes
+        for two lookups in the toponym_<field>_head and _tail indexes.
+
+        Takes:
+            new_toponym - toponym_id for the toponym seeking geolocating
+            field - 'name' or 'asciiname'
+            name - the name or asciiname of the new toponym
+
+        Returns:
+            A list of the candidates as ToponymTuple
+        """
+        head, tail = (half.format(field) for half in name_halves)
+        query = self.options_query + \
+            'and toponym_id in ( '\
+            f'select toponym_id from toponym where length({field}) == '\
+            f':length and {head} == :head union all '\
+            f'select toponym_id from toponym where length({field}) == '\
+            f':length and {tail} == :tail) '
+        if len(languages) > 0:
+            query += languages
+
+        half = len(name) // 2
+        return [ToponymTuple(*toponym) for toponym in self.execute(
+            query, values={'new_toponym': new_toponym, 'length': len(name),
+                           'head': name[:half], 'tail': name[half:]},
+            status='hamming_options')]
+
+    @format_languages
+    def gram_options(self, new_toponym, field, name, languages=''):
+        """Queries toponym_gram for the options that can be close to a name
+
+        Any name within jaro_level of the name has one of its
+        len(name) - shared + 1 rarest characters, counting repeats, since
+        they share at least shared characters. A name has the repeat k of a
+        character when it has the character at least k times, so only the
+        lowest repeat of each character is looked up.
+
+        Takes:
+            new_toponym - toponym_id for the toponym seeking geolocating
+            field - 'name' or 'asciiname'
+            name - the name or asciiname of the new toponym
+
+        Returns:
+            A list of the candidates as ToponymTuple, or None when the name
+            is too short, or too long, to limit the options.
+        """
+        blocking = gram_blocking(len(name))
+        if blocking is None:
+            return None
+        shortest, longest, shared = blocking
+        counts = gram_frequencies()
+        ranked = sorted(gram_keys(name), key=lambda key: counts[key])
+        keys = {}
+        for char, repeat in ranked[:len(name) - shared + 1]:
+            keys[char] = min(repeat, keys.get(char, repeat))
+        # CROSS JOIN keeps the keys outermost, even without statistics
+        query = self.options_query + \
+            'and toponym_id in ( '\
+            'select posting.toponym_id from json_each(:keys) as key '\
+            'cross join toponym_gram as posting '\
+            'on posting.field in (:field, :shared_field) '\
+            'and posting.gram == key.key '\
+            'and posting.length between :shortest and :longest '\
+            'and posting.n >= key.value) '
         if len(languages) > 0:
             query += languages
 
-        return set(ToponymTuple(*toponym) for toponym in self.execute(
-            query, values={'new_toponym': new_toponym}))
+        return [ToponymTuple(*toponym) for toponym in self.execute(
+            query, values={'new_toponym': new_toponym, 'field': field,
+                           'shared_field': gram_shared.get(field, field),
+                           'keys': json.dumps(keys),
+                           'shortest': shortest, 'longest': longest},
+            status='gram_options')]
+
+    @format_languages
+    def token_options(self, new_toponym, field, tokens, languages=''):
+        """Queries the postings for the options sharing all their tokens
+
+        Takes:
+            new_toponym - toponym_id for the toponym seeking geolocating
+            field - 'tokens' or 'asciitokens'
+            tokens - the space separated tokens of the new toponym
+
+        Returns:
+            A list of the viable candidates as ToponymTuple, whose tokens
+            include all the tokens given, or are all among them.
+        """
+        tokens = set(tokens.split())
+        query = self.options_query + \
+            'and toponym_id in ( '\
+            'select toponym_id from toponym_token as posting '\
+            'where field == :field and token in ( '\
+            'select value from json_each(:tokens)) '\
+            'group by toponym_id having count(*) == :n_tokens '\
+            'or count(*) == ( select count(*) from toponym_token '\
+            'where field == :field and '\
+            'toponym_id == posting.toponym_id)) '
+        if len(languages) > 0:
+            query += languages
+
+        return [ToponymTuple(*toponym) for toponym in self.execute(
+            query, values={'new_toponym': new_toponym, 'field': field,
+                           'tokens': json.dumps(sorted(tokens)),
+                           'n_tokens': len(tokens)},
+            status='token_options')]
 
     @format_languages
     def perfect_matches(self, target_id, target, target_field='name',
@@ -195,12 +409,15 @@ class matcher():
         else:
             return ToponymTuple(*_[0])
 
-    def suggest_toponyms(self, toponym_id, suggestions, comment, suggest=False):
+    def suggest_toponyms(self, toponym_id, suggestions, comment, suggest=False,
+                         score=None):
         """
         Takes:
             toponym_id
             suggestions - a set of suggested position_fk
             comment - str
+            score - the strength of the suggestions, if None the third value
+                of each suggestion is used as its score
 
         Inserts a row in to the suggestion table for each suggestion:
             toponym_id as new_toponym_fk
@@ -218,14 +435,14 @@ class matcher():
 
         # adding suggestions first:
         suggestions = [
-            (toponym_id, stable_toponym_fk, ' '.join((comment, str(outcome)))
+            (toponym_id, stable_toponym_fk, ' '.join((comment, str(outcome))),
+             outcome if score is None else score
              ) for stable_toponym_fk, postition_fk, outcome in suggestions]
 
         execute(self.suggest_query, values=suggestions, many=True)
 
         # Marking the added toponym with "multiple"
-        execute(self.mark_query, values={'comment': comment+' \n ',
-                'toponym_id': toponym_id})
+        log_event(toponym_id, comment, self.suggest_state)
 
         if not suggest:
             merge_message = merge_suggestions(target_id=toponym_id)
@@ -258,9 +475,11 @@ class matcher():
                 return 1, message
             elif len(matches) > 1 or suggest:
                 comment = f'multiple_{message}'
+                score = next((score for prefix, score in matcher_scores.items()
+                              if message.startswith(prefix)), 0)
                 message += ' - ' + self.suggest_toponyms(target_row.toponym_id,
                                                          matches, comment,
-                                                         suggest)
+                                                         suggest, score)
 
                 return len(matches), message
         return matcher_wrapper
@@ -336,7 +555,7 @@ class matcher():
 
     def jairo9(self, target, option):
         """Distance measure for jaro 0.9"""
-        return self.jairo_measure(target, option, level=0.9)
+        return self.jairo_measure(target, option, level=jaro_level)
 
     def all_in_one(self, target, option):
         """Checks if all tokens of one string are in the other, or vice versa"""
@@ -356,28 +575,85 @@ class matcher():
     def distance_matcher(self, target_row, options=None,
                          functions=(hamming1, jairo9, all_in_one)):
         """Matching function that progresses through the distance measures"""
+        return self.distance_matches(target_row, options, functions)
 
-        if options is None:
-            options = self.get_options(target_row.toponym_id,
-                                       languages=target_row.language)
+    def distance_matches(self, target_row, options=None,
+                         functions=(hamming1, jairo9, all_in_one)):
+        """Finds the matches of the first distance measure with any matches
+
+        The options are only read once, each option is compared using the
+        measures in order, but only as far as the first measure that has
+        matched any of the options so far, since the later measures can no
+        longer be used. The matches from the first measure with any matches
+        are returned.
+
+        Unless the options are given, the measures are only checked against
+        the options found through the indexes: the halves of the names for
+        hamming1, toponym_gram for jairo9, for names long enough, and
+        toponym_token for all_in_one. Each is only queried once the measures
+        before it have found nothing.
 
+        Returns:
+            set of suggestions
+            result message
+        """
+
+        stages = []
         for func in functions:
             if func.__name__ == 'all_in_one':
                 fields = ['tokens', 'asciitokens']
             else:
                 fields = ['name', 'asciiname']
             for field in fields:
-                idx = ToponymTuple._fields.index(field)
-                matches = []
-                for option in options:
+                stages.append((func, ToponymTuple._fields.index(field)))
+
+        # The stages checked against the indexes, with the lookup of their
+        # candidates.
+        indexed = {}
+        if options is None:
+            for stage, (func, idx) in enumerate(stages):
+                field = ToponymTuple._fields[idx]
+                if func.__name__ == 'all_in_one':
+                    indexed[stage] = (self.token_options, field)
+                elif func.__name__ == 'hamming1':
+                    indexed[stage] = (self.hamming_options, field)
+                elif func.__name__ == 'jairo9' and \
+                        gram_blocking(len(target_row[idx])) is not None:
+                    indexed[stage] = (self.gram_options, field)
+            options = self.get_options(target_row.toponym_id,
+                                       languages=target_row.language) \
+                if len(indexed) < len(stages) else ()
+
+        stage_matches = [[] for _ in stages]
+        last_stage = len(stages)
+        for option in options:
+            for stage, (func, idx) in enumerate(stages[:last_stage]):
+                if stage in indexed:
+                    continue
+                usable, score = func(self, target_row[idx], option[idx])
+                if usable:
+                    stage_matches[stage].append(
+                        (option.toponym_id, option.position_fk,
+                         f'{target_row[idx]} ={score}= {option[idx]}')
+                        )
+                    last_stage = stage + 1
+                    break
+
+        for stage, ((func, idx), matches) in enumerate(zip(stages,
+                                                           stage_matches)):
+            if stage in indexed:
+                lookup, field = indexed[stage]
+                for option in lookup(target_row.toponym_id, field,
+                                     target_row[idx],
+                                     languages=target_row.language):
                     usable, score = func(self, target_row[idx], option[idx])
                     if usable:
                         matches.append(
                             (option.toponym_id, option.position_fk,
                              f'{target_row[idx]} ={score}= {option[idx]}')
                             )
-                if len(matches) > 0:
-                    return set(matches), f'{func.__name__}_match'
+            if len(matches) > 0:
+                return set(matches), f'{func.__name__}_match'
         return set(), 'No distance matches found'
 
     def jairo6(self, target, option):
@@ -388,8 +664,8 @@ class matcher():
     def distance_suggester(self, target_row, options=None):
         """Suggests matches based on the jaro6 distance -- not implemented"""
         if options is None:
-            options = self.get_options(target_row.toponym_id,
-                                       languages=target_row.language)
+            options = list(self.get_options(target_row.toponym_id,
+                                            languages=target_row.language))
 
         fields = ['name', 'asciiname', 'pattern', 'tokens',
                           'asciitokens']
@@ -459,6 +735,8 @@ class Nemo(matcher):
         self.query = 'select toponym_id from toponym where '\
                      'position_fk is null limit 30'
         self.suggest_query = self.suggest_query.replace('suggestion', 'nemo')
+        # Nemo suggestions leave the toponym to the matcher
+        self.suggest_state = None
 
     def top_10(self, *toponyms):
 
@@ -479,17 +757,14 @@ class Nemo(matcher):
 
             name = self.execute('select name from toponym where toponym_id == :toponym_id', values={'toponym_id': toponym_id})[0][0]
 
-            contenders = []
-            for candidate in self.get_options(toponym_id, languages=''):
-                contenders.append((
-                    self.jairo_measure(name, candidate.name, 0)[1],
-                    candidate.toponym_id, candidate.position_fk))
-
-            # print(toponym_id, len(contenders))
+            # Only the ten best candidates are kept in memory.
+            contenders = heapq.nlargest(10, (
+                (self.jairo_measure(name, candidate.name, 0)[1],
+                 candidate.toponym_id, candidate.position_fk)
+                for candidate in self.get_options(toponym_id, languages='')))
 
             contenders = [(toponym, position, score)
-                          for score, toponym, position in sorted(
-                            contenders, reverse=True)[:10]]
+                          for score, toponym, position in contenders]
 
             self.suggest_toponyms(toponym_id, contenders, 'Nemo_')
 
@@ -1,29 +1,385 @@
 # rewrite this as a class?
 from settings import settings
+import atexit
 import logging
+import os
+import queue
 import sqlite3
 from anyascii import anyascii
-from stopwords import get_stopwords
 import re
-import inspect
-from wiki_operations import get_wiki_names
-from time import sleep
-
-# some globals
-stops = set()
-for lang in settings.languages:
-    stops |= set(get_stopwords(lang))
+import sys
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from collections import defaultdict
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from contextlib import nullcontext
+from functools import lru_cache
+from time import perf_counter
+
+# The stopwords of each tuple of languages, loaded by get_stops on first use
+stops = {}
+
+
+def get_stops():
+    """The stopwords of all the languages from the settings, as a set"""
+    languages = tuple(settings.languages)
+    if languages not in stops:
+        from stopwords import get_stopwords
+
+        words = set()
+        for lang in languages:
+            words |= set(get_stopwords(lang))
+        stops[languages] = words
+    return stops[languages]
 
 
 # Enable the logging of queries.
 sqlite3.enable_callback_tracebacks(True)
 
+# sqlite3 connections cannot be shared between threads, so each thread keeps
+# its own long-lived connections, which are reused for all of its queries:
+# one for execute and transactions, and one for streaming with iterate.
+_local = threading.local()
+
+# The settings of the storage profiles, in the order they are applied.
+# page_size and auto_vacuum have to come before the switch to WAL mode.
+storage_pragmas = ('page_size', 'auto_vacuum', 'journal_mode', 'synchronous',
+                   'cache_size', 'mmap_size', 'temp_store')
+
+
+def apply_profile(conn, profile=None):
+    """Applies the SQLite settings of a storage profile to a connection
+
+    Takes:
+        conn - sqlite3.Connection
+        profile - str, the name of one of settings.storage_profiles, defaults
+            to settings.storage_profile
+    """
+    if profile is None:
+        profile = settings.storage_profile
+    if profile not in settings.storage_profiles:
+        raise ValueError(f'Unknown storage profile: {profile}')
+
+    pragmas = settings.storage_profiles[profile]
+    for pragma in storage_pragmas:
+        if pragma in pragmas:
+            conn.execute(f'PRAGMA {pragma} = {pragmas[pragma]}')
+
+
+def connect(path=None, profile=None):
+    """Opens a new connection to the database and configures it
+
+    Takes:
+        path - str, defaults to the database_path from the settings
+        profile - str, the storage profile to apply, defaults to the
+            storage_profile from the settings
+
+    The per-connection pragmas are applied here, once, rather than for
+    every query.
+
+    Returns:
+        sqlite3.Connection
+    """
+    if path is None:
+        path = settings.database_path
+    conn = sqlite3.connect(path, timeout=30, cached_statements=256)
+    # For debugging queries
+    conn.set_trace_callback(logging.debug)
+    apply_profile(conn, profile)
+    return conn
+
+
+def thread_connection(kind):
+    """Returns the calling thread's connection of a kind, connecting if needed
+
+    The connection is replaced when the database_path or storage_profile in
+    the settings have changed since it was made.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    made_for = (settings.database_path, settings.storage_profile)
+    conn, conn_made_for = connections.get(kind, (None, None))
+    if conn is None or conn_made_for != made_for:
+        if conn is not None:
+            conn.close()
+        conn = connect()
+        connections[kind] = (conn, made_for)
+    return conn
+
+
+def get_connection():
+    """Returns the calling thread's connection, connecting if necessary"""
+    return thread_connection('conn')
+
+
+def get_reader():
+    """Returns the calling thread's connection for iterate
+
+    It is only used for reading, so the rows are read outside any
+    transaction open on the connection of get_connection.
+    """
+    return thread_connection('reader')
+
+
+def close_connection():
+    """Closes the calling thread's connections, if it has any"""
+    for conn, _ in getattr(_local, 'connections', {}).values():
+        conn.close()
+    _local.connections = {}
+    _local.depth = 0
+
+
+@contextmanager
+def transaction():
+    """Groups the queries executed within it into a single transaction
+
+    All the queries run through execute on the calling thread, within the
+    with-block, share its connection and are committed once at the end, or
+    rolled back together if any of them fails. Nested transactions are
+    merged into the outermost one.
+
+    Yields:
+        sqlite3.Connection
+    """
+    conn = get_connection()
+    depth = getattr(_local, 'depth', 0)
+    _local.depth = depth + 1
+    try:
+        if depth > 0:
+            yield conn
+        else:
+            with conn:
+                # Taking the write lock up front, rather than upgrading a
+                # read lock half way through, which would fail if another
+                # connection got there first.
+                conn.execute('BEGIN IMMEDIATE')
+                yield conn
+    finally:
+        _local.depth = depth
+
+
+class QueryStats():
+    """Counters and a latency histogram for a single named statement"""
+
+    # Upper bounds of the latency buckets in seconds, doubling from 10us.
+    buckets = tuple(1e-5 * 2 ** i for i in range(22))
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+        self.histogram = [0] * (len(self.buckets) + 1)
+
+    def record(self, seconds, rows):
+        """Adds a single execution to the counters"""
+        self.count += 1
+        self.total += seconds
+        self.rows += rows
+        self.histogram[bisect_left(self.buckets, seconds)] += 1
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the fraction of executions"""
+        target = fraction * self.count
+        seen = 0
+        for bound, n in zip(self.buckets + (float('inf'), ), self.histogram):
+            seen += n
+            if seen >= target:
+                return bound
+
+    def as_dict(self):
+        """Summarises the counters"""
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.total / self.count if self.count else 0,
+                'p50': self.percentile(0.5),
+                'p99': self.percentile(0.99),
+                'rows': self.rows}
+
+
+# Statistics for each statement name, shared by all threads.
+query_stats = defaultdict(QueryStats)
+_stats_lock = threading.Lock()
+
+
+def dump_query_stats(reset=False):
+    """Returns the per-statement statistics, the most time consuming first
+
+    Takes:
+        reset - bool, whether to start counting afresh afterwards
+
+    Returns:
+        List of dicts with the statement name, count, total and mean time,
+        the p50 and p99 latency bucket and the number of rows returned.
+    """
+    with _stats_lock:
+        stats = [dict(name=name, **stat.as_dict()) for name, stat in
+                 query_stats.items()]
+        if reset:
+            query_stats.clear()
+    return sorted(stats, key=lambda stat: stat['total'], reverse=True)
+
+
+# All writes made outside of a transaction() are funnelled through a single
+# writer thread, which commits whatever has queued up in one transaction.
+# This spares the threads from competing for the database lock, and the
+# disk from a sync for every statement.
+write_statements = ('insert', 'update', 'delete', 'replace', 'create',
+                    'drop', 'alter', 'analyze', 'vacuum', 'reindex', 'pragma')
+# The statements SQLite cannot run within a transaction, which the writer
+# runs on their own
+transactionless_statements = ('vacuum', )
+# The statements a WITH query can end in
+with_statements = ('select', 'values', 'insert', 'update', 'delete',
+                   'replace')
+# The pragmas which write without setting a value
+write_pragmas = {'optimize', 'incremental_vacuum', 'wal_checkpoint'}
+max_write_group = 500
+_write_queue = queue.Queue()
+_writer = None
+_writer_lock = threading.Lock()
+
+# Quoted strings and names, comments, parentheses, = and words
+sql_tokens = re.compile(r"""'(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^]]*]"""
+                        r'|--[^\n]*|/\*.*?(?:\*/|$)|[()=]|\w+', re.S)
+
+
+def statement_words(query):
+    """The words of a query, lowercased, and its = signs, outside of
+    parentheses, quotes and comments"""
+    depth = 0
+    for token in sql_tokens.findall(query):
+        if token == '(':
+            depth += 1
+        elif token == ')':
+            depth -= 1
+        elif depth == 0 and (token == '=' or token[0].isalnum()
+                             or token[0] == '_'):
+            yield token.lower()
+
+
+@lru_cache(maxsize=1024)
+def statement_keyword(query):
+    """The keyword of the statement a query makes, e.g. select or insert
+
+    The statement of a WITH query comes after its common table expressions.
+    Pragmas are only a pragma when they set a value, or are one of the
+    write_pragmas, and a select otherwise.
+    """
+    words = statement_words(query)
+    keyword = next(words, '')
+    if keyword == 'with':
+        keyword = next((word for word in words if word in with_statements),
+                       '')
+    elif keyword == 'pragma':
+        words = set(words)
+        if '=' not in words and len(words & write_pragmas) == 0:
+            keyword = 'select'
+    return keyword
+
+
+def is_write(query):
+    """Whether the query modifies the database, judged by its keywords"""
+    return statement_keyword(query) in write_statements
+
+
+def submit_write(query, values=(), status='', many=False, name=None):
+    """Queues a write for the writer thread, starting it when necessary
+
+    Takes the same arguments as execute.
+
+    Returns:
+        concurrent.futures.Future, which resolves to the results of the query
+        once it has been committed, or to the exception it raised.
+    """
+    global _writer
+    future = Future()
+    _write_queue.put((future, query, values, status, many, name))
+
+    if _writer is None or not _writer.is_alive():
+        with _writer_lock:
+            if _writer is None or not _writer.is_alive():
+                _writer = threading.Thread(target=_write_loop,
+                                           name='database_writer',
+                                           daemon=True)
+                _writer.start()
+    return future
+
+
+def flush_writes():
+    """Waits until all the writes queued so far have been committed"""
+    if _writer is not None and _writer.is_alive():
+        # The queue is processed in order, so this is the last to finish. It
+        # has no query, so it is resolved without touching the database.
+        submit_write(None, name='flush_writes').result()
+
+
+atexit.register(flush_writes)
+
+
+def in_transaction(request):
+    """Whether a queued write can be grouped with others in a transaction"""
+    query = request[1]
+    return query is None or \
+        statement_keyword(query) not in transactionless_statements
+
+
+def _write_loop():
+    """The writer thread, committing the queued writes in groups"""
+    request = None
+    while True:
+        group = [request or _write_queue.get()]
+        request = None
+        while len(group) < max_write_group and in_transaction(group[0]):
+            try:
+                request = _write_queue.get_nowait()
+            except queue.Empty:
+                break
+            if not in_transaction(request):
+                # It starts the next group instead
+                break
+            group.append(request)
+            request = None
+        _write_group(group)
+
+
+def _write_group(group):
+    """Executes a group of queued writes in a single transaction
+
+    If any of the writes fails the transaction is rolled back and the writes
+    are retried one at a time, so that only the failing ones fail. A write
+    which cannot run within a transaction comes in a group of its own, and
+    is executed as it is.
+    """
+    writes = [request for request in group if request[1] is not None]
+    try:
+        if len(writes) == 0:
+            results = [None] * len(group)
+        else:
+            with transaction() if in_transaction(group[0]) else \
+                    nullcontext():
+                results = [None if query is None else
+                           execute(query, values, status, many, name)
+                           for _, query, values, status, many, name in group]
+    except Exception as e:
+        if len(group) > 1:
+            for request in group:
+                _write_group([request])
+        else:
+            logging.error(f'Queued write {group[0][1]=} led to {e=}')
+            group[0][0].set_exception(e)
+        return
+
+    for (future, *_), result in zip(group, results):
+        future.set_result(result)
+
 
 # Handling all the processing in one place to enable betterlogging
 # But most importantly, this makes it easier to later change DB type.
-# It started from not being able to use a single connection throughout
-# the server
-def execute(query, values=(), status='', many=False):
+def execute(query, values=(), status='', many=False, name=None, wait=True):
     """Wrapper function for sqlite3 connection
 
     Takes:
@@ -31,23 +387,39 @@ def execute(query, values=(), status='', many=False):
         values - typically dict or tuple
         status - A brief explanation to explain the operation in the log
         many - bool, whether the executemany function should be used
+        name - str, the statement name used for the query statistics,
+            defaults to the name of the calling function
+        wait - bool, whether to wait for a write to be committed, if False
+            the write is queued and its Future is returned instead.
 
-    Connects to the database from the settings, executes the query and
-    logs the process.
+    Executes the query on the calling thread's connection to the database
+    from the settings, records its latency and logs the process.
+    Writes made outside of a transaction are handed to the writer thread.
 
     Returns:
         List of results from select query, None otherwise
     """
 
+    if name is None:
+        # Only looks up the caller's code object, unlike inspect.stack().
+        name = sys._getframe(1).f_code.co_name
+
+    if not getattr(_local, 'depth', 0) and \
+            threading.current_thread() is not _writer and is_write(query):
+        future = submit_write(query, values, status, many, name)
+        if wait:
+            return future.result()
+        return future
+
     if status == '':
-        status = f'Called from: {inspect.stack()[1][1:4]}'
+        status = f'Called from: {name}'
 
     try:
-        # Since the connection cannot be shared between threads, each
-        # query needs its own temporary connection.
-        with sqlite3.connect(settings.database_path) as conn:
-            # For debugging queries
-            conn.set_trace_callback(logging.debug)
+        start = perf_counter()
+        conn = get_connection()
+        # The connection commits on success and rolls back on errors, unless
+        # the query is part of a transaction, which then does it at the end.
+        with nullcontext() if getattr(_local, 'depth', 0) else conn:
             cur = conn.cursor()
             if len(values) == 0:
                 cur.execute(query)
@@ -59,14 +431,11 @@ def execute(query, values=(), status='', many=False):
                 cur.execute(query, values)
             results = cur.fetchall()
 
-        if type(results) is None:
-            results_len = 'None'
-        else:
-            results_len = len(results)
+        results_len = len(results)
+        with _stats_lock:
+            query_stats[name].record(perf_counter() - start, results_len)
 
         status += f' Executed with {results_len=} results'
-        if any(_ in query.lower() for _ in ['insert', 'update', 'delete']):
-            conn.commit()
         return results
     except Exception as e:
         # logging query and error for debugging
@@ -79,13 +448,81 @@ def execute(query, values=(), status='', many=False):
     return
 
 
-def add_toponym_list(names, status='Adding toponyms'):
-    """Adds a list of new toponyms to the toponym table"""
+def iterate(query, values=(), status='', name=None, arraysize=1000,
+            profile=None):
+    """Streaming variant of execute for select queries with large results
+
+    Takes:
+        query - str
+        values - typically dict or tuple
+        status - A brief explanation to explain the operation in the log
+        name - str, the statement name used for the query statistics,
+            defaults to the name of the calling function
+        arraysize - int, the number of rows fetched from the cursor at a time
+        profile - str, the storage profile for the query's connection,
+            defaults to the storage_profile from the settings
+
+    The query runs on the calling thread's reader connection, apart from
+    the one execute uses, so the caller is free to execute other queries in
+    between. Only a profile other than the storage_profile from the
+    settings gets a connection of its own, which is closed once all the rows
+    have been consumed. Note that the rows are read outside any transaction
+    the caller may have open. The recorded latency includes the time spent
+    consuming the rows.
+
+    Yields:
+        The resulting rows, one at a time
+    """
+    if name is None:
+        name = sys._getframe(1).f_code.co_name
+
+    if status == '':
+        status = f'Called from: {name}'
+
+    start = perf_counter()
+    results_len = 0
+    if profile is None or profile == settings.storage_profile:
+        conn, own = get_reader(), False
+    else:
+        conn, own = connect(profile=profile), True
+    cur = conn.cursor()
+    try:
+        cur.arraysize = arraysize
+        cur.execute(query, values)
+        while rows := cur.fetchmany():
+            results_len += len(rows)
+            yield from rows
+    except Exception as e:
+        # logging query and error for debugging
+        logging.debug(f'{query=} led to {e=}')
+        print(f'{query=}, {values=} led to {e=}')
+        raise e
+    finally:
+        cur.close()
+        if own:
+            conn.close()
+        with _stats_lock:
+            query_stats[name].record(perf_counter() - start, results_len)
+        logging.info(f'iterated: {query=} -- {status=} {results_len=}')
+
+
+def add_toponym_list(names, status='Adding toponyms', alt_ids=False):
+    """Adds a list of new toponyms to the toponym table
+
+    Takes:
+        names - list of (position_fk, source_fk, name, asciiname, pattern,
+            tokens, asciitokens, language, comment) tuples
+        status - A brief explanation to explain the operation in the log
+        alt_ids - bool, if True each tuple ends with the GeoNames
+            alternateNameId of the name as well
+    """
+    alt_id = ', geonames_alt_id' if alt_ids else ''
     _ = execute('INSERT into toponym (position_fk, source_fk, name, '
                 'asciiname, pattern, tokens, asciitokens, '
-                ' language, comment, toponym_created_date'
+                ' language, comment' + alt_id + ', toponym_created_date'
                 ') values'
-                '(?, ?, ?, ?, ?, ?, ?, ?, ?, datetime("NOW"))',
+                '(?, ?, ?, ?, ?, ?, ?, ?, ?' + (', ?' if alt_ids else '')
+                + ', datetime("NOW"))',
                 values=names,
                 many=True,
                 status=status)
@@ -103,8 +540,156 @@ def preprocess_toponym(raw_name, asciiname=None):
     return tokens, asciiname, asciitokens, pattern
 
 
+class NameCache():
+    """A bounded cache of the preprocessed names, by their raw name
+
+    The names are kept together with the settings.languages they were
+    preprocessed with, as their stopwords change the tokens, so a change of
+    the languages misses the names cached before it.
+
+    Once it holds size names, settings.name_cache_size by default, the
+    least recently used names are dropped first. The hits and misses are
+    counted, across all the threads sharing the cache.
+    """
+
+    def __init__(self, size=None):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_many(self, raw_names):
+        """Looks up a list of names, counting the repeated ones as hits
+
+        Returns:
+            dict of the cached raw_name: preprocessed name
+        """
+        found = {}
+        languages = tuple(settings.languages)
+        with self.lock:
+            for raw_name in raw_names:
+                key = (languages, raw_name)
+                if raw_name in found:
+                    self.hits += 1
+                elif key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[raw_name] = self.entries[key]
+                    self.hits += 1
+                else:
+                    # the repeats of a missing name are hits of its first one
+                    found[raw_name] = None
+                    self.misses += 1
+        return {raw_name: preprocessed for raw_name, preprocessed in
+                found.items() if preprocessed is not None}
+
+    def put_many(self, items):
+        """Adds (raw_name, preprocessed name) pairs to the cache"""
+        languages = tuple(settings.languages)
+        with self.lock:
+            for raw_name, preprocessed in items:
+                key = (languages, raw_name)
+                self.entries[key] = preprocessed
+                self.entries.move_to_end(key)
+            size = self.size or settings.name_cache_size
+            while len(self.entries) > size:
+                self.entries.popitem(last=False)
+
+    def stats(self, reset=False):
+        """The counters of the cache, and its hit rate"""
+        with self.lock:
+            lookups = self.hits + self.misses
+            stats = {'size': self.size or settings.name_cache_size,
+                     'names': len(self.entries),
+                     'hits': self.hits, 'misses': self.misses,
+                     'hit_rate': self.hits / lookups if lookups else 0}
+            if reset:
+                self.hits = self.misses = 0
+        return stats
+
+    def clear(self):
+        """Empties the cache and resets its counters"""
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+
+# The preprocessed names, shared by seeding, the GUI and the WikiData queue
+name_cache = NameCache()
+
+
+# The processes for preprocess_many, started on first use
+_pool = None
+_pool_key = None
+_pool_lock = threading.Lock()
+# Lists shorter than this are not worth sending to the processes
+preprocess_threshold = 2000
+
+
+def preprocess_workers():
+    """The number of preprocessing processes, from the settings"""
+    if settings.preprocess_workers is None:
+        return os.cpu_count() or 1
+    return max(1, int(settings.preprocess_workers))
+
+
+def _init_preprocess(languages):
+    """Gives a preprocessing process the languages of the one starting it"""
+    settings.languages = list(languages)
+
+
+def get_pool():
+    """Returns the pool of preprocessing processes, starting it if necessary
+
+    The pool is replaced when the number of workers or the languages in the
+    settings have changed since it was started.
+    """
+    global _pool, _pool_key
+    with _pool_lock:
+        key = (preprocess_workers(), tuple(settings.languages))
+        if _pool is None or _pool_key != key:
+            if _pool is not None:
+                _pool.shutdown()
+            _pool_key = key
+            _pool = ProcessPoolExecutor(max_workers=key[0],
+                                        initializer=_init_preprocess,
+                                        initargs=(key[1],))
+            atexit.register(_pool.shutdown)
+        return _pool
+
+
+def preprocess_many(raw_names, chunksize=500):
+    """Precalculates the variants of a list of toponyms, using all cores
+
+    Takes:
+        raw_names - list of str
+        chunksize - int, the number of names sent to a process at a time
+
+    Only the names missing from the name_cache are preprocessed, once each,
+    and added to it. Short lists of them, or a single worker in the
+    settings, are preprocessed in this process instead.
+
+    Returns:
+        A list of (tokens, asciiname, asciitokens, pattern), in the order of
+        the raw_names
+    """
+    found = name_cache.get_many(raw_names)
+    missing = list(dict.fromkeys(raw_name for raw_name in raw_names
+                                 if raw_name not in found))
+
+    if len(missing) < preprocess_threshold or preprocess_workers() == 1:
+        preprocessed = [preprocess_toponym(raw_name) for raw_name in missing]
+    else:
+        preprocessed = list(get_pool().map(preprocess_toponym, missing,
+                                           chunksize=chunksize))
+
+    name_cache.put_many(zip(missing, preprocessed))
+    found.update(zip(missing, preprocessed))
+    return [found[raw_name] for raw_name in raw_names]
+
+
 # generic comment function
-def write_comment(comment, table, field, value):
+def write_comment(comment, table, field, value, wait=True):
     """Generic function for writing to the beginning of comment fields
 
     Takes:
@@ -112,6 +697,7 @@ def write_comment(comment, table, field, value):
         table - name of the table to update
         field - the field to compare the value against
         value - the value to select rows
+        wait - bool, if False the comment is queued without waiting for it
 
     Adds the supplied 'comment' to the beginning of the comment field for the
     matching table, field and value.
@@ -119,7 +705,8 @@ def write_comment(comment, table, field, value):
     _ = execute(f'UPDATE {table} set comment = :comment || " \n " || comment '
                 f'where {field} == :value ',
                 {'comment': comment.strip(),
-                 'value': value})
+                 'value': value},
+                wait=wait)
     return _
 
 
@@ -130,6 +717,7 @@ def tokenize(name):
     tokens = [token.lower() for token in re.findall(r'\w+', name)]
     # Remove stopwords, add commas and join by spaces
     # Sorting them so that seemlingly different names become perfect matches
+    stops = get_stops()
     sorted_tokens = sorted([f',{token},' for token in tokens if
                             token not in stops])
     if len(sorted_tokens) == 0:
@@ -137,24 +725,56 @@ def tokenize(name):
     return ' '.join(sorted_tokens)
 
 
-def connect_toponym(toponym_id, position_fk, comment):
+def log_event(toponym_id, comment, match_state=None):
+    """Records a step in the matching history of a toponym
+
+    Takes:
+        toponym_id
+        comment - str - the human readable explanation of the step
+        match_state - if not None, the new match_state of the toponym
+
+    The event is appended to the toponym_event table, together with the
+    match_state the toponym is left in.
+    """
+    values = {'toponym_id': toponym_id, 'comment': comment.strip(),
+              'match_state': match_state}
+    with transaction():
+        if match_state is not None:
+            execute('update toponym set match_state = :match_state '
+                    'where toponym_id == :toponym_id', values=values)
+        execute('insert into toponym_event (toponym_fk, match_state, '
+                'comment, event_created) select toponym_id, match_state, '
+                ':comment, datetime("now") from toponym '
+                'where toponym_id == :toponym_id', values=values)
+
+
+def toponym_history(toponym_id):
+    """Lists the comments of a toponym's events, the most recent first"""
+    return [comment for (comment, ) in execute(
+        'select comment from toponym_event where toponym_fk == :toponym_id '
+        'order by event_id desc', values={'toponym_id': toponym_id})]
+
+
+def connect_toponym(toponym_id, position_fk, comment,
+                    match_state='auto-single'):
     """
     Takes:
         toponym_id
         position_fk
         comment
+        match_state - how the position was found, 'auto-single' by default
 
     Registers the data in the toponym_id's row:
         Setting its position_fk t0 the input
-        Concatenating the supplied comment with the existing one.
+        Recording the match_state and the comment in its history.
     """
-    query = 'update toponym set position_fk = :position_fk, '\
-            'comment = :comment || " \n " || comment '\
+    query = 'update toponym set position_fk = :position_fk '\
             'where toponym_id == :toponym_id'
-    values = {'position_fk': position_fk, 'comment': comment,
-              'toponym_id': toponym_id}
+    values = {'position_fk': position_fk, 'toponym_id': toponym_id}
     status = f'Connecting {toponym_id=} to {position_fk=}'
-    return execute(query, values=values, status=status)
+    with transaction():
+        execute(query, values=values, status=status)
+        log_event(toponym_id, comment, match_state)
 
 
 def find_mappable_suggestions(target_id=None):
@@ -199,78 +819,130 @@ def merge_suggestions(target_id=None):
         return comment
 
 
-def resolve_wiki_queue(n_rows=settings.wiki_rows):
+# The most rows of the WikiData queue resolved in a batch, per worker of
+# settings.wiki_workers
+max_wiki_rows = 500
+
+
+def claim_wiki_queue(n_rows, after=0):
+    """Claims the next unprocessed rows of the WikiData queue
+
+    Takes:
+        n_rows (int) - the most rows to claim
+        after (int) - the rowid of the last row claimed so far
+
+    The rows are claimed in the order they were queued, and found through
+    the wiki_queue_pending index, rather than sorting the whole queue.
+
+    Returns:
+        list of (rowid, wiki_id, position_fk)
+    """
+    return execute('select rowid, wiki_id, position_fk from wiki_queue '
+                   'where processed == FALSE and wiki_id is not NULL '
+                   'and rowid > :after order by rowid limit :n_rows',
+                   values={'after': after, 'n_rows': n_rows},
+                   status='Fetching wiki queue')
+
+
+def resolve_wiki_queue(n_rows=None, after=0, report=False):
     """Fetching appropriate toponyms from WikiData based on the queue
 
     Takes:
-        n_rows (int) - The number of rows from the queue to process.
+        n_rows (int) - The number of rows from the queue to process,
+            settings.wiki_rows by default.
+        after (int) - The rowid of the last row processed so far, which
+            resolve_wiki_queue returns, to carry on from.
+        report (bool) - Whether to print the throughput of the batch, which
+            is logged either way.
 
-    Queries the wiki queue for 1 <= n_rows <= 500 entries, use their links
-    to query WikiData for toponyms in any of the languages from the settings.
+    Claims 1 <= n_rows <= max_wiki_rows entries per worker of
+    settings.wiki_workers from the wiki queue, use their links to query
+    WikiData for toponyms in any of the languages from the settings.
 
     Adds all entries to the toponyms table, linked to the appropriate position
-    and marks the queue item as processed.
-
+    and marks the queue items as processed, in a single transaction.
 
+    Returns:
+        The rowid of the last row processed, 0 once the queue is done.
     """
 
-    if n_rows > 500:
-        n_rows == 500
-    elif n_rows < 0:
-        n_rows = 1
-    elif n_rows == 0:
-        return
+    from wiki_operations import get_wiki_names
 
-    query = 'select wiki_id, position_fk, source_fk from wiki_queue where '\
-            ' processed == FALSE and wiki_id is not NULL '\
-            f'order by random() limit {n_rows}'
-    queue = sorted(execute(query, status='Fetching wiki queue'))
+    if n_rows is None:
+        n_rows = settings.wiki_rows
+    if n_rows == 0:
+        return 0
+    n_rows = min(max(n_rows, 1),
+                 max_wiki_rows * max(1, settings.wiki_workers))
 
-    identifiers = {q: (position, source) for q, position, source in queue if
-                   q.startswith('q')}
+    start = perf_counter()
+    queue = claim_wiki_queue(n_rows, after)
+    if len(queue) == 0:
+        return 0
+
+    # The positions linked to each Q, links to anything else are only
+    # marked as processed.
+    identifiers = defaultdict(set)
+    for _, q, position in queue:
+        if q.startswith('q'):
+            identifiers[q].add(position)
+
+    rows = []
     if len(identifiers) > 0:
         result_dict = get_wiki_names(identifiers.keys(), settings.languages)
 
-        for q, (position, source) in identifiers.items():
-            rows = []
-            for toponyms, language in result_dict[q]:
-                for toponym in toponyms.split('___'):
-                    processed_toponym = preprocess_toponym(toponym)
-                    tokens, asciiname, asciitokens, pattern = processed_toponym
-                    rows.append((position,
-                                 'WikDat',
-                                 toponym,
-                                 asciiname,
-                                 pattern,
-                                 tokens,
-                                 asciitokens,
-                                 language,
-                                 f'WikiData: {q}',
-                                 ))
-
-            if len(rows) > 0:
-                add_toponym_list(rows)
-
-            # recording the Q as done.
-
-            q_done_query = 'update wiki_queue set processed = TRUE where '\
-                           'wiki_id == :processed_q'
-
-            execute(q_done_query, values={'processed_q': q},
-                    status=f'{q} Processed.')
-
-        return True
-    else:
-        return False
+        # Preprocessing the names of all the Qs together
+        names = [(q, toponym, language) for q in identifiers
+                 for toponyms, language in result_dict[q]
+                 for toponym in toponyms.split('___')]
+        processed = preprocess_many([toponym for _, toponym, _ in names])
+        for (q, toponym, language), processed_toponym in zip(names, processed):
+            tokens, asciiname, asciitokens, pattern = processed_toponym
+            for position in sorted(identifiers[q]):
+                rows.append((position,
+                             'WikDat',
+                             toponym,
+                             asciiname,
+                             pattern,
+                             tokens,
+                             asciitokens,
+                             language,
+                             f'WikiData: {q}',
+                             ))
+
+    # recording the queue rows as done, together with their toponyms.
+    with transaction():
+        if len(rows) > 0:
+            add_toponym_list(rows)
+
+        execute('update wiki_queue set processed = TRUE where rowid == ?',
+                values=[(rowid, ) for rowid, *_ in queue], many=True,
+                status='Wiki queue processed.')
+
+    seconds = perf_counter() - start
+    message = f'Wiki queue: {len(queue)} rows, {len(identifiers)} items and '\
+              f'{len(rows)} toponyms in {seconds:.2f}s, '\
+              f'{len(queue) / seconds:.1f} rows/s'
+    logging.info(message)
+    if report:
+        print(message)
+    with _stats_lock:
+        query_stats['wiki_queue_batch'].record(seconds, len(queue))
+
+    return queue[-1][0]
 
 
 def wiki_queue_cleanup():
-    """Processes the WikiData queue, one batch at a time"""
+    """Processes the WikiData queue, one batch at a time
 
-    while resolve_wiki_queue():
-        logging.info('Taking care of the last wikipedia toponyms '
-                     f'{settings.wiki_rows} toponyms at at time')
-        sleep(10)
+    The pace is set by the rate limit of wiki_operations, and each batch
+    holds settings.wiki_rows rows per worker, to keep all of them busy. The
+    throughput of each batch is printed.
+    """
+    n_rows = settings.wiki_rows * max(1, settings.wiki_workers)
+    last = 0
+    while last := resolve_wiki_queue(n_rows, last, report=True):
+        pass
 
 
 if __name__ == '__main__':
@@ -1,21 +1,33 @@
 # coding=<utf-8>
 
+import argparse
+import io
+import json
 import logging
 import os
+import sys
 from settings import settings
 # This may not be a good idea
 from toponym_main import add_source, add_position
-from operations import execute, preprocess_toponym, add_toponym_list
-from datetime import datetime
+from toponym_main import source_available, erase_positions
+from operations import execute, iterate, preprocess_toponym, add_toponym_list
+from operations import preprocess_many
+from datetime import datetime, timedelta, timezone
 from collections import namedtuple
-import wget
+from contextlib import contextmanager
+from contextlib import nullcontext
+from itertools import islice
 import zipfile
-from tqdm import tqdm
 from collections import defaultdict
-from wiki_operations import fetch_base_item
+from wiki_operations import fetch_base_items
 from operations import resolve_wiki_queue, wiki_queue_cleanup
+from operations import transaction, flush_writes
+from operations import get_connection, close_connection
 
-from initiate_schema import create_tables
+from initiate_schema import create_tables, migrate
+from initiate_schema import create_indexes, drop_indexes
+from initiate_schema import create_posting_triggers, fill_postings
+from initiate_schema import postings
 
 geoname = namedtuple('geoname',
                      ['geonameid', 'name', 'asciiname', 'alternatenames',
@@ -41,14 +53,119 @@ altname = namedtuple('altname',
 wikiname = namedtuple('wikiname',
                       ['comment', 'name', 'language'])
 
+# The rows of the daily deletes-* and alternateNamesDeletes-* files
+deleted_geoname = namedtuple('deleted_geoname',
+                             ['geonameid', 'name', 'comment'])
+
+deleted_altname = namedtuple('deleted_altname',
+                             ['alternateNameId', 'geonameid', 'comment'])
+
 geonames_dir_path = 'geonames'
 
 
+class IdBitmap():
+    """A compact set of non-negative integer ids, one bit per possible id
+
+    Holds every GeoNames id, up to some 13 million, in under 2 MB.
+    """
+
+    def __init__(self, ids=()):
+        self.bits = bytearray()
+        for i in ids:
+            self.add(i)
+
+    def add(self, i):
+        """Adds the id i to the set"""
+        byte = i >> 3
+        if byte >= len(self.bits):
+            # growing by at least half, so that adding ids in order is cheap
+            self.bits.extend(bytes(max(byte + 1 - len(self.bits),
+                                       len(self.bits) // 2)))
+        self.bits[byte] |= 1 << (i & 7)
+
+    def __contains__(self, i):
+        byte = i >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & 1 << (i & 7))
+
+
+class CountedRows():
+    """Iterates over the rows of an input file, counting the rows read"""
+
+    def __init__(self, rows, start=0):
+        self.rows = iter(rows)
+        self.count = start
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = next(self.rows)
+        self.count += 1
+        return row
+
+
+def seed_checkpoint(stage):
+    """Fetches the checkpoint of a seeding stage
+
+    Returns:
+        (rows, completed) - the number of rows of the input file committed,
+            and whether the whole stage is, or None if it was never started
+    """
+    res = execute('select rows, completed from seed_progress '
+                  'where stage == :stage', {'stage': stage})
+    return (res[0][0], bool(res[0][1])) if len(res) > 0 else None
+
+
+def stage_completed(stage):
+    """Checks if a seeding stage has been committed in full"""
+    checkpoint = seed_checkpoint(stage)
+    return checkpoint is not None and checkpoint[1]
+
+
+def save_checkpoint(stage, rows=0, completed=False):
+    """Records the progress of a seeding stage
+
+    Executed within the transaction of the rows it accounts for, so that the
+    rows and the checkpoint are committed, or lost, together.
+    """
+    execute('INSERT INTO seed_progress (stage, rows, completed, '
+            'progress_edited) values (:stage, :rows, :completed, '
+            'datetime("now")) on conflict (stage) do update set '
+            'rows = excluded.rows, completed = excluded.completed, '
+            'progress_edited = excluded.progress_edited',
+            {'stage': stage, 'rows': rows, 'completed': completed})
+
+
+def resume_rows(rows, stage):
+    """Skips the rows of an input file already committed by a stage
+
+    Returns:
+        CountedRows, counting from the start of the file
+    """
+    done = (seed_checkpoint(stage) or (0, False))[0]
+    if done > 0:
+        print(f'\tResuming {stage} after {done} rows')
+    return CountedRows(islice(rows, done, None), start=done)
+
+
+def seeded_geonameids():
+    """Reads the ids of the positions seeded from GeoNames into an IdBitmap"""
+    return IdBitmap(position_id for (position_id, ) in iterate(
+        'SELECT position_id from position '
+        'where external_id == CAST(position_id AS TEXT)'))
+
+
 def add_known_toponym(source, raw_name, position_id,
                       asciiname=None, language='-'):
+    """Adds a toponym of a known position, preprocessed through the cache
 
-    tokens, asciiname, asciitokens, pattern = preprocess_toponym(
-            raw_name, asciiname)
+    The name_cache holds the names transliterated by anyascii, an asciiname
+    other than that is preprocessed on its own.
+    """
+    processed = preprocess_many([raw_name])[0]
+    if asciiname is not None and asciiname != processed[1]:
+        processed = preprocess_toponym(raw_name, asciiname)
+    tokens, asciiname, asciitokens, pattern = processed
 
     execute('INSERT INTO toponym (name, source_fk, asciiname, tokens, '
             'asciitokens, pattern, position_fk, toponym_created_date, '
@@ -66,251 +183,805 @@ def add_known_toponym(source, raw_name, position_id,
              'language': language})
 
 
-def get_geonames_txt(file):
-    """Makes sure the relevant txt file exists and returns its path"""
+@contextmanager
+def open_geonames(path):
+    """Opens a GeoNames dump for reading text, from a .txt or a .zip file
+
+    The .txt file of the same name is read straight out of a zip archive,
+    and decoded as it is read, without extracting it first.
+    """
+    if not path.endswith('.zip'):
+        with open(path, 'r', encoding='utf8') as f:
+            yield f
+        return
+
+    member = os.path.basename(path)[:-len('.zip')] + '.txt'
+    with zipfile.ZipFile(path, 'r') as archive:
+        with archive.open(member) as raw:
+            yield io.TextIOWrapper(raw, encoding='utf8')
+
+
+def read_geonames(path, row_type):
+    """Streams the rows of a GeoNames dump, one line at a time
+
+    Takes:
+        path - the path to the tab separated GeoNames .txt file, or the zip
+            archive holding it
+        row_type - the namedtuple matching the columns of the file
+
+    Yields:
+        row_type for each line
+    """
+    with open_geonames(path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line == '':
+                continue
+            split_line = line.split('\t')
+            if len(split_line) != len(row_type._fields):
+                print('\a')
+                logging.critical(f'One of the line of the {path} was not '
+                                 f'exatcly {len(row_type._fields)} columns '
+                                 'wide. ')
+                raise IOError(f'{path} may be corrupted.')
+            yield row_type(*split_line)
+
+
+def chunked(rows, size):
+    """Groups the rows of an iterable into lists of (at most) size rows"""
+    rows = iter(rows)
+    # num_rows used to default to 1e100, meaning everything at once
+    size = min(int(size), sys.maxsize)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def get_geonames_dump(file):
+    """Makes sure the relevant GeoNames dump exists and returns its path
+
+    An already extracted .txt file is used if there is one, otherwise the
+    zip archive, which is downloaded if necessary. Either can be read with
+    read_geonames.
+    """
     txt_path = os.path.join(geonames_dir_path, file + '.txt')
-    if not os.path.exists(txt_path):
-        get_geonames_zip(file)
-    return txt_path
+    if os.path.exists(txt_path):
+        return txt_path
+    return get_geonames_zip(file)
 
 
 def get_geonames_zip(zip_file):
-    """Makes sure the GeoNames zip is downloaded and extracts its content"""
+    """Makes sure the GeoNames zip is downloaded and returns its path"""
     zip_path = os.path.join(geonames_dir_path, zip_file+'.zip')
     if not os.path.exists(zip_path):
+        import wget
+
         url = f'http://download.geonames.org/export/dump/{zip_file}.zip'
         print(f'\tDownloading: {url}')
         downloaded = wget.download(url)
         os.rename(downloaded, zip_path)
+    return zip_path
 
-    with zipfile.ZipFile(zip_path, 'r') as z:
-        z.extractall(geonames_dir_path)
 
+def seed_alt_names(bulk=False, links=True):
 
-def seed_alt_names():
+    """Seeds all the alternate names
 
-    """Seeds all the alternate names"""
+    Takes:
+        bulk - bool, whether to load the whole file in a single transaction
+        links - bool, whether to queue and resolve the Wikipedia links
 
-    alt_names_path = get_geonames_txt('alternateNamesV2')
+    The Wikipedia links are looked up between the transactions of the
+    portions, so no request is made while a transaction is open. In bulk,
+    their titles are queued along with the names, and looked up by
+    resolve_wiki_titles once the whole file has been committed.
+    """
+    from tqdm import tqdm
 
+    stage = 'alternateNamesV2'
     geo_al_source = 'GeoAlt'
-    add_source(name=geo_al_source, comment='alternateNamesV2',
-               year=datetime.now().year)
     wiki_source = 'WikDat'
-    add_source(name=wiki_source, comment='wikidata',
-               year=datetime.now().year)
-
-    with open(alt_names_path, 'r', encoding='utf8') as f:
-
-        names_dict = defaultdict(list)
-        wiki_ndict = defaultdict(list)
-        for i, name in enumerate(tqdm(f.readlines(), desc='Preprocess rows')):
-
-            split_line = name.split('\t')
-
-            if len(split_line) != 10:
-                print('\a')
-                logging.critical(f'One of the line of the {alt_names_path} '
-                                 'was not exatcly 10 columns wide. ')
-                raise IOError(f'{alt_names_path} may be corrupted.')
+    if not stage_completed(stage):
+        alt_names_path = get_geonames_dump(stage)
+        if source_available(geo_al_source.lower()):
+            add_source(name=geo_al_source, comment='alternateNamesV2',
+                       year=datetime.now().year)
+        if source_available(wiki_source.lower()):
+            add_source(name=wiki_source, comment='wikidata',
+                       year=datetime.now().year)
+
+        # Only the rows that are kept are held in memory, a portion at a time.
+        rows = resume_rows(tqdm(read_geonames(alt_names_path, altname),
+                                desc='Preprocess rows'), stage)
+        names = filter_alt_names(rows, seeded=seeded_geonameids())
+        with stage_transaction(bulk):
+            for portion in chunked(names, settings.num_rows):
+                names_dict = defaultdict(list)
+                wiki_ndict = defaultdict(list)
+                for is_wiki, alt_row in portion:
+                    if not is_wiki:
+                        names_dict[alt_row.geonameid].append(alt_row)
+                    elif links:
+                        wiki_ndict[alt_row.geonameid].append(alt_row)
+
+                if bulk:
+                    wiki_records = wiki_queue_titles(wiki_ndict,
+                                                     source_name=wiki_source)
+                else:
+                    wiki_records = wiki_queue_records(wiki_ndict,
+                                                      source_name=wiki_source)
+                with transaction():
+                    process_portion(names_dict, source_name=geo_al_source)
+                    queue_wiki_records(wiki_records)
+                    save_checkpoint(stage, rows.count)
+                if links and not bulk:
+                    resolve_wiki_queue()
+
+        save_checkpoint(stage, rows.count, completed=True)
+
+    # finishing the queue, which keeps its own progress
+    if links and not stage_completed('wiki_queue'):
+        resolve_wiki_titles()
+        wiki_queue_cleanup()
+        save_checkpoint('wiki_queue', completed=True)
 
-            alt_row = altname(*split_line)
 
-            if alt_row.language == 'link' and 'wikipedia' in alt_row.name:
-                wiki_ndict[alt_row.geonameid].append(alt_row)
-                continue
-            elif (alt_row.language not in settings.languages and
-                  settings.languages != {}):
-                if alt_row != '':
-                    continue
+def filter_alt_names(rows, seeded=None):
+    """Filters the alternate names on the languages from the settings
 
-            names_dict[alt_row.geonameid].append(alt_row)
+    Takes:
+        rows - iterable of altname
+        seeded - if not None, the IdBitmap, or set, of the seeded geonameids,
+            the names of any other place are dropped.
 
-            if len(names_dict) >= settings.num_rows:
-                used = process_portion(names_dict, source_name='GeoAlt')
-                names_dict = defaultdict(list)
+    Yields:
+        (is_wiki, altname) - is_wiki is True for links to Wikipedia, which
+            are kept regardless of language.
+    """
+    for alt_row in rows:
+        if seeded is not None and int(alt_row.geonameid) not in seeded:
+            continue
+        elif alt_row.language == 'link' and 'wikipedia' in alt_row.name:
+            yield True, alt_row
+        # No languages in the settings means all languages
+        elif not settings.languages or alt_row.language in settings.languages:
+            yield False, alt_row
 
-                process_wiki_portion(wiki_ndict, source_name='WikDat',
-                                     used_geonames=used)
-                wiki_ndict = defaultdict(list)
-                del used
 
-    # this is where it seems to stop...
+def process_wiki_portion(names_dict, source_name):
+    """Resolves a portion of the Wikipedia links and fetches toponyms
 
-    # recording the last names
-    used = process_portion(names_dict, source_name='GeoAlt')
-    if process_wiki_portion(wiki_ndict, source_name='WikDat',
-                            used_geonames=used):
-        wiki_queue_cleanup()
+    The names_dict is keyed by the geonameids of seeded positions.
+    """
+    queue_wiki_records(wiki_queue_records(names_dict, source_name))
+    return resolve_wiki_queue()
 
 
-def process_wiki_portion(names_dict, source_name, used_geonames):
-    """Resolves a portion of the Wikipedia links and fetches toponyms"""
+def wiki_queue_records(names_dict, source_name):
+    """Resolves the Wikipedia links of a portion into wiki_queue rows
 
+    The names_dict is keyed by the geonameids of seeded positions.
+    """
     wiki_records = []
-    for geoid in used_geonames:
-        for row in names_dict[geoid]:
-            # title = fetch_title(row.name)
-            # if title is None:
-            #     continue
-            base_item = fetch_base_item(row.name)
+    # All the links of the portion are looked up together
+    base_items = fetch_base_items(row.name for rows in names_dict.values()
+                                  for row in rows)
+    for geoid, rows in names_dict.items():
+        # GeoNames ids double as the integer position keys
+        position_id = int(geoid)
+        for row in rows:
+            base_item = base_items[row.name]
 
             if type(base_item) is str:
                 base_item = base_item.lower()
 
             # if base_item is not None:
-            wiki_records.append((base_item, geoid,
+            wiki_records.append((base_item, position_id,
                                  source_name, row.name, False))
-
+    return wiki_records
+
+
+def wiki_queue_titles(names_dict, source_name):
+    """The wiki_queue rows of the Wikipedia links of a portion, unresolved
+
+    Their processed is NULL until resolve_wiki_titles looks them up.
+    """
+    # GeoNames ids double as the integer position keys
+    return [(None, int(geoid), source_name, row.name, None)
+            for geoid, rows in names_dict.items() for row in rows]
+
+
+def resolve_wiki_titles(n_rows=None):
+    """Looks up the WikiData items of the titles queued unresolved
+
+    Takes:
+        n_rows (int) - the most titles looked up at a time,
+            settings.num_rows by default
+
+    Each batch is committed on its own, the titles left by an interrupted
+    run are picked up by the next one.
+
+    Returns:
+        The number of titles resolved
+    """
+    if n_rows is None:
+        n_rows = settings.num_rows
+    resolved = 0
+    last = 0
+    while batch := execute('select rowid, title from wiki_queue '
+                           'where processed is NULL and rowid > :after '
+                           'order by rowid limit :n_rows',
+                           values={'after': last, 'n_rows': n_rows},
+                           status='Fetching unresolved titles'):
+        base_items = fetch_base_items(title for _, title in batch)
+        records = []
+        for rowid, title in batch:
+            base_item = base_items[title]
+            if type(base_item) is str:
+                base_item = base_item.lower()
+            records.append((base_item, rowid))
+        with transaction():
+            execute('update wiki_queue set wiki_id = ?, processed = FALSE '
+                    'where rowid == ?', values=records, many=True,
+                    status='Resolving wiki queue titles')
+        last = batch[-1][0]
+        resolved += len(batch)
+    return resolved
+
+
+def queue_wiki_records(wiki_records):
+    """Adds the rows from wiki_queue_records to the queue"""
     if len(wiki_records) > 0:
         execute('INSERT INTO wiki_queue (wiki_id, position_fk, source_fk, '
                 'title, processed) values (?, ?, ?, ?, ?)',
                 values=wiki_records,
                 many=True, status='Adding wikidata to queue')
 
-    return resolve_wiki_queue()
-
 
 def process_portion(names_dict, source_name):
-    """Records a portion of the toponyms"""
-    used_geonames = [str(_[0]) for _ in execute(
-            'SELECT position_id from position')]
+    """Records a portion of the toponyms
+
+    The names_dict is keyed by the geonameids of seeded positions.
 
+    Returns:
+        The number of toponyms recorded
+    """
     alt_names = []
 
-    for geonameid in used_geonames:
-        for row in names_dict[geonameid]:
-
-            tokens, asciiname, asciitokens, pattern = preprocess_toponym(
-                row.name)
-            try:
-                comment = row.comment
-            except AttributeError:
-                comment = ''
-
-            alt_names.append((geonameid,
-                             source_name,
-                             row.name,
-                             asciiname,
-                             pattern,
-                             tokens,
-                             asciitokens,
-                             row.language,
-                             comment)
-                             )
+    # GeoNames ids double as the integer position keys
+    rows = [(int(geonameid), row) for geonameid, alt_rows in names_dict.items()
+            for row in alt_rows]
+    processed = preprocess_many([row.name for _, row in rows])
+
+    for (position_id, row), processed_name in zip(rows, processed):
+        tokens, asciiname, asciitokens, pattern = processed_name
+        try:
+            comment = row.comment
+        except AttributeError:
+            comment = ''
+
+        alt_names.append((position_id,
+                         source_name,
+                         row.name,
+                         asciiname,
+                         pattern,
+                         tokens,
+                         asciitokens,
+                         row.language,
+                         comment,
+                         int(row.alternateNameId))
+                         )
     if len(alt_names) > 0:
-        add_toponym_list(alt_names)
+        add_toponym_list(alt_names, alt_ids=True)
 
-    return used_geonames
+    return len(alt_names)
 
 
 def seed_admin():
     """ Adds all the names from used admin2 codes from geonames"""
+    if stage_completed('admin2Codes'):
+        return
+
     admin2_file = os.path.join(geonames_dir_path, 'admin2Codes.txt')
     if not os.path.exists(admin2_file):
+        import wget
+
         wget.download('http://download.geonames.org/export/dump/'
                       'admin2Codes.txt')
         os.rename('admin2Codes.txt', admin2_file)
 
     with open(admin2_file, 'r', encoding='utf8') as f:
-        admins = f.readlines()
-    admins = [_.split('\t')[:2] for _ in admins if _[:2] in settings.countries]
-    execute('INSERT INTO parent_region (parent_id, name) values (?, ?)',
-            values=admins, many=True)
-
-
-def seed_positions():
-    """Seeding positions table from GeoNames and its base toponym"""
-
-    add_source(name='none', comment='For linking foreign positions', year=2022)
-    add_position(position_id=0,
-                 longitude=0,
-                 latitude=0,
-                 source="none",
-                 parent_id='none')
+        admins = [_.split('\t')[:2] for _ in f if _[:2] in settings.countries]
+    with transaction():
+        execute('INSERT INTO parent_region (parent_id, name) values (?, ?)',
+                values=admins, many=True)
+        save_checkpoint('admin2Codes', len(admins), completed=True)
+
+
+def seed_positions(bulk=False):
+    """Seeding positions table from GeoNames and its base toponym
+
+    Takes:
+        bulk - bool, whether to load each country file in a single
+            transaction
+    """
+    from tqdm import tqdm
+
+    if source_available('none'):
+        with transaction():
+            add_source(name='none', comment='For linking foreign positions',
+                       year=2022)
+            add_position(position_id=0,
+                         longitude=0,
+                         latitude=0,
+                         source="none",
+                         parent_id='none')
 
     countries = [(c, True) for c in settings.countries]
     countries += [(c, False) for c in settings.adjacents]
 
     for country, main in tqdm(countries, total=len(countries),
                               desc='Seeding positions by country'):
-        positions = []
-        names = []
-        txt_path = get_geonames_txt(country)
+        if stage_completed(country):
+            continue
+
+        dump_path = get_geonames_dump(country)
         source_name = f'GeoN{country}'.lower()
-        add_source(source_name, f'GeoNames {txt_path}',
-                   datetime.now().year)
-        # print(txt_path)
-        with open(txt_path, 'r', encoding='utf8') as f:
-            s = f.read().split('\n')
-            # for line in f.readlines():
-        for line in tqdm(s):
-            if line == '':
-                continue
-            geo_row = geoname(*line.split('\t'))
+        if source_available(source_name):
+            add_source(source_name, f'GeoNames {dump_path}',
+                       datetime.now().year)
+
+        rows = resume_rows(tqdm(read_geonames(dump_path, geoname)), country)
+        # store admin data and fetch names.
+        places = (geo_row for geo_row in rows if geo_row.feature_class != 'A')
+        seeded = 0
+        with stage_transaction(bulk):
+            for portion in chunked(places, settings.num_rows):
+                with transaction():
+                    seeded += seed_position_portion(portion, country, main,
+                                                    source_name)
+                    save_checkpoint(country, rows.count)
+            save_checkpoint(country, rows.count, completed=True)
+        print(f'{seeded=} positions for {country}')
+
+
+def seed_position_portion(portion, country, main, source_name):
+    """Records a portion of the positions from a GeoNames country file
+
+    Takes:
+        portion - list of geoname
+        country - the ISO 3166 code of the file
+        main - bool, False for the adjacent countries
+        source_name
+
+    Returns:
+        The number of positions recorded
+    """
+    positions = []
+    names = []
+    processed = preprocess_many([geo_row.name for geo_row in portion])
+    for geo_row, processed_name in zip(portion, processed):
+        # GeoNames ids double as the integer position keys
+        positions.append(
+                (int(geo_row.geonameid),
+                 geo_row.geonameid,
+                 source_name,
+                 geo_row.latitude,
+                 geo_row.longitude,
+                 parent_code(geo_row, country, main)))
+
+        tokens, asciiname, asciitokens, pattern = processed_name
+
+        names.append([int(geo_row.geonameid),
+                      source_name,
+                      geo_row.name,
+                      asciiname,
+                      pattern,
+                      tokens,
+                      asciitokens,
+                      '', 'GeoNames-Default']
+                     )
+
+    try:
+        _ = execute('INSERT into position (position_id, external_id, '
+                    'source_fk, '
+                    'latitude, '
+                    'longitude, '
+                    'parent_fk, '
+                    'position_created) values'
+                    '(?, ?, ?, ?, ?, '
+                    '?, datetime("NOW"))',
+                    values=positions,
+                    many=True)
+    except Exception as e:
+        print(country)
+
+        raise e
+
+    add_toponym_list(names)
+    return len(positions)
+
+
+def parent_code(geo_row, country, main):
+    """The parent_fk of a position, its admin2 code in the main countries"""
+    if main:
+
+        # assembling admin2 codes
+        return '.'.join((country, geo_row.admin1_code, geo_row.admin2_code))
+    else:
+        return '0'
 
-            if geo_row.feature_class == 'A':
-                # store admin data and fetch names.
-                continue
 
-            if main:
+def get_geonames_diff(kind, date):
+    """Makes sure a daily GeoNames diff file exists and returns its path
 
-                # assembling admin2 codes
-                admin_code = '.'.join((country, geo_row.admin1_code,
-                                       geo_row.admin2_code))
-            else:
-                admin_code = '0'
-
-            positions.append(
-                    (geo_row.geonameid,
-                     source_name,
-                     geo_row.latitude,
-                     geo_row.longitude,
-                     admin_code))
-
-            tokens, asciiname, asciitokens, pattern = preprocess_toponym(
-                geo_row.name)
-
-            names.append([geo_row.geonameid,
-                          source_name,
-                          geo_row.name,
-                          asciiname,
-                          pattern,
-                          tokens,
-                          asciitokens,
-                          '', 'GeoNames-Default']
-                         )
+    Takes:
+        kind - one of 'modifications', 'deletes',
+            'alternateNamesModifications' and 'alternateNamesDeletes'
+        date - str, the day of the changes as YYYY-MM-DD
 
-        try:
-            _ = execute('INSERT into position (position_id, source_fk, '
-                        'latitude, '
-                        'longitude, '
-                        'parent_fk, '
-                        'position_created) values'
-                        '(?, ?, ?, ?, '
-                        ':parent_fk, datetime("NOW"))',
-                        values=positions,
-                        many=True)
-            print(f'{len(positions)=}')
-            del positions
-        except Exception as e:
-            print(country)
+    A file already in the geonames directory is used as it is.
+    """
+    file = f'{kind}-{date}.txt'
+    path = os.path.join(geonames_dir_path, file)
+    if not os.path.exists(path):
+        import wget
 
-            raise e
+        url = f'http://download.geonames.org/export/dump/{file}'
+        print(f'\tDownloading: {url}')
+        downloaded = wget.download(url)
+        os.rename(downloaded, path)
+    return path
+
+
+def update_positions(rows):
+    """Applies modified GeoNames rows to the positions and their base toponym
+
+    Takes:
+        rows - iterable of geoname, from any country
+
+    Rows from the countries and adjacents in the settings are added when new
+    and otherwise update the coordinates, parent and base toponym of the
+    position, only the changed names are preprocessed again. The base
+    toponym is the one from the source of the position, whatever its
+    comment has become.
+
+    Returns:
+        The set of the ids of the existing positions that were changed
+    """
+    countries = {c: False for c in settings.adjacents}
+    countries.update({c: True for c in settings.countries})
+    rows = (geo_row for geo_row in rows if geo_row.country_code in countries
+            and geo_row.feature_class != 'A')
+
+    changed = set()
+    for portion in chunked(rows, settings.num_rows):
+        ids = json.dumps([int(geo_row.geonameid) for geo_row in portion])
+        current = {position_id: rest for position_id, *rest in execute(
+            'select position_id, latitude, longitude, parent_fk, toponym_id, '
+            'name from position left join toponym on position_fk == '
+            'position_id and toponym.source_fk == position.source_fk '
+            'where position_id in (select value from json_each(:ids))',
+            values={'ids': ids})}
+
+        new = defaultdict(list)
+        moved = []
+        renamed = []
+        for geo_row in portion:
+            country = geo_row.country_code
+            position_id = int(geo_row.geonameid)
+            if position_id not in current:
+                new[country].append(geo_row)
+                continue
 
-        add_toponym_list(names)
+            latitude, longitude, parent, toponym_id, name = \
+                current[position_id]
+            location = (float(geo_row.latitude), float(geo_row.longitude),
+                        parent_code(geo_row, country, countries[country]))
+            if location != (latitude, longitude, parent):
+                moved.append(location + (position_id, ))
+                changed.add(position_id)
+            if toponym_id is not None and name != geo_row.name:
+                renamed.append((toponym_id, geo_row.name))
+                changed.add(position_id)
+
+        with transaction():
+            for country, new_rows in new.items():
+                source_name = f'GeoN{country}'.lower()
+                if source_available(source_name):
+                    add_source(source_name, 'GeoNames updates',
+                               datetime.now().year)
+                seed_position_portion(new_rows, country, countries[country],
+                                      source_name)
+
+            if len(moved) > 0:
+                execute('update position set latitude = ?, longitude = ?, '
+                        'parent_fk = ? where position_id == ?',
+                        values=moved, many=True, status='Moving positions')
+            rename_toponyms(renamed)
+
+    return changed
+
+
+def rename_toponyms(renamed):
+    """Renames a list of (toponym_id, name) and preprocesses the new names"""
+    if len(renamed) == 0:
+        return
+    processed = preprocess_many([name for _, name in renamed])
+    execute('update toponym set name = ?, tokens = ?, asciiname = ?, '
+            'asciitokens = ?, pattern = ? where toponym_id == ?',
+            values=[(name, *processed_name, toponym_id) for
+                    (toponym_id, name), processed_name in
+                    zip(renamed, processed)],
+            many=True, status='Renaming toponyms')
+
+
+def delete_positions(rows, seeded):
+    """Removes the positions of deleted GeoNames rows
+
+    Takes:
+        rows - iterable of deleted_geoname
+        seeded - the IdBitmap of the seeded geonameids
+
+    The added toponyms connected to them are left for the matcher, as
+    with erase_positions.
+
+    Returns:
+        The number of positions removed
+    """
+    ids = [int(row.geonameid) for row in rows
+           if int(row.geonameid) in seeded]
+    if len(ids) > 0:
+        erase_positions(ids)
+    return len(ids)
+
+
+def update_alt_names(rows, seeded):
+    """Applies modified GeoNames alternate names to the toponyms
+
+    Takes:
+        rows - iterable of altname
+        seeded - the IdBitmap of the seeded geonameids
+
+    Names are found by their alternateNameId, or by position and name for
+    names seeded before the ids were kept. Changed names are preprocessed
+    again, new ones are added and new Wikipedia links are queued.
+
+    Returns:
+        The set of the ids of the positions whose names were changed
+    """
+    changed = set()
+    for portion in chunked(filter_alt_names(rows, seeded), settings.num_rows):
+        names = [alt_row for is_wiki, alt_row in portion if not is_wiki]
+        links = [alt_row for is_wiki, alt_row in portion if is_wiki]
+
+        values = {'ids': json.dumps([int(row.alternateNameId)
+                                     for row in names]),
+                  'positions': json.dumps(list({int(row.geonameid)
+                                                for _, row in portion}))}
+        known = {alt_id: rest for alt_id, *rest in execute(
+            'select geonames_alt_id, toponym_id, position_fk, name, language '
+            'from toponym where geonames_alt_id in '
+            '(select value from json_each(:ids))', values=values)}
+        unlabelled = {(position_fk, name): toponym_id for
+                      position_fk, name, toponym_id in execute(
+                        'select position_fk, name, toponym_id from toponym '
+                        'where source_fk == "GeoAlt" and geonames_alt_id is '
+                        'NULL and position_fk in '
+                        '(select value from json_each(:positions))',
+                        values=values)}
+
+        renamed = []
+        labelled = []
+        added = defaultdict(list)
+        for row in names:
+            alt_id = int(row.alternateNameId)
+            position_id = int(row.geonameid)
+            if alt_id in known:
+                toponym_id, position_fk, name, language = known[alt_id]
+                if (position_fk, name, language) == \
+                        (position_id, row.name, row.language):
+                    continue
+                renamed.append((toponym_id, row.name))
+                labelled.append((alt_id, row.language, position_id,
+                                 toponym_id))
+                changed |= {position_fk, position_id}
+            elif (position_id, row.name) in unlabelled:
+                toponym_id = unlabelled.pop((position_id, row.name))
+                labelled.append((alt_id, row.language, position_id,
+                                 toponym_id))
+            else:
+                added[row.geonameid].append(row)
+                changed.add(position_id)
+
+        queued = set(execute('select position_fk, title from wiki_queue '
+                             'where position_fk in '
+                             '(select value from json_each(:positions))',
+                             values=values))
+        new_links = defaultdict(list)
+        for row in links:
+            if (int(row.geonameid), row.name) not in queued:
+                new_links[row.geonameid].append(row)
+
+        with transaction():
+            rename_toponyms(renamed)
+            if len(labelled) > 0:
+                execute('update toponym set geonames_alt_id = ?, '
+                        'language = ?, position_fk = ? where toponym_id == ?',
+                        values=labelled, many=True,
+                        status='Updating alternate names')
+            process_portion(added, source_name='GeoAlt')
+
+        if len(new_links) > 0:
+            process_wiki_portion(new_links, source_name='WikDat')
+
+    return changed
+
+
+def delete_alt_names(rows):
+    """Removes the toponyms of deleted GeoNames alternate names
+
+    Takes:
+        rows - iterable of deleted_altname
+
+    Only names with a known alternateNameId can be found, which excludes
+    names seeded before the ids were kept.
+
+    Returns:
+        The set of the ids of the positions that lost names
+    """
+    changed = set()
+    for portion in chunked(rows, settings.num_rows):
+        values = {'ids': json.dumps([int(row.alternateNameId)
+                                     for row in portion])}
+        selected = 'toponym where geonames_alt_id in '\
+                   '(select value from json_each(:ids))'
+        with transaction():
+            changed |= {position_fk for (position_fk, ) in execute(
+                'select position_fk from ' + selected, values=values)}
+            execute('delete from suggestion where stable_toponym_fk in '
+                    '(select toponym_id from ' + selected + ')',
+                    values=values)
+            execute('delete from ' + selected, values=values)
+    return changed
+
+
+def flag_rechecks(positions):
+    """Flags the matched toponyms of changed positions for re-checking
+
+    Only the toponyms connected by the matcher, or by disambiguating its
+    suggestions, are flagged, the manual connections are left as they are.
+
+    Returns:
+        The number of toponyms flagged
+    """
+    values = {'positions': json.dumps(sorted(positions))}
+    selected = 'from toponym where match_state in '\
+               '("auto-single", "disambiguated") and position_fk in '\
+               '(select value from json_each(:positions))'
+    with transaction():
+        flagged = execute('select count(*) ' + selected, values=values)[0][0]
+        execute('insert into toponym_event (toponym_fk, match_state, '
+                'comment, event_created) select toponym_id, "recheck", '
+                '"Position " || position_fk || " changed in GeoNames", '
+                'datetime("now") ' + selected, values=values)
+        execute('update toponym set match_state = "recheck" where '
+                'toponym_id in (select toponym_id ' + selected + ')',
+                values=values)
+    return flagged
+
+
+def update_geonames(dates):
+    """Applies the daily GeoNames diffs to an existing database
+
+    Takes:
+        dates - iterable of str, the days to apply as YYYY-MM-DD, in order
+
+    For each day the modified and deleted positions are applied before the
+    modified and deleted alternate names, and finally the matched toponyms
+    of the changed positions are flagged for re-checking.
+    """
+    for date in dates:
+        print(f'Updating from GeoNames: {date}')
+        changed = update_positions(read_geonames(
+            get_geonames_diff('modifications', date), geoname))
+        deleted = delete_positions(read_geonames(
+            get_geonames_diff('deletes', date), deleted_geoname),
+            seeded_geonameids())
+
+        seeded = seeded_geonameids()
+        changed |= update_alt_names(read_geonames(
+            get_geonames_diff('alternateNamesModifications', date), altname),
+            seeded)
+        changed |= delete_alt_names(read_geonames(
+            get_geonames_diff('alternateNamesDeletes', date),
+            deleted_altname))
+
+        flagged = flag_rechecks(changed)
+        print(f'\t{len(changed)} positions changed, {deleted} deleted, '
+              f'{flagged} matched toponyms to re-check')
+
+
+def stage_transaction(bulk):
+    """The transaction of a whole seeding stage, in bulk mode only"""
+    return transaction() if bulk else nullcontext()
+
+
+@contextmanager
+def bulk_mode():
+    """Switches the connections over to the bulk-seed storage profile
+
+    Commits are neither journaled to disk nor synced while seeding, which
+    only suits a database that can be seeded again from scratch. The
+    durable settings of the previous profile are restored on the way out.
+    """
+    # Leaving the journal mode of WAL takes the only connection to the
+    # database, so the connection of this thread is closed first, and the
+    # writer thread, if any, reconnects with the new profile on its own.
+    profile = settings.storage_profile
+    close_connection()
+    settings.storage_profile = 'bulk-seed'
+    flush_writes()
+    try:
+        yield
+    finally:
+        close_connection()
+        settings.storage_profile = profile
+        flush_writes()
+        get_connection()
+
+
+def seed_tables(bulk=False, links=True):
+    """Seeding all tables with data from GeoNames and WikiData
+
+    Takes:
+        bulk - bool, whether to load each file in a single transaction and
+            build the secondary indexes and the token postings, and gather
+            the statistics of the query planner, only once all the rows are
+            in. Meant to be run within bulk_mode.
+        links - bool, whether to queue and resolve the Wikipedia links of
+            the alternate names
+
+    Each stage records its progress in the seed_progress table, in the
+    transactions of the rows it adds, so an interrupted seeding resumes
+    after the last committed portion.
+    """
 
+    os.makedirs(geonames_dir_path, exist_ok=True)
 
-def seed_tables():
-    """Seeding all tables with data from GeoNames and WikiData"""
+    if seed_checkpoint('seed') is None:
+        save_checkpoint('seed')
 
-    os.makedirs(geonames_dir_path, exist_ok=True)
+    if bulk:
+        with transaction() as conn:
+            drop_indexes(conn)
+            for table in postings:
+                conn.execute(f'DROP TRIGGER IF EXISTS add_{table}s')
+                save_checkpoint(table)
 
     seed_admin()
 
-    seed_positions()
+    seed_positions(bulk)
 
-    seed_alt_names()
+    seed_alt_names(bulk, links)
+
+    # The postings left out by a bulk seeding, even if it was resumed
+    # without --bulk.
+    for table in postings:
+        checkpoint = seed_checkpoint(table)
+        if checkpoint is not None and not checkpoint[1]:
+            with transaction() as conn:
+                print(f'Building the postings of {table}')
+                fill_postings(conn, table)
+                create_posting_triggers(conn)
+                save_checkpoint(table, completed=True)
+
+    if bulk:
+        with transaction() as conn:
+            print('Building the indexes')
+            create_indexes(conn)
+            conn.execute('ANALYZE')
+
+    save_checkpoint('seed', completed=True)
 
 
 if __name__ == '__main__':
@@ -323,12 +994,44 @@ if __name__ == '__main__':
         force=True
         )
 
-    if not os.path.exists(settings.database_path):
-        # initiate schema
-        create_tables()
-
-        # initiate seed
-        seed_tables()
+    parser = argparse.ArgumentParser(
+        description='Seeds the database from the settings file with '
+                    'GeoNames and WikiData, or updates an existing one.')
+    parser.add_argument('-b', '--bulk', action='store_true',
+                        help='Seed without journaling or syncing the '
+                        'commits, and build the indexes at the end. Faster, '
+                        'but a crash while seeding can corrupt the database, '
+                        'which then has to be deleted and seeded again.')
+    parser.add_argument('-u', '--update', metavar='date', type=str,
+                        nargs='*', default=None,
+                        help='Apply the daily GeoNames diffs of the dates '
+                        '(YYYY-MM-DD) to the existing database, defaults to '
+                        'yesterday. Diff files already in the geonames '
+                        'directory are not downloaded again.')
+
+    args = parser.parse_args()
+
+    if args.update is not None:
+        if not os.path.exists(settings.database_path):
+            parser.error('There is no database to update, seed it first.')
+        dates = args.update or [str((datetime.now(timezone.utc)
+                                     - timedelta(days=1)).date())]
+        migrate()
+        update_geonames(sorted(dates))
+    elif not os.path.exists(settings.database_path):
+        with bulk_mode() if args.bulk else nullcontext():
+            # initiate schema
+            create_tables()
+
+            # initiate seed
+            seed_tables(bulk=args.bulk)
     else:
-        print('Database already exists')
-        wiki_queue_cleanup()
+        migrate()
+        checkpoint = seed_checkpoint('seed')
+        if checkpoint is not None and not checkpoint[1]:
+            print('Resuming the interrupted seeding')
+            with bulk_mode() if args.bulk else nullcontext():
+                seed_tables(bulk=args.bulk)
+        else:
+            print('Database already exists')
+            wiki_queue_cleanup()
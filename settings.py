@@ -1,16 +1,102 @@
 # coding=<utf-8>
-import yaml
+from copy import deepcopy
+
+
+class toponymDefaults():
+    # Defaults, which are overridden by any value in the settings file.
+
+    # Named sets of SQLite settings, applied to each connection by
+    # operations.connect. page_size and auto_vacuum only take effect when the
+    # database is created, or when it is vacuumed.
+    storage_profiles = {
+        # Serving the GUI: durable commits, a moderate cache
+        'interactive': {'page_size': 8192,
+                        'auto_vacuum': 'INCREMENTAL',
+                        'journal_mode': 'WAL',
+                        'synchronous': 'NORMAL',
+                        'cache_size': -65536,
+                        'mmap_size': 268435456,
+                        'temp_store': 'MEMORY'},
+        # Seeding: the seed can be rerun, so commits are neither journaled
+        # to disk nor synced, the journal only allows rolling back
+        'bulk-seed': {'page_size': 8192,
+                      'auto_vacuum': 'INCREMENTAL',
+                      'journal_mode': 'MEMORY',
+                      'synchronous': 'OFF',
+                      'cache_size': -524288,
+                      'mmap_size': 1073741824,
+                      'temp_store': 'MEMORY'},
+        # Exports and clustering: large scans of the whole database
+        'read-heavy export': {'page_size': 8192,
+                              'auto_vacuum': 'INCREMENTAL',
+                              'journal_mode': 'WAL',
+                              'synchronous': 'NORMAL',
+                              'cache_size': -262144,
+                              'mmap_size': 2147418112,
+                              'temp_store': 'MEMORY'},
+    }
+    # The profile used unless another one is requested
+    storage_profile = 'interactive'
+
+    # The number of GeoNames rows read, preprocessed and inserted at a time
+    num_rows = 10000
+
+    # The number of processes preprocessing toponyms, None for one per core
+    # and 1 to preprocess them in the main process only.
+    preprocess_workers = None
+
+    # The most preprocessed names kept in memory, to reuse for repeated names
+    name_cache_size = 100000
+
+    # The number of concurrent requests to Wikipedia and WikiData, and the
+    # most requests made per second, across all of them.
+    wiki_workers = 4
+    wiki_requests_per_second = 5
+
+    # The User-Agent of the requests to Wikipedia and WikiData. The Wikimedia
+    # policy asks for a way to contact whoever makes them, add yours.
+    wiki_user_agent = 'CITADEL/1.0 (https://doi.org/10.5281/zenodo.7447897)'
+
+
+# The defaults by name
+defaults = {key: value for key, value in vars(toponymDefaults).items()
+            if key[0] != '_'}
 
 
 class toponymSettings():
+    # The settings file is only read when a setting is first used, or
+    # changed, so that importing the settings stays cheap. Loading fills the
+    # instance with the defaults and the values of the file, after which the
+    # settings are read as plain attributes.
+
     def __init__(self, path='toponym_settings.yaml'):
-        """Loading or creating toponym settings file"""
-        self.path = path
+        """Pointing to the toponym settings file, which is loaded later"""
+        self.__dict__['_loaded'] = False
+        self.__dict__['path'] = path
+
+    def __getattr__(self, name):
+        # Only called for the names missing from the instance
+        if name[0] != '_' and not self._loaded:
+            self.load()
+            if name in self.__dict__:
+                return self.__dict__[name]
+        raise AttributeError(f'No setting {name}')
 
+    def __setattr__(self, name, value):
+        if not self._loaded:
+            self.load()
+        self.__dict__[name] = value
+
+    def load(self):
+        """Loading the settings file, if there is one"""
+        import yaml
+
+        self.__dict__['_loaded'] = True
+        self.__dict__.update(deepcopy(defaults))
         try:
             with open(self.path, 'r') as f:
                 for key, value in yaml.safe_load(f).items():
-                    setattr(self, key, value)
+                    self.__dict__[key] = value
         # TODO: (80) Deal with these exceptions better.
         except FileNotFoundError:
             pass
@@ -18,9 +104,14 @@ class toponymSettings():
             pass
 
     def save(self):
-        """Save the settings file"""
+        """Save the settings file, without the defaults left unchanged"""
+        import yaml
+
         with open(self.path, 'w') as f:
-            yaml.safe_dump(self.__dict__, f)
+            yaml.safe_dump({key: value for key, value in self.__dict__.items()
+                            if key[0] != '_'
+                            and (key not in defaults
+                                 or value != defaults[key])}, f)
 
 
 settings = toponymSettings()
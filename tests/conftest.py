@@ -0,0 +1,30 @@
+# coding=<utf-8>
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from settings import settings  # noqa: E402
+import initiate_schema  # noqa: E402
+import operations  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """A new database with the schema, which the settings point to
+
+    Yields:
+        str, the path of the database
+    """
+    path = str(tmp_path / 'toponyms.sqlite3')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, 'database_path', path, raising=False)
+    monkeypatch.setattr(settings, 'languages', ['cs', 'en'], raising=False)
+    operations.close_connection()
+    initiate_schema.create_tables()
+    yield path
+    operations.flush_writes()
+    operations.close_connection()
@@ -0,0 +1,174 @@
+# coding=<utf-8>
+import sqlite3
+
+import pytest
+
+from settings import settings
+import initiate_schema
+import operations
+
+# The tables of the schema from before the scores and the unique pairs of
+# the suggestions, with the pairs indexed by plain indexes
+old_schema = (
+    'CREATE TABLE source (name char(6) primary key, comment text, '
+    'year INTEGER not NULL, source_date_edited)',
+    'CREATE TABLE toponym (toponym_id integer primary key, position_fk, '
+    'source_fk char(6) not null, name not null, asciiname not null, '
+    'pattern, tokens, language, asciitokens, comment text, '
+    'toponym_created_date datetime, toponym_edited datetime)',
+    'CREATE TABLE position (position_id primary key, source_fk not NULL, '
+    'latitude REAL not NULL, longitude REAL not NULL, parent_fk not null, '
+    'comment text, position_created datetime not null, '
+    'position_edited datetime)',
+    'CREATE TABLE suggestion (added_toponym_fk, stable_toponym_fk, '
+    'comment text, outcome bool)',
+    'CREATE TABLE nemo (added_toponym_fk, stable_toponym_fk, comment text, '
+    'outcome bool)',
+    'CREATE TABLE parent_region (parent_id primary key, name text)',
+    'CREATE TABLE wiki_queue (wiki_id , position_fk, source_fk, title, '
+    'processed)',
+    'CREATE INDEX suggestion_pair ON suggestion '
+    '(added_toponym_fk, stable_toponym_fk)',
+    'CREATE INDEX nemo_pair ON nemo (added_toponym_fk, stable_toponym_fk)',
+)
+
+
+@pytest.fixture
+def old_database(tmp_path, monkeypatch):
+    """A database with the old schema and repeated suggestions"""
+    path = str(tmp_path / 'old.sqlite3')
+    conn = sqlite3.connect(path)
+    for statement in old_schema:
+        conn.execute(statement)
+    conn.executemany('INSERT INTO toponym (toponym_id, position_fk, '
+                     'source_fk, name, asciiname) VALUES (?, ?, ?, ?, ?)',
+                     [(1, None, 'added', 'Brno', 'Brno'),
+                      (2, 'CZ1', 'geoncz', 'Brno', 'Brno'),
+                      (3, 'CZ2', 'geoncz', 'Brna', 'Brna')])
+    for table in ('suggestion', 'nemo'):
+        conn.executemany(f'INSERT INTO {table} VALUES (1, ?, ?, ?)',
+                         [(2, 'multiple_perfect', None),
+                          (2, 'multiple_perfect', None),
+                          (3, 'Nemo_ 0.5', False),
+                          (3, 'Nemo_ 0.9', None)])
+    conn.commit()
+    conn.close()
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, 'database_path', path, raising=False)
+    monkeypatch.setattr(settings, 'languages', ['cs'], raising=False)
+    operations.close_connection()
+    yield path
+    operations.flush_writes()
+    operations.close_connection()
+
+
+def pair_indexes(conn):
+    """The unique flag of the pair indexes, by name"""
+    return {name: unique for table in ('suggestion', 'nemo') for
+            _, name, unique, *_ in conn.execute(f'PRAGMA index_list({table})')
+            if name in initiate_schema.unique_indexes}
+
+
+def test_migrate_makes_the_pair_indexes_unique(old_database):
+    initiate_schema.migrate()
+    initiate_schema.migrate()
+
+    conn = operations.get_connection()
+    assert pair_indexes(conn) == {'suggestion_pair': 1, 'nemo_pair': 1}
+    for table in ('suggestion', 'nemo'):
+        # One row per pair, keeping the rejection
+        assert conn.execute(f'SELECT stable_toponym_fk, outcome FROM {table} '
+                            'ORDER BY stable_toponym_fk').fetchall() == \
+            [(2, None), (3, 0)]
+
+
+def test_suggestions_upsert_after_the_migration(old_database):
+    import matchers
+
+    initiate_schema.migrate()
+    query = matchers.matcher().suggest_query
+    operations.execute(query, values=(1, 2, 'multiple_hamming1', 3))
+    operations.execute(query, values=(1, 4, 'multiple_jairo9', 2))
+    assert operations.execute('SELECT stable_toponym_fk, score FROM '
+                              'suggestion ORDER BY stable_toponym_fk') == \
+        [(2, 5), (3, 0.5), (4, 2)]
+
+
+# toponym_gram as one row per character, filled by the old trigger
+old_grams = (
+    'CREATE TABLE toponym_gram (field text not NULL, gram text not NULL, '
+    'n INTEGER not NULL, length INTEGER not NULL, '
+    'toponym_id INTEGER not NULL, '
+    'primary key (field, gram, n, length, toponym_id)) WITHOUT ROWID',
+    "INSERT INTO toponym_gram VALUES ('name', 'n', 1, 4, 2), "
+    "('name', 'o', 1, 4, 2)",
+    "CREATE TRIGGER add_toponym_grams after insert on toponym begin "
+    "INSERT INTO toponym_gram VALUES ('name', 'x', 1, 1, new.toponym_id); "
+    "end",
+)
+
+
+def test_migrate_makes_the_grams_anew(old_database):
+    conn = sqlite3.connect(old_database)
+    for statement in old_grams:
+        conn.execute(statement)
+    conn.commit()
+    conn.close()
+
+    initiate_schema.migrate()
+    operations.execute('INSERT INTO toponym (position_fk, source_fk, name, '
+                       'asciiname) VALUES (1, "geoncz", "Žilina", "Zilina")')
+    conn = operations.get_connection()
+    assert initiate_schema.primary_key(conn, 'toponym_gram') == \
+        ['field', 'gram', 'length', 'n', 'toponym_id']
+    grams = conn.execute('SELECT * FROM toponym_gram').fetchall()
+    assert sorted(grams) == sorted(conn.execute(
+        initiate_schema.gram_rows('toponym')).fetchall())
+    # The asciinames equal to the names are not posted
+    assert {(field, toponym_id) for field, _, _, _, toponym_id in grams} == \
+        {('name', 1), ('name', 2), ('name', 3), ('name', 4),
+         ('asciiname', 4)}
+    assert ('name', 'i', 2, 6, 4) in grams
+
+
+def test_migrate_gives_the_position_references_integer_affinity(
+        old_database):
+    conn = sqlite3.connect(old_database)
+    conn.executemany('INSERT INTO position VALUES (?, "geoncz", 49.2, 16.6, '
+                     '"CZ.78", "", "2026-01-01", NULL)',
+                     [('1001', ), ('M_1', )])
+    conn.execute('INSERT INTO toponym (toponym_id, position_fk, source_fk, '
+                 'name, asciiname) VALUES (4, "1001", "geoncz", "Brno", '
+                 '"Brno"), (5, "M_1", "added", "Brünn", "Brunn")')
+    conn.execute('INSERT INTO wiki_queue VALUES ("q14960", "1001", "WikDat", '
+                 '"Brno", FALSE)')
+    conn.commit()
+    conn.close()
+
+    initiate_schema.migrate()
+    initiate_schema.migrate()
+    conn = operations.get_connection()
+    for table in ('toponym', 'wiki_queue'):
+        assert [declared for _, name, declared, *_ in conn.execute(
+            f'PRAGMA table_info({table})') if name == 'position_fk'] == \
+            ['INTEGER']
+    (manual, ) = conn.execute('SELECT position_id FROM position WHERE '
+                              'external_id == "M_1"').fetchone()
+    assert conn.execute('SELECT toponym_id, typeof(position_fk) FROM toponym '
+                        'WHERE position_fk IS NOT NULL ORDER BY 1'
+                        ).fetchall() == [(4, 'integer'), (5, 'integer')]
+    # Ids bound as text, as the GUI sends them, find the toponyms
+    assert conn.execute('SELECT toponym_id FROM toponym WHERE position_fk == '
+                        '? ORDER BY 1', ('1001', )).fetchall() == [(4, )]
+    assert conn.execute('SELECT toponym_id FROM toponym WHERE position_fk IN '
+                        '(SELECT value FROM json_each(?)) ORDER BY 1',
+                        (f'["1001", "{manual}"]', )).fetchall() == \
+        [(4, ), (5, )]
+    assert conn.execute('SELECT wiki_id FROM wiki_queue WHERE position_fk == '
+                        '?', ('1001', )).fetchall() == [('q14960', )]
+    # The triggers and indexes of the tables are back
+    names = {name for (name, ) in conn.execute(
+        'SELECT name FROM sqlite_master WHERE tbl_name == "toponym"')}
+    assert {'set_toponym_edit', 'add_toponym_tokens',
+            'toponym_position_fk'} <= names
@@ -0,0 +1,96 @@
+# coding=<utf-8>
+import random
+
+import pytest
+
+from anyascii import anyascii
+
+import matchers
+import operations
+
+places = ['Brno', 'Jihlava', 'Žďár nad Sázavou', 'Hradec Králové',
+          'Ústí nad Labem', 'Karlovy Vary', 'Olomouc', 'Ostrava', 'Plzeň',
+          'České Budějovice', 'Mariánské Lázně', 'Frýdek-Místek', 'Aš',
+          'Cheb', 'Kladno', 'Kolín', 'Liberec', 'Zlín']
+
+
+def variants(name, rng):
+    """Misspellings of a name, some of them within the reach of the matchers"""
+    k = rng.randrange(len(name))
+    char = rng.choice(name)
+    yield name[:k] + name[k + 1:]
+    yield name[:k] + char + name[k + 1:]
+    yield name[:k] + char + name[k:]
+    yield name[:k] + name[k:k + 2][::-1] + name[k + 2:]
+    yield name + ' ' + rng.choice(places)
+    yield anyascii(name)
+
+
+@pytest.fixture
+def toponyms(database, monkeypatch):
+    """Stable toponyms, and added ones to match against them
+
+    Returns:
+        list of the toponym_id of the added toponyms
+    """
+    monkeypatch.setattr(matchers, 'gram_counts', None)
+    rng = random.Random(24)
+    names = {'stable': set(), 'added': set()}
+    for _ in range(2):
+        for place in places:
+            for variant in variants(place, rng):
+                names['stable'].add(variant)
+                misspelt = list(variants(variant, rng))
+                names['added'].update(rng.sample(misspelt, 2))
+    for source, source_names in names.items():
+        operations.execute(
+            'insert into toponym (position_fk, source_fk, name, asciiname, '
+            'pattern, tokens, asciitokens) values (?, ?, ?, ?, ?, ?, ?)',
+            values=[(1 if source == 'stable' else None, source, name,
+                     asciiname, pattern, tokens, asciitokens)
+                    for name in sorted(source_names) if name
+                    for tokens, asciiname, asciitokens, pattern in
+                    [operations.preprocess_toponym(name)]],
+            many=True)
+    operations.flush_writes()
+    return [toponym_id for (toponym_id, ) in operations.execute(
+        'select toponym_id from toponym where source_fk == "added"')]
+
+
+@pytest.mark.parametrize('measure, lookup, fields', [
+    ('hamming1', 'hamming_options', ('name', 'asciiname')),
+    ('jairo9', 'gram_options', ('name', 'asciiname')),
+    ('all_in_one', 'token_options', ('tokens', 'asciitokens'))])
+def test_indexed_candidates_equal_the_scan(toponyms, measure, lookup,
+                                           fields):
+    match = matchers.matcher()
+    func = getattr(matchers.matcher, measure)
+    compared = matched = 0
+    for toponym_id in toponyms:
+        target = match.get_target_data(toponym_id)
+        options = list(match.get_options(toponym_id, languages=None))
+        for field in fields:
+            idx = matchers.ToponymTuple._fields.index(field)
+            candidates = getattr(match, lookup)(toponym_id, field,
+                                                target[idx], languages=None)
+            if candidates is None:
+                continue
+            scanned = {option.toponym_id for option in options
+                       if func(match, target[idx], option[idx])[0]}
+            indexed = {option.toponym_id for option in candidates
+                       if func(match, target[idx], option[idx])[0]}
+            assert indexed == scanned, (measure, target[idx])
+            compared += 1
+            matched += len(scanned) > 0
+    # Most of the names are looked up, and some have matches
+    assert compared > len(toponyms)
+    assert matched > len(toponyms) / 10
+
+
+def test_distance_matches_equal_the_scan(toponyms):
+    match = matchers.matcher()
+    for toponym_id in toponyms:
+        target = match.get_target_data(toponym_id)
+        options = list(match.get_options(toponym_id, languages=None))
+        assert match.distance_matches(target) == \
+            match.distance_matches(target, options)
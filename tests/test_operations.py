@@ -0,0 +1,271 @@
+# coding=<utf-8>
+import sqlite3
+
+import pytest
+
+from settings import settings
+import operations
+
+
+@pytest.fixture
+def connections(database, monkeypatch):
+    """Counts the connections opened, by their storage profile"""
+    opened = []
+    connect = operations.connect
+
+    def counted(path=None, profile=None):
+        opened.append(profile)
+        return connect(path, profile)
+
+    monkeypatch.setattr(operations, 'connect', counted)
+    return opened
+
+
+def add_sources(n):
+    operations.execute('insert into source (name, comment, year) '
+                       'values (?, ?, ?)',
+                       values=[(f'src{i:03}', 'test', 2022) for i in range(n)],
+                       many=True)
+
+
+def test_iterate_reuses_the_reader_connection(connections):
+    add_sources(5)
+    query = 'select name from source order by name'
+    for _ in range(3):
+        assert [name for (name, ) in operations.iterate(query)] == \
+            [f'src{i:03}' for i in range(5)]
+    # One for the writer thread, one for the reader of this thread
+    assert len(connections) == 2
+
+
+def test_iterate_allows_queries_while_streaming(connections):
+    add_sources(5)
+    names = []
+    for (name, ) in operations.iterate('select name from source '
+                                       'order by name', arraysize=2):
+        names.append(name)
+        operations.execute('select count(*) from source')
+        # A nested stream on the same reader connection
+        assert len(list(operations.iterate('select name from source'))) == 5
+    assert len(names) == 5
+
+
+def test_iterate_abandoned_early_leaves_the_reader_usable(connections):
+    add_sources(5)
+    rows = operations.iterate('select name from source', arraysize=1)
+    next(rows)
+    rows.close()
+    assert len(list(operations.iterate('select name from source'))) == 5
+    assert len(connections) == 2
+
+
+def test_iterate_with_another_profile_gets_its_own_connection(connections):
+    add_sources(1)
+    # Another profile in WAL mode, which can be applied with other
+    # connections open
+    profiles = settings.storage_profiles
+    journal_mode = profiles[settings.storage_profile]['journal_mode']
+    other = next(profile for profile in profiles
+                 if profile != settings.storage_profile and
+                 profiles[profile]['journal_mode'] == journal_mode)
+    for _ in range(2):
+        assert list(operations.iterate('select name from source',
+                                       profile=other)) == [('src000', )]
+    assert connections.count(other) == 2
+
+
+@pytest.mark.parametrize('query, write', [
+    ('select * from toponym', False),
+    ('  SELECT 1', False),
+    ('insert into source values (1)', True),
+    ('WITH new AS (select 1) INSERT INTO t SELECT * FROM new', True),
+    ('with recursive c (k) as (select 1 union all select k + 1 from c '
+     'where k < 3) select k from c', False),
+    ('with c as (select 1) update t set k = 1', True),
+    ('with c as (select 1) delete from t', True),
+    ('with "insert" as (select 1) select * from "insert"', False),
+    ("select 'delete' -- update\n", False),
+    ('/* drop */ select 1', False),
+    ('ANALYZE', True),
+    ('VACUUM', True),
+    ('REINDEX toponym', True),
+    ('PRAGMA optimize', True),
+    ('PRAGMA wal_checkpoint(TRUNCATE)', True),
+    ('PRAGMA journal_mode = WAL', True),
+    ('PRAGMA main.cache_size=-2000', True),
+    ('PRAGMA journal_mode', False),
+    ('PRAGMA table_info(toponym)', False),
+    ('explain query plan delete from toponym', False),
+])
+def test_is_write(query, write):
+    assert operations.is_write(query) == write
+
+
+@pytest.fixture
+def numbers(database):
+    """A table of numbers to write to"""
+    operations.execute('create table numbers_written '
+                       '(k INTEGER primary key, n INTEGER unique)')
+    return 'numbers_written'
+
+
+@pytest.fixture
+def groups(monkeypatch):
+    """Records the size of each group of writes the writer executes"""
+    sizes = []
+    write_group = operations._write_group
+
+    def recorded(group):
+        sizes.append(len(group))
+        return write_group(group)
+
+    monkeypatch.setattr(operations, '_write_group', recorded)
+    return sizes
+
+
+@pytest.fixture
+def writer_held(database):
+    """Holds the write lock, so the writes queue up, until called"""
+    operations.flush_writes()
+    conn = operations.connect()
+    conn.execute('BEGIN EXCLUSIVE')
+
+    # The first write is taken by the writer, which then waits for the lock
+    blocked = operations.execute('create table blocked (k)', wait=False)
+    while operations._write_queue.qsize() > 0:
+        pass
+
+    def release():
+        conn.rollback()
+        conn.close()
+        blocked.result()
+
+    yield release
+    conn.close()
+
+
+def test_writes_are_committed_in_order(numbers):
+    futures = [operations.execute(f'insert into {numbers} (n) values (?)',
+                                  values=(n, ), wait=False)
+               for n in range(1000)]
+    operations.flush_writes()
+    assert all(future.done() for future in futures)
+    assert [n for (n, ) in operations.execute(
+        f'select n from {numbers} order by k')] == list(range(1000))
+
+
+def test_write_errors_reach_the_future(numbers):
+    future = operations.execute('insert into missing (n) values (1)',
+                                wait=False)
+    assert isinstance(future.exception(), sqlite3.OperationalError)
+    with pytest.raises(sqlite3.OperationalError):
+        operations.execute('insert into missing (n) values (1)')
+
+
+def test_failed_group_is_retried_one_write_at_a_time(numbers, writer_held,
+                                                     groups):
+    query = f'insert into {numbers} (n) values (?)'
+    futures = [operations.execute(query, values=(n, ), wait=False)
+               for n in (1, 2, 1, 3)]
+    writer_held()
+
+    assert [future.exception() is None for future in futures] == \
+        [True, True, False, True]
+    # The whole group, then each of its writes on its own
+    assert groups == [4, 1, 1, 1, 1]
+    assert isinstance(futures[2].exception(), sqlite3.IntegrityError)
+    assert [n for (n, ) in operations.execute(
+        f'select n from {numbers} order by k')] == [1, 2, 3]
+
+
+def test_vacuum_is_written_outside_of_a_transaction(numbers, writer_held,
+                                                    groups):
+    query = f'insert into {numbers} (n) values (?)'
+    futures = [operations.execute(query, values=(1, ), wait=False),
+               operations.execute('VACUUM', wait=False),
+               operations.execute(query, values=(2, ), wait=False)]
+    writer_held()
+    assert [future.exception() for future in futures] == [None] * 3
+    # The vacuum keeps the inserts apart
+    assert groups == [1, 1, 1]
+
+
+def test_flushing_needs_no_connection(database, monkeypatch):
+    operations.flush_writes()
+    monkeypatch.setattr(operations, 'connect', None)
+    operations.flush_writes()
+
+
+@pytest.fixture
+def name_cache(tmp_path, monkeypatch):
+    """preprocess_many with an empty cache of 3 names"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(settings, 'languages', ['cs'], raising=False)
+    monkeypatch.setattr(settings, 'name_cache_size', 3, raising=False)
+    cache = operations.NameCache()
+    monkeypatch.setattr(operations, 'name_cache', cache)
+    return cache
+
+
+names = ['Ústí nad Labem', 'Lands of the North', 'Brno', 'Jihlava']
+
+
+def test_name_cache_equals_preprocess(name_cache):
+    uncached = [operations.preprocess_toponym(name) for name in names]
+    assert operations.preprocess_many(names) == uncached
+    assert operations.preprocess_many(names[-3:]) == uncached[-3:]
+    assert name_cache.stats()['hits'] == 3
+
+
+def test_name_cache_hits(name_cache):
+    operations.preprocess_many(['Brno', 'Brno', 'Jihlava'])
+    assert name_cache.stats() == {'size': 3, 'names': 2, 'hits': 1,
+                                  'misses': 2, 'hit_rate': 1 / 3}
+    operations.preprocess_many(['Jihlava'])
+    assert name_cache.stats()['hits'] == 2
+
+
+def test_name_cache_drops_the_least_recently_used(name_cache):
+    operations.preprocess_many(names[:3])
+    # Using the first name again makes the second the least recently used
+    operations.preprocess_many(names[:1])
+    operations.preprocess_many(names[3:])
+    name_cache.stats(reset=True)
+    found = name_cache.get_many(names)
+    assert sorted(found) == sorted([names[0], names[2], names[3]])
+    assert name_cache.stats()['names'] == 3
+
+
+def test_name_cache_follows_the_languages(name_cache, monkeypatch):
+    assert operations.preprocess_many(names[:2]) == \
+        [(',labem, ,ústí,', 'Usti nad Labem', ',labem, ,usti,',
+          '_st_ nad Labem'),
+         (',lands, ,north, ,of, ,the,', 'Lands of the North',
+          ',lands, ,north, ,of, ,the,', 'Lands of the North')]
+    monkeypatch.setattr(settings, 'languages', ['en'], raising=False)
+    assert name_cache.get_many(names[:2]) == {}
+    assert [tokens for tokens, *_ in operations.preprocess_many(names[:2])] \
+        == [',labem, ,nad, ,ústí,', ',lands, ,north,']
+
+
+def test_wiki_queue_batches_scale_with_the_workers(database, monkeypatch):
+    import wiki_operations
+
+    monkeypatch.setattr(settings, 'wiki_rows', 500, raising=False)
+    monkeypatch.setattr(settings, 'wiki_workers', 4, raising=False)
+    operations.execute('INSERT INTO wiki_queue (wiki_id, position_fk, '
+                       'source_fk, title, processed) values (?, ?, ?, ?, ?)',
+                       values=[(f'q{i}', i, 'WikDat', f'Place {i}', False)
+                               for i in range(1, 2501)],
+                       many=True)
+    batches = []
+
+    def get_wiki_names(identifiers, languages=None):
+        batches.append(len(identifiers))
+        return {q: [] for q in identifiers}
+
+    monkeypatch.setattr(wiki_operations, 'get_wiki_names', get_wiki_names)
+    operations.wiki_queue_cleanup()
+    assert batches == [2000, 500]
+    assert operations.execute('select count(*) from wiki_queue where '
+                              'processed is not TRUE') == [(0, )]
@@ -0,0 +1,239 @@
+# coding=<utf-8>
+import os
+
+import pytest
+
+from settings import settings
+import initiate_schema
+import operations
+import seed
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'fixtures', 'geonames')
+
+date = '2026-01-02'
+
+
+def geoname(geonameid, name, latitude, longitude, country, admin1, admin2):
+    return seed.geoname(str(geonameid), name, name, '', latitude, longitude,
+                        'P', 'PPLA', country, '', admin1, admin2, '', '',
+                        '1000', '', '200', 'Europe/Prague', '2026-01-01')
+
+
+def altname(alt_id, geonameid, language, name):
+    return seed.altname(str(alt_id), str(geonameid), language, name,
+                        '', '', '', '', '', '')
+
+
+@pytest.fixture
+def seeded(database, monkeypatch):
+    """A database seeded with a few places, names and matched toponyms
+
+    The diffs of the day are read from the fixtures.
+    """
+    from toponym_main import add_source
+
+    monkeypatch.setattr(settings, 'countries', ['CZ'], raising=False)
+    monkeypatch.setattr(settings, 'adjacents', ['SK'], raising=False)
+    monkeypatch.setattr(settings, 'languages', ['cs'], raising=False)
+    monkeypatch.setattr(seed, 'geonames_dir_path', fixtures)
+    operations.name_cache.clear()
+
+    for source in ('geoncz', 'geonsk', 'GeoAlt', 'added'):
+        add_source(source, 'test', 2026)
+    seed.seed_position_portion(
+        [geoname(1001, 'Brno', '49.19', '16.61', 'CZ', '78', '0642'),
+         geoname(1002, 'Jihlava', '49.39', '15.59', 'CZ', '79', '0707')],
+        'CZ', True, 'geoncz')
+    seed.seed_position_portion(
+        [geoname(1003, 'Žilina', '49.22', '18.74', 'SK', '02', '')],
+        'SK', False, 'geonsk')
+    seed.process_portion({'1001': [altname(5002, 1001, 'cs', 'Brna')],
+                          '1002': [altname(5001, 1002, 'cs', 'Iglava')]},
+                         source_name='GeoAlt')
+
+    # Toponyms matched by the matcher, and one connected by hand
+    operations.add_toponym_list(
+        [(position, 'added', name, name, name, name.lower(), name.lower(),
+          'cs', '') for position, name in
+         ((1001, 'Brno'), (1002, 'Jihlava'), (1001, 'Brunn'))])
+    operations.execute('update toponym set match_state = case name '
+                       'when "Brunn" then "manual" else "auto-single" end '
+                       'where source_fk == "added"')
+    return database
+
+
+def toponym(position_fk, source_fk='geoncz'):
+    """The name, tokens and asciiname of a toponym of a position"""
+    rows = operations.execute('select toponym_id, name, tokens, asciiname, '
+                              'asciitokens, pattern from toponym where '
+                              'position_fk == ? and source_fk == ?',
+                              values=(position_fk, source_fk))
+    return rows[0] if len(rows) == 1 else rows
+
+
+def snapshot():
+    """All the rows of the tables the updates change"""
+    return {table: sorted(operations.execute(f'select * from {table}'),
+                          key=repr)
+            for table in ('position', 'toponym', 'toponym_event',
+                          'suggestion', 'wiki_queue', 'source',
+                          *initiate_schema.postings)}
+
+
+def test_known_toponyms_are_preprocessed_through_the_cache(seeded):
+    operations.name_cache.clear()
+    for asciiname in (None, 'Brno', 'Brunn'):
+        seed.add_known_toponym('added', 'Brno', 1003, asciiname, 'cs')
+    operations.flush_writes()
+
+    assert operations.name_cache.stats()['hits'] == 2
+    assert [tuple(row[1:]) for row in toponym(1003, 'added')] == [
+        ('Brno', *operations.preprocess_toponym('Brno')),
+        ('Brno', *operations.preprocess_toponym('Brno')),
+        ('Brno', *operations.preprocess_toponym('Brno', 'Brunn'))]
+
+
+def test_update_upserts_and_deletes_positions(seeded):
+    seed.update_geonames([date])
+
+    assert operations.execute(
+        'select position_id, latitude, longitude, parent_fk from position '
+        'where position_id > 0 order by position_id') == \
+        [(1001, 49.2, 16.6, 'CZ.78.0642'),
+         (1002, 49.39, 15.59, 'CZ.79.0707'),
+         (1004, 48.86, 16.05, 'CZ.78.0647')]
+    # The places of the other countries are left out
+    assert toponym(1005) == []
+    assert toponym(1004)[1] == 'Znojmo'
+    assert toponym(1003, 'geonsk') == []
+
+
+def test_update_preprocesses_renamed_toponyms(seeded):
+    seed.update_geonames([date])
+    operations.name_cache.clear()
+
+    for position, source, name in ((1001, 'geoncz', 'Brno-město'),
+                                   (1002, 'GeoAlt', 'Iglau')):
+        toponym_id, *processed = toponym(position, source)
+        tokens, asciiname, asciitokens, pattern = \
+            operations.preprocess_toponym(name)
+        assert processed == [name, tokens, asciiname, asciitokens, pattern]
+
+    # The new and deleted alternate names
+    names = operations.execute('select geonames_alt_id, position_fk, name '
+                               'from toponym where source_fk == "GeoAlt" '
+                               'order by geonames_alt_id')
+    assert names == [(5001, 1002, 'Iglau'), (5003, 1001, 'Brünn')]
+
+
+def test_update_renames_commented_toponyms(seeded):
+    toponym_id = toponym(1001)[0]
+    operations.write_comment('Checked by hand', 'toponym', 'toponym_id',
+                             toponym_id)
+    seed.update_geonames([date])
+    assert toponym(1001)[:2] == (toponym_id, 'Brno-město')
+
+
+def test_update_refreshes_the_postings(seeded):
+    seed.update_geonames([date])
+
+    conn = operations.get_connection()
+    for table, (_, _, rows) in initiate_schema.postings.items():
+        assert sorted(conn.execute(f'select * from {table}')) == \
+            sorted(conn.execute(rows('toponym')))
+    renamed = toponym(1001)[0]
+    assert sorted(token for (token, ) in conn.execute(
+        'select token from toponym_token where field == "tokens" and '
+        'toponym_id == ?', (renamed, ))) == [',brno,', ',město,']
+
+
+def test_update_flags_the_matched_toponyms(seeded):
+    seed.update_geonames([date])
+
+    assert operations.execute('select name, match_state from toponym where '
+                              'source_fk == "added" order by name') == \
+        [('Brno', 'recheck'), ('Brunn', 'manual'), ('Jihlava', 'recheck')]
+    assert operations.execute(
+        'select toponym.name, toponym_event.comment from toponym_event join '
+        'toponym on toponym_id == toponym_fk where toponym_event.match_state '
+        '== "recheck" order by toponym.name') == \
+        [('Brno', 'Position 1001 changed in GeoNames'),
+         ('Jihlava', 'Position 1002 changed in GeoNames')]
+
+
+def test_applying_a_diff_twice_changes_nothing(seeded):
+    seed.update_geonames([date])
+    before = snapshot()
+    seed.update_geonames([date])
+    assert snapshot() == before
+
+
+@pytest.fixture
+def wikipedia(monkeypatch):
+    """Stand-ins for Wikipedia and WikiData, refusing calls in transactions
+
+    Returns:
+        list of the titles looked up
+    """
+    import wiki_operations
+
+    monkeypatch.setattr(settings, 'wiki_rows', 50, raising=False)
+    queried = []
+
+    def fetch_base_items(titles):
+        assert not operations.get_connection().in_transaction
+        titles = list(titles)
+        queried.extend(titles)
+        return {title: 'Q' + title.split('/')[-1] for title in titles}
+
+    def get_wiki_names(identifiers, languages=None):
+        assert not operations.get_connection().in_transaction
+        return {q: [(q[1:].title() + '___' + q[1:].upper(), 'cs')]
+                for q in identifiers}
+
+    monkeypatch.setattr(seed, 'fetch_base_items', fetch_base_items)
+    monkeypatch.setattr(wiki_operations, 'get_wiki_names', get_wiki_names)
+    return queried
+
+
+def assert_links_resolved():
+    assert operations.execute('select position_fk, name from toponym where '
+                              'source_fk == "WikDat" order by name') == \
+        [(1001, 'BRNO'), (1001, 'Brno'), (1002, 'JIHLAVA'), (1002, 'Jihlava')]
+    assert operations.execute('select count(*) from wiki_queue where '
+                              'processed is not TRUE') == [(0, )]
+    assert seed.stage_completed('alternateNamesV2')
+
+
+@pytest.mark.parametrize('bulk', [False, True])
+def test_wikipedia_is_not_queried_within_a_transaction(seeded, wikipedia,
+                                                       bulk):
+    seed.seed_alt_names(bulk=bulk)
+
+    assert sorted(wikipedia) == ['https://cs.wikipedia.org/wiki/Brno',
+                                 'https://cs.wikipedia.org/wiki/Jihlava']
+    assert_links_resolved()
+
+
+def test_bulk_links_survive_a_failure_after_the_commit(seeded, wikipedia,
+                                                       monkeypatch):
+    fetch_base_items = seed.fetch_base_items
+
+    def unreachable(titles):
+        raise ConnectionError('Wikipedia is unreachable')
+
+    monkeypatch.setattr(seed, 'fetch_base_items', unreachable)
+    with pytest.raises(ConnectionError):
+        seed.seed_alt_names(bulk=True)
+    # The names are committed, and the links are queued for the next run
+    assert seed.stage_completed('alternateNamesV2')
+    assert operations.execute('select position_fk, title from wiki_queue '
+                              'where processed is NULL order by title') == \
+        [(1001, 'https://cs.wikipedia.org/wiki/Brno'),
+         (1002, 'https://cs.wikipedia.org/wiki/Jihlava')]
+
+    monkeypatch.setattr(seed, 'fetch_base_items', fetch_base_items)
+    seed.seed_alt_names(bulk=True)
+    assert len(wikipedia) == 2
+    assert_links_resolved()
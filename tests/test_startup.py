@@ -0,0 +1,33 @@
+# coding=<utf-8>
+import os
+
+import pytest
+
+from benchmark import import_module
+from benchmark import startup_budget, startup_heavy, startup_modules
+
+
+@pytest.mark.parametrize('module', startup_modules)
+def test_import_has_no_side_effects(module, tmp_path):
+    imported = import_module(module, tmp_path)
+    assert imported['returncode'] == 0, imported['stderr']
+
+    assert os.listdir(tmp_path) == []
+    assert imported['connected'] == []
+    assert [path for path in imported['opened']
+            if path.endswith(('.yaml', '.sqlite3', '.txt'))
+            or not os.path.isabs(path)
+            or path.startswith(str(tmp_path))] == []
+
+
+@pytest.mark.parametrize('module', startup_modules)
+def test_import_is_quick(module, tmp_path):
+    imported = import_module(module, tmp_path)
+    assert imported['returncode'] == 0, imported['stderr']
+
+    names = [name for name, _, _ in imported['times']]
+    assert module in names
+    assert sorted({name for name in names
+                   if name.split('.')[0] in startup_heavy}) == []
+    # The interpreter's and site's imports are counted as well
+    assert 0 < imported['seconds'] <= imported['total'] <= startup_budget
@@ -0,0 +1,269 @@
+# coding=<utf-8>
+from contextlib import closing
+from email.utils import format_datetime
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+from settings import settings
+import wiki_operations
+
+
+class Response():
+    def __init__(self, status_code=200, headers=None, body=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class Clock():
+    """Stands in for the clocks of wiki_operations, sleeping takes no time"""
+
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return 1800000000 + self.now
+
+    def sleep(self, seconds):
+        self.now += max(0, seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    for name in ('monotonic', 'sleep', 'time'):
+        monkeypatch.setattr(wiki_operations, name, getattr(clock, name))
+    # The backoff without its jitter
+    monkeypatch.setattr(wiki_operations.random, 'uniform',
+                        lambda low, high: low)
+    monkeypatch.setattr(wiki_operations, 'limiter',
+                        wiki_operations.RateLimiter(1000, 10))
+    return clock
+
+
+@pytest.fixture
+def server(clock, monkeypatch):
+    """Answers the requests with the responses, or errors, put in replies
+
+    Returns:
+        (replies, sent) - the list of the replies to come, and the list of
+            the seconds since the start at which each request was made
+    """
+    start = clock.now
+    replies = []
+    sent = []
+
+    def http_get(url, params, timeout, headers):
+        sent.append(clock.now - start)
+        reply = replies.pop(0) if len(replies) > 1 else replies[0]
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    monkeypatch.setattr(wiki_operations, 'http_get', http_get)
+    return replies, sent
+
+
+def test_requests_say_who_makes_them(monkeypatch):
+    sent = []
+
+    def http_get(url, params, timeout, headers):
+        sent.append(headers)
+        return Response()
+
+    monkeypatch.setattr(wiki_operations, 'http_get', http_get)
+    monkeypatch.setattr(wiki_operations, 'limiter',
+                        wiki_operations.RateLimiter(1000, 10))
+    wiki_operations.get(wiki_operations.sparql_endpoint, {'query': ''})
+    assert sent == [{'User-Agent': settings.wiki_user_agent}]
+    assert 'CITADEL' in settings.wiki_user_agent
+
+
+def http_date(seconds):
+    return format_datetime(datetime.fromtimestamp(seconds, timezone.utc),
+                           usegmt=True)
+
+
+@pytest.mark.parametrize('retry_after, delay', [
+    ('7', 7),
+    (lambda now: http_date(now + 20), 20),
+    (lambda now: http_date(now - 20), 0),
+    ('86400000', wiki_operations.max_delay),
+    # An unreadable header falls back to the backoff
+    ('soon', 1)])
+def test_refusals_wait_for_retry_after(clock, server, retry_after, delay):
+    replies, sent = server
+    if callable(retry_after):
+        retry_after = retry_after(clock.time())
+    replies.extend([Response(429, {'Retry-After': retry_after}),
+                    Response()])
+    assert wiki_operations.get(wiki_operations.sparql_endpoint,
+                               {}).status_code == 200
+    # Besides the wait for a token of the limiter, emptied by the pause
+    assert sent == [0, pytest.approx(delay, abs=0.01)]
+
+
+@pytest.mark.parametrize('failure', [Response(503),
+                                     requests.ConnectionError('reset')])
+def test_failures_back_off_exponentially(server, failure):
+    replies, sent = server
+    replies.extend([failure, failure, failure, Response()])
+    wiki_operations.get(wiki_operations.sparql_endpoint, {})
+    assert sent == pytest.approx([0, 1, 3, 7])
+
+
+@pytest.mark.parametrize('failure, error', [
+    (Response(503), requests.HTTPError),
+    (requests.ConnectionError('reset'), requests.ConnectionError)])
+def test_failures_give_up_after_max_retries(server, failure, error):
+    replies, sent = server
+    replies.append(failure)
+    with pytest.raises(error):
+        wiki_operations.get(wiki_operations.sparql_endpoint, {})
+    assert len(sent) == wiki_operations.max_retries + 1
+
+
+def test_other_errors_are_not_retried(server):
+    replies, sent = server
+    replies.append(Response(404))
+    with pytest.raises(requests.HTTPError):
+        wiki_operations.get(wiki_operations.sparql_endpoint, {})
+    assert sent == [0]
+
+
+def test_limiter_keeps_the_rate_after_a_burst(clock):
+    limiter = wiki_operations.RateLimiter(rate=2, burst=3)
+    start = clock.now
+    acquired = []
+    for _ in range(7):
+        limiter.acquire()
+        acquired.append(clock.now - start)
+    assert acquired == pytest.approx([0, 0, 0, 0.5, 1, 1.5, 2])
+
+    # The tokens come back up to the burst only
+    clock.sleep(10)
+    start = clock.now
+    acquired = []
+    for _ in range(4):
+        limiter.acquire()
+        acquired.append(clock.now - start)
+    assert acquired == pytest.approx([0, 0, 0, 0.5])
+
+
+def test_limiter_pause_holds_back_the_requests(clock):
+    limiter = wiki_operations.RateLimiter(rate=2, burst=3)
+    start = clock.now
+    limiter.pause(5)
+    limiter.pause(1)
+    limiter.acquire()
+    assert clock.now - start == pytest.approx(5)
+
+
+# The pages of the Wikipedia stand-in, by language, and their redirects
+pages = {'cs': {'Brno': 'Q14960', 'Jihlava': 'Q1', 'Ostrava': 'Q2',
+                'Hradec Králové': 'Q3', 'Zlín': 'Q4', 'Kolín': None},
+         'de': {'Brünn': 'Q14960'}}
+redirects = {'cs': {'Brünn': 'Brno'}}
+
+
+@pytest.fixture
+def wikipedia(tmp_path, monkeypatch):
+    """A Wikipedia stand-in for the MediaWiki API, with an empty title cache
+
+    Returns:
+        list of the (language, titles) of the requests made
+    """
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(wiki_operations, 'limiter',
+                        wiki_operations.RateLimiter(1000, 10))
+    sent = []
+
+    def http_get(url, params, timeout, headers):
+        language = urlsplit(url).netloc.split('.')[0]
+        titles = params['titles'].split('|')
+        sent.append((language, titles))
+        query = {'normalized': [], 'redirects': [], 'pages': {}}
+        for title in titles:
+            page = title.replace('_', ' ')
+            page = page[0].upper() + page[1:]
+            if page != title:
+                query['normalized'].append({'from': title, 'to': page})
+            if page in redirects.get(language, {}):
+                query['redirects'].append(
+                    {'from': page, 'to': redirects[language][page]})
+                page = redirects[language][page]
+            if page in pages[language]:
+                item = pages[language][page]
+                query['pages'][str(len(query['pages']))] = dict(
+                    title=page, **({'pageprops': {'wikibase_item': item}}
+                                   if item else {}))
+            else:
+                query['pages'][f'-{len(query["pages"])}'] = {
+                    'title': page, 'missing': ''}
+        return Response(body={'query': query})
+
+    monkeypatch.setattr(wiki_operations, 'http_get', http_get)
+    return sent
+
+
+def link(language, title):
+    return f'https://{language}.wikipedia.org/wiki/{title}'
+
+
+def test_titles_are_looked_up_in_batches_per_language(wikipedia,
+                                                      monkeypatch):
+    monkeypatch.setattr(wiki_operations, 'max_titles', 2)
+    links = [link('cs', title) for title in pages['cs']] + \
+        [link('de', 'Brünn')]
+    wiki_operations.fetch_base_items(links)
+
+    assert sorted((language, len(titles)) for language, titles in
+                  wikipedia) == [('cs', 2), ('cs', 2), ('cs', 2), ('de', 1)]
+    assert sorted(title for _, titles in wikipedia for title in titles) == \
+        sorted(list(pages['cs']) + ['Brünn'])
+
+
+def test_titles_are_mapped_back_to_their_items(wikipedia):
+    links = [link('cs', 'brno'), link('cs', 'Hradec_Kr%C3%A1lov%C3%A9'),
+             link('cs', 'Br%C3%BCnn'), link('de', 'Brünn'),
+             link('cs', 'Kolín'), link('cs', 'Nikde'),
+             'https://www.example.com/wiki/Brno']
+    assert wiki_operations.fetch_base_items(links) == dict(zip(links, [
+        'Q14960', 'Q3', 'Q14960', 'Q14960', None, None, None]))
+    # All the Czech titles in one request
+    assert len(wikipedia) == 2
+
+
+def test_cached_titles_are_not_looked_up_again(wikipedia):
+    # The titles of the older cache, without their language
+    with open(wiki_operations.wiki_title_2_base_item, 'w',
+              encoding='utf8') as f:
+        f.write('Ostrava___Q2\nNikde___None\nBrno___Q0\n')
+
+    assert wiki_operations.fetch_base_items(
+        [link('cs', 'Ostrava'), link('cs', 'Nikde')]) == \
+        {link('cs', 'Ostrava'): 'Q2', link('cs', 'Nikde'): None}
+    assert wikipedia == []
+
+    links = [link('cs', 'Jihlava'), link('cs', 'Zlín'), link('de', 'Brünn')]
+    first = wiki_operations.fetch_base_items(links)
+    assert sorted(wikipedia) == [('cs', ['Jihlava', 'Zlín']),
+                                 ('de', ['Brünn'])]
+    assert wiki_operations.fetch_base_items(links + [link('cs', 'Brno')]) \
+        == dict(first, **{link('cs', 'Brno'): 'Q0'})
+    assert len(wikipedia) == 2
+
+    # A title looked up in its language takes over from the older one
+    with closing(wiki_operations.open_title_cache()) as conn, conn:
+        conn.execute('INSERT INTO title_item VALUES ("cs", "Brno", '
+                     '"Q14960")')
+    assert wiki_operations.fetch_base_item(link('cs', 'Brno')) == 'Q14960'
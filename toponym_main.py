@@ -1,22 +1,26 @@
 # coding=<utf-8>
-from initiate_schema import create_tables
+from initiate_schema import migrate
 from settings import settings
-import anvil.server
+import json
 import logging
 import sqlite3
 # from anyascii import anyascii
 # from stopwords import get_stopwords
 # from nltk.corpus import stopwords
-import matchers
 from operations import execute
-from operations import preprocess_toponym
+from operations import iterate
+from operations import transaction
+from operations import preprocess_many
+from operations import name_cache
 from operations import write_comment
 from operations import connect_toponym
+from operations import log_event
+from operations import toponym_history
+from operations import dump_query_stats
 from statistics import mean
-from anyascii import anyascii
 from collections import namedtuple
 from collections import Counter
-from geopy.distance import great_circle
+from itertools import chain
 
 DisambigTuple = namedtuple('DisambigTuple',
                            ['added_toponym_id', 'newname', 'source_fk',
@@ -25,12 +29,44 @@ DisambigTuple = namedtuple('DisambigTuple',
                             'pcomment', 'paltnames', 'adminname', ])
 
 
+# The functions served to the GUI, which are only registered with the anvil
+# uplink by connect_uplink, so that the seed and the other scripts importing
+# this module neither import nor need anvil.
+server_callables = []
+background_tasks = []
+
+
+def server_callable(func):
+    """Marks a function as callable from the GUI"""
+    server_callables.append(func)
+    return func
+
+
+def background_task(func):
+    """Marks a function as a background task, launched from the GUI"""
+    background_tasks.append(func)
+    return func
+
+
+def connect_uplink(token):
+    """Registers the callables and background tasks and connects to anvil"""
+    import anvil.server
+
+    for func in server_callables:
+        anvil.server.callable(func)
+    for func in background_tasks:
+        anvil.server.background_task(func)
+    anvil.server.connect(token)
+
+
 def position_distance(pos1, pos2):
+    from geopy.distance import great_circle
+
     return great_circle(pos1, pos2).km
 
 
 # add source
-@anvil.server.callable
+@server_callable
 def add_source(name, comment, year):
     """
     Takes:
@@ -55,7 +91,7 @@ def add_source(name, comment, year):
 
 
 # comment source
-@anvil.server.callable
+@server_callable
 def comment_source(source_name, comment):
     """
     Takes:
@@ -75,7 +111,7 @@ def source_available(source):
 
 
 # add toponym
-@anvil.server.callable
+@server_callable
 def add_toponym(source, raw_names):
     """Adds a list of toponyms from a source to the toponyms table
     Takes:
@@ -83,7 +119,10 @@ def add_toponym(source, raw_names):
         raw_names - a list of tuples expected to contain:
             toponym name - as is, possibly with transcription errors
             lang - '' or 2-character language ISO 639 code
-            position - '' or a fk to the position table
+            position - '' or the external_id of a position, e.g. GeoNames id
+
+    Toponyms without a known position are left "unmatched" for the matcher,
+    the others are recorded as "manual".
     """
 
     # check that source exists:
@@ -93,7 +132,8 @@ def add_toponym(source, raw_names):
     raw_names_in_count = len(raw_names)
 
     # for some reason the passed tuples are changed to lists.
-    raw_names = [(n.strip(), lang, pos) for n, lang, pos in raw_names]
+    raw_names = [(n.strip(), lang, '' if pos is None else str(pos)) for
+                 n, lang, pos in raw_names]
 
     if type(raw_names) is str:
         raw_names = {raw_names, source}
@@ -104,8 +144,10 @@ def add_toponym(source, raw_names):
 
     raw_names_uniq_count = len(raw_names)
 
-    used_names = set(execute('SELECT name, language, position_fk from toponym '
-                             'where source_fk == :source',
+    used_names = set(execute('SELECT name, language, '
+                             'ifnull(external_id, "") from toponym '
+                             'left join position on position_id == position_fk '
+                             'where toponym.source_fk == :source',
                              {'source': source}))
     raw_names -= used_names
 
@@ -115,68 +157,100 @@ def add_toponym(source, raw_names):
                   f'{raw_names_entered_count}')
 
     values = []
-    for raw_name, language, position in raw_names:
+    raw_names = list(raw_names)
+    processed = preprocess_many([raw_name for raw_name, *_ in raw_names])
+    for (raw_name, language, position), processed_name in zip(raw_names,
+                                                              processed):
 
-        tokens, asciiname, asciitokens, pattern = preprocess_toponym(
-            raw_name)
+        tokens, asciiname, asciitokens, pattern = processed_name
         values.append((raw_name, source, asciiname, tokens, asciitokens,
-                       pattern, position, language))
+                       pattern, position, language, position))
+
+    if len(values) == 0:
+        return 0
 
-    q_marks = q_marker(values[0])
+    q_marks = q_marker(values[0][:6])
 
     _ = execute('INSERT INTO toponym (name, source_fk, asciiname, tokens, '
                 'asciitokens, pattern, position_fk, language, '
-                'toponym_created_date, comment) '
-                'values (' + q_marks + ', datetime("now"), "")',
+                'match_state, toponym_created_date, comment) '
+                'values (' + q_marks + ', (select position_id from position '
+                'where external_id == ?), ?, ifnull((select "manual" from '
+                'position where external_id == ?), "unmatched"), '
+                'datetime("now"), "")',
                 values=values,
                 many=True)
     return len(values)
 
 
 # comment toponym
-@anvil.server.callable
+@server_callable
 def comment_toponym(toponym_id, comment):
-    """Appends a new string to the beginning of a toponym comment"""
-    _ = write_comment(comment=comment, table='toponym', field='toponym_id',
-                      value=toponym_id)
-    return _
+    """Appends a new string to the beginning of a toponym comment
+
+    The comment is queued for the writer thread without waiting for it.
+    """
+    write_comment(comment=comment, table='toponym', field='toponym_id',
+                  value=toponym_id, wait=False)
 
 
 # add position
-@anvil.server.callable
+@server_callable
 def add_position(position_id, source, latitude, longitude,
                  # precision,
                  # abandoned,
                  # parent_name,
                  parent_id,
                  comment=None):
-    """Creates a record of a position"""
+    """Creates a record of a position
+
+    Takes:
+        position_id - the external id of the position, a GeoNames id is
+            also used as its key, any other id, e.g. "M_123", gets a new key.
+        source, latitude, longitude, parent_id, comment
+
+    Returns:
+        The integer key of the position
+    """
 
     if source_available(source=source):
         raise ValueError(f'{source} is not available')
 
+    external_id = str(position_id)
+    key = int(external_id) if external_id.isdigit() else None
+
     # feature class and or name may be necessary
     try:
-        _ = execute('INSERT into position (position_id, source_fk, latitude, '
-                    'longitude, '
-                    'parent_fk, comment, '
-                    'position_created) values'
-                    '(:position_id, :source, :latitude, :longitude, '
-                    ':parent_fk, :comment, datetime("NOW"))',
-                    {'position_id': position_id, 'source': source,
+        execute('INSERT into position (position_id, external_id, source_fk, '
+                'latitude, longitude, '
+                'parent_fk, comment, '
+                'position_created) values'
+                '(:key, :external_id, :source, :latitude, :longitude, '
+                ':parent_fk, :comment, datetime("NOW"))',
+                {'key': key, 'external_id': external_id, 'source': source,
                      'latitude': latitude, 'longitude': longitude,
-                     # 'abandoned':abandoned,
-                     # 'parent_name': parent_name,
-                     'parent_fk': parent_id,
-                     'comment': comment})
+                 # 'abandoned':abandoned,
+                 # 'parent_name': parent_name,
+                 'parent_fk': parent_id,
+                 'comment': comment})
     except sqlite3.IntegrityError as e:
         logging.warning(f'Duplicate coordinates found for: {position_id=}, '
                         f'{source=}, {latitude=}, {longitude=}, {parent_id=}\n'
                         f'{e}')
-    return _
+    return position_key(external_id)
 
 
-@anvil.server.callable
+def position_key(external_id):
+    """Looks up the integer key of a position from its external id"""
+    _ = execute('select position_id from position where '
+                'external_id == :external_id',
+                {'external_id': str(external_id)})
+    if len(_) == 0:
+        return None
+    return _[0][0]
+
+
+@server_callable
 def change_coordinates(position_id, latitude, longitude):
     """Change a positions coordinates"""
     execute('update position set latitude = :latitude, longitude = :longitude'
@@ -186,7 +260,7 @@ def change_coordinates(position_id, latitude, longitude):
 
 
 # comment position
-@anvil.server.callable
+@server_callable
 def comment_position(comment, position_id):
     """Append comment to the beginning of position comment"""
     _ = write_comment(comment=comment, table='position', field='position_id',
@@ -199,29 +273,35 @@ def q_marker(items):
     return ', '.join('?' for _ in items)
 
 
-@anvil.server.callable
+@server_callable
 def start_matcher(source=None):
     """Initiate the matching process in the background """
+    import anvil.server
+
     task = anvil.server.launch_background_task('matcher', source)
     return task
 
 
-@anvil.server.callable
+@server_callable
 def get_existing_matcher():
     """"Fetches existing matchers, if they exist"""
+    import anvil.server
+
     return [t for t in anvil.server.list_background_tasks() if
             t.get_task_name() == 'matcher']
 
 
-@anvil.server.callable
+@server_callable
 def kill_matcher(task):
     """Kills the supplied background task"""
     task.kill()
 
 
-@anvil.server.background_task
+@background_task
 def matcher(source_fk=None):
     """Background task for the auto matching process"""
+    import anvil.server
+    import matchers
 
     # making the matcher object that manages the matching process.
     matcher = matchers.matcher(source_fk, execute)
@@ -242,31 +322,37 @@ def matcher(source_fk=None):
         raise e
 
 
-@anvil.server.callable
+@server_callable
 def start_nemo_list(*toponym_id):
+    import anvil.server
+
     task = anvil.server.launch_background_task('make_nemo_list', *toponym_id)
     return task
 
 
-@anvil.server.background_task
+@background_task
 def make_nemo_list(*toponym_id):
     make_nemo(*toponym_id)
 
 
 def make_nemo(*toponym_id):
+    import matchers
+
     matcher = matchers.Nemo()
 
     matcher.top_10(*toponym_id)
 
 
-@anvil.server.callable
+@server_callable
 def match_one_wait(toponym_id, source_fk):
+    import matchers
+
     matcher = matchers.matcher(source_fk, execute)
 
     return matcher.run_all_matchers(toponym_id, suggest=True)[0]
 
 
-@anvil.server.callable
+@server_callable
 def toponym_data(toponym_ids):
     """Fetching toponym plus position data for editors from toponym_ids list"""
     results = []
@@ -284,15 +370,18 @@ def toponym_data(toponym_ids):
     if len(results) == 0:
         return('No toponym data found.')
 
+    # The matching history is shown above the comments of the editors
     results = [{'id':toponym_id, 'name':name, 'source':source, 'p_id':pos,
-                'lat':lat, 'lng':lng, 'comment':comment, 'p_comment':p_comment,
-                'p_source': p_source} for
+                'lat':lat, 'lng':lng,
+                'comment':' \n '.join(filter(None, toponym_history(toponym_id)
+                                                + [comment])),
+                'p_comment':p_comment, 'p_source': p_source} for
                 toponym_id, name, source, pos, lat, lng, comment, p_comment,
                 p_source in results]
     return results
 
 # TODO: (70) server.call('browser', 'positions')
-@anvil.server.callable
+@server_callable
 def browser(table, filters={}, page=1):
     """A generic function for retreiving subsets from tables to display in app
     Takes:
@@ -334,7 +423,7 @@ def browser(table, filters={}, page=1):
             toponym = ''
 
         if filters['position_fk'] != '':
-            position = ' and position_fk like :position_fk '
+            position = ' and p.external_id like :position_fk '
             values['position_fk'] = '%'+filters['position_fk']+'%'
         else:
             position = ''
@@ -394,7 +483,7 @@ def browser(table, filters={}, page=1):
     return 'Nothing found'
 
 
-@anvil.server.callable
+@server_callable
 def fetch_sources(user_sources=True):
     """Fetching the source data for storage in anvil table"""
 
@@ -406,16 +495,14 @@ def fetch_sources(user_sources=True):
     return o
 
 
-@anvil.server.callable
+@server_callable
 def declare_foreign(toponym_id):
     """Connects a toponym to the dummy point of (0,0)"""
-    execute('update toponym set position_fk = 0, '
-            'comment = "Declared irrelevant " || comment '
-            'where toponym_id == :target',
-            values={'target': toponym_id})
+    connect_toponym(toponym_id=toponym_id, position_fk=0,
+                    comment='Declared irrelevant', match_state='foreign')
 
 
-@anvil.server.callable
+@server_callable
 def next_nemo(n=5):
     res = execute(
          'select toponym_id, name from toponym where position_fk is  null order by source_fk, name')
@@ -424,7 +511,7 @@ def next_nemo(n=5):
     return next_id, next_name
 
 
-@anvil.server.callable
+@server_callable
 def goto_disambiguator(n=5, nemo=False):
     """Go to position n of the toponyns with multiple suggestions
 
@@ -528,7 +615,7 @@ def goto_disambiguator(n=5, nemo=False):
     return (n, N), results
 ## added the 'selected': True so that the checkboxes defaults to being selected.
 
-@anvil.server.callable
+@server_callable
 def remove_disambiguation_options(target_id, option_ids, nemo=False):
     """Suggestions are rejected, to ensure that they are not suggested again"""
     print(target_id, option_ids)
@@ -541,28 +628,36 @@ def remove_disambiguation_options(target_id, option_ids, nemo=False):
     _ = execute(remove_query, values=values, many=True)
 
 
-@anvil.server.callable
+@server_callable
 def delete_toponym(toponym_id):
     execute('delete from toponym where toponym_id == :toponym_id',
             values={'toponym_id': toponym_id}, status='Deleting toponym')
 
 
-@anvil.server.callable
+@server_callable
 def delete_position(position_id):
     """Removing a position, and all its seeded toponyms"""
     values = {'position_id': position_id}
-    execute('update toponym set position_fk = NULL where length(source_fk) > 6'
-            ' and position_fk == :position_id', values=values,
-            status='Nulling added toponym position')
+    with transaction():
+        execute('insert into toponym_event (toponym_fk, match_state, '
+                'comment, event_created) select toponym_id, "unmatched", '
+                '"Position deleted", datetime("now") from toponym where '
+                'length(source_fk) > 6 and position_fk == :position_id',
+                values=values, status='Logging deleted position')
+
+        execute('update toponym set position_fk = NULL, '
+                'match_state = "unmatched" where '
+                'length(source_fk) > 6 and position_fk == :position_id',
+                values=values, status='Nulling added toponym position')
 
-    execute('delete from toponym where position_fk == :position_id',
-            values=values, status='Removing seeded connected toponyms.')
+        execute('delete from toponym where position_fk == :position_id',
+                values=values, status='Removing seeded connected toponyms.')
 
-    execute('delete from position where position_id == :position_id',
-            status='Deleting position.', values=values)
+        execute('delete from position where position_id == :position_id',
+                status='Deleting position.', values=values)
 
 
-@anvil.server.callable
+@server_callable
 def disconnect_position(toponym_id, position_fk):
     """Disconnect a position from a toponym
 
@@ -571,32 +666,41 @@ def disconnect_position(toponym_id, position_fk):
     pairing will not be suggested in the future.
     """
 
-    #first we delete the suggestions connecting toponym to position
-    execute('delete from suggestion where added_toponym_fk == :toponym_id '
-            'and stable_toponym_fk in (select toponym_id from toponym where '
-            'position_fk == :position_fk)',
-            values={'toponym_id': toponym_id, 'position_fk': position_fk})
-
-    #disconnect position
-    execute('update toponym set position_fk = NULL where toponym_id == '
-            ':toponym_id', values={'toponym_id': toponym_id})
-
-    # fetching all the toponym connected to position
-    toponyms = execute('select toponym_id from toponym where position_fk == '
-                       ':position_fk', values={'position_fk': position_fk})
-
-    toponyms = [(f'disconnected: {position_fk}', toponym_id, reject_id[0]) for
-                reject_id in toponyms]
-    if len(toponyms) > 0:
-
-        execute('insert into suggestion (outcome, comment, '
-                'added_toponym_fk, stable_toponym_fk) values (False, ?, ?, ?)',
-                values=toponyms, status='Disconnecting position', many=True)
+    with transaction():
+        #first we delete the suggestions connecting toponym to position
+        execute('delete from suggestion where added_toponym_fk == :toponym_id '
+                'and stable_toponym_fk in (select toponym_id from toponym '
+                'where position_fk == :position_fk)',
+                values={'toponym_id': toponym_id, 'position_fk': position_fk})
+
+        #disconnect position
+        execute('update toponym set position_fk = NULL where toponym_id == '
+                ':toponym_id', values={'toponym_id': toponym_id})
+        log_event(toponym_id, f'Disconnected from {position_fk}',
+                  match_state='unmatched')
+
+        # fetching all the toponym connected to position
+        toponyms = execute('select toponym_id from toponym where '
+                           'position_fk == :position_fk',
+                           values={'position_fk': position_fk})
+
+        toponyms = [(f'disconnected: {position_fk}', toponym_id, reject_id[0])
+                    for reject_id in toponyms]
+        if len(toponyms) > 0:
+
+            execute('insert into suggestion (outcome, comment, '
+                    'added_toponym_fk, stable_toponym_fk) '
+                    'values (False, ?, ?, ?) '
+                    'on conflict (added_toponym_fk, stable_toponym_fk) '
+                    'do update set outcome = FALSE, '
+                    'comment = excluded.comment',
+                    values=toponyms, status='Disconnecting position',
+                    many=True)
 
     return len(toponyms)
 
 
-@anvil.server.callable
+@server_callable
 def fetch_position_toponyms(position_id):
     """Fetching the toponyms, with source_fk and id, from connected toponyms"""
     res = execute('select toponym_id, name, source_fk from toponym where '
@@ -609,7 +713,7 @@ def fetch_position_toponyms(position_id):
     return res
 
 
-@anvil.server.callable
+@server_callable
 def fetch_positions_with_names(positions):
     """
     # later: Position name fetcher is ugly.
@@ -645,12 +749,12 @@ def fetch_positions_with_names(positions):
     return [_ for _ in results_dict.values()]
 
 
-@anvil.server.callable
+@server_callable
 def fetch_created_positions():
     """Fetches all the positions recorded manually in the app"""
     query = 'select toponym_id, name, position_id, '\
             'longitude, latitude from position join toponym '\
-            'on position_id == position_fk where position_id like "M_%" '\
+            'on position_id == position_fk where external_id like "M_%" '\
             'group by position_id'
     res = execute(query, status='Created position Names')
     return [{'toponym_id': t_id, 'name': name, 'position_id': p_id,
@@ -658,7 +762,7 @@ def fetch_created_positions():
              'latitude': lat} for t_id, name, p_id, lng, lat in res]
 
 
-@anvil.server.callable
+@server_callable
 def merge_positions(positions, longitudes, latitudes, new_name,
                     parent_ids, sources):
     new_longitude = mean(longitudes)
@@ -676,32 +780,45 @@ def merge_positions(positions, longitudes, latitudes, new_name,
     source = singularise(sources)
 
     # creating new point
+    from anyascii import anyascii
+
     new_name = 'M_' + anyascii(new_name) + '_'
 
-    # A quick and dirty way to make sure that the new ID is not taken
-    existing_pos_id = execute('select position_id from position')
-    o = 0
-    while (new_name + str(o), ) in existing_pos_id:
-        o += 1
-    new_name += str(o)
-    add_position(position_id=new_name, longitude=new_longitude,
-                 latitude=new_latitude,
-                 source=source, parent_id=parent_id,
-                 comment=f'Merged from {positions=} - {sources=}')
-
-    replace_old_query = 'update toponym set position_fk = ?, '\
-                        'comment = comment || "position_merged" '\
-                        'where position_fk == ?'
-    values = [(new_name, position_id) for position_id in positions]
-    execute(replace_old_query, values=values, many=True)
-
-    # recording the change in old positions, to explain why they are no longer in use.
-
-    mark_old_positions = 'update position set comment = ? || comment '\
-                         'where position_id == ?'
-    values = [(f'Merged into {new_name} \n', pid) for pid in positions]
-    execute(mark_old_positions, values=values, many=True,
-            status='marking old positions')
+    with transaction():
+        # A quick and dirty way to make sure that the new ID is not taken
+        o = 0
+        while position_key(new_name + str(o)) is not None:
+            o += 1
+        new_name += str(o)
+        new_position = add_position(
+            position_id=new_name, longitude=new_longitude,
+            latitude=new_latitude, source=source, parent_id=parent_id,
+            comment=f'Merged from {positions=} - {sources=}')
+
+        values = {'new_name': new_name, 'new_position': new_position,
+                  'positions': json.dumps(positions)}
+
+        log_merge_query = 'insert into toponym_event (toponym_fk, '\
+                          'match_state, comment, event_created) '\
+                          'select toponym_id, match_state, '\
+                          '"Position merged into " || :new_name, '\
+                          'datetime("now") from toponym where position_fk in '\
+                          '(select value from json_each(:positions))'
+        execute(log_merge_query, values=values)
+
+        replace_old_query = 'update toponym set position_fk = :new_position '\
+                            'where position_fk in '\
+                            '(select value from json_each(:positions))'
+        execute(replace_old_query, values=values)
+
+        # recording the change in old positions, to explain why they are no longer in use.
+
+        mark_old_positions = 'update position set comment = "Merged into " '\
+                             '|| :new_name || " \n" || comment '\
+                             'where position_id in '\
+                             '(select value from json_each(:positions))'
+        execute(mark_old_positions, values=values,
+                status='marking old positions')
 
     # Resolve any solvable doubles:
     # Use position_ids to fetch name ids, to see if they have more than one candidate pos
@@ -711,7 +828,7 @@ def merge_positions(positions, longitudes, latitudes, new_name,
 
 
 
-@anvil.server.callable
+@server_callable
 def disambiguate(target, option, nemo=False):
     """Disambiguates a toponym
 
@@ -720,7 +837,7 @@ def disambiguate(target, option, nemo=False):
         option - the toponym id to donate the position
 
     Records the position from the accepted option in the target toponyms row.
-    Which is also added to the comment of the target topony.
+    Which is also added to the history of the target topony.
     The suggested pairing is recorded as accepted in the  suggestion table.
 
     """
@@ -733,19 +850,59 @@ def disambiguate(target, option, nemo=False):
 
     log_position = 'update toponym set position_fk = '\
                    '(select position_fk from toponym where toponym_id == '\
-                   ':option), comment = "Disambiguated to " || :option || '\
-                   '"\n" || comment where toponym_id == :target'
-    execute(log_position, values=values)
+                   ':option), match_state = "disambiguated" '\
+                   'where toponym_id == :target'
 
     # for some reason this part does not get executed through the GUI.
     log_acceptance = f'update {suggestion} set outcome = TRUE '\
                      'where added_toponym_fk == :target '\
                      'and stable_toponym_fk == :option'
 
-    execute(log_acceptance, values=values)
+    with transaction():
+        execute(log_position, values=values)
+        log_event(target, f'Disambiguated to {option}')
+        execute(log_acceptance, values=values)
+
+
+@server_callable
+def fetch_rechecks(n=50):
+    """Fetches the matched toponyms whose positions changed in GeoNames"""
+    query = 'select toponym_id, name, position_fk from toponym '\
+            'where match_state == "recheck" limit :n'
+    res = execute(query, values={'n': n}, status='Toponyms to re-check')
+    return [{'toponym_id': t_id, 'name': name, 'position_id': p_id}
+            for t_id, name, p_id in res]
 
 
-@anvil.server.callable
+@server_callable
+def confirm_match(toponym_id):
+    """Confirms the match of a toponym flagged for re-checking
+
+    Its match state is restored to the one it had before being flagged.
+    """
+    previous = 'select match_state from toponym_event '\
+               'where toponym_fk == :toponym_id and match_state is not NULL '\
+               'and match_state != "recheck" '\
+               'order by event_created desc, rowid desc limit 1'
+    with transaction():
+        state = execute(previous, values={'toponym_id': toponym_id})
+        state = state[0][0] if len(state) > 0 else 'auto-single'
+        log_event(toponym_id, 'Match confirmed after GeoNames update', state)
+
+
+@server_callable
+def fetch_query_stats(reset=False):
+    """Fetches the per-statement query counters and latencies"""
+    return dump_query_stats(reset)
+
+
+@server_callable
+def fetch_name_cache_stats(reset=False):
+    """Fetches the size and the hit rate of the preprocessed name cache"""
+    return name_cache.stats(reset)
+
+
+@server_callable
 def fetch_languages():
     """Fetches the used languages from the settings file"""
     return settings.languages
@@ -761,20 +918,20 @@ def export_formatter(cell):
         return f'"{cell}"'
 
 
-@anvil.server.callable
+@server_callable
 def export_selection(source, no_source=None, source2=None):
     """Exports position data from source, and source2 but not in no_source"""
     query = 'select (select name from toponym where '\
              'position_fk = position_id order by toponym_id limit 1), '\
              'toponym.name, '\
              'toponym.source_fk, '\
-             'position_id, '\
+             'external_id, '\
              'longitude, latitude, '\
              'year, '\
              'toponym_edited, toponym.comment '\
              'from toponym join position on position_id == position_fk '\
              'join source on source.name == toponym.source_fk '\
-             f'where toponym.comment not like "%Declare%" '
+             'where toponym.match_state is not "foreign" '
 
     # fillin in the 'where' depending on the supplied source.
     if source == 'Use':
@@ -782,7 +939,7 @@ def export_selection(source, no_source=None, source2=None):
     elif type(source) is not str or len(source) < 7 or len(source) > 10:
         return 'invalid source supplied.'
     else:
-        query += ' toponym.source_fk == :source '
+        query += 'and toponym.source_fk == :source '
         if source2 is not None:
             query += ' and position_id in (select position_fk from toponym '\
                      'where source_fk == :source2) '
@@ -793,20 +950,22 @@ def export_selection(source, no_source=None, source2=None):
 
     query += 'group by position_id'
 
-    result = execute(query, values={'source': source, 'no_source': no_source,
-                                    'source2': source2})
+    result = iterate(query, values={'source': source, 'no_source': no_source,
+                                    'source2': source2},
+                     profile='read-heavy export')
 
-    if len(result) == 0:
+    first = next(result, None)
+    if first is None:
         return (f'No results were found for {source}:{no_source}:{source2}')
 
     header = ['Toponym_first_used', 'Toponym_added', 'Source',
               'PositionID', 'Longitude', 'Latitude',
               'Year', 'Toponym_edited', 'Comment', ]
 
-    return to_tsv(header, result)
+    return to_tsv(header, chain([first], result))
 
 
-@anvil.server.callable
+@server_callable
 def export_selection_by_year(source, no_source=None, source2=None):
     """Exports positions with year source, and source2 but not in no_source"""
 
@@ -814,7 +973,7 @@ def export_selection_by_year(source, no_source=None, source2=None):
             'position_fk = position_id order by toponym_id limit 1), '\
             'toponym.name, '\
             'source.year, '\
-            'position_id, '\
+            'external_id, '\
             'longitude, latitude, '\
             'year, '\
             'toponym_edited, toponym.comment '\
@@ -845,30 +1004,30 @@ def export_selection_by_year(source, no_source=None, source2=None):
 
     query += 'group by position_id'
 
-    result = execute(query, values={'source': source, 'no_source': no_source,
-                                    'source2': source2})
+    result = iterate(query, values={'source': source, 'no_source': no_source,
+                                    'source2': source2},
+                     profile='read-heavy export')
 
-    if len(result) == 0:
+    first = next(result, None)
+    if first is None:
         return (f'No results were found for {source}:{no_source}:{source2}')
 
     header = ['Toponym_first_used', 'Toponym_added', 'Source',
                'PositionID', 'Longitude', 'Latitude',
                'Year', 'Toponym_edited', 'Comment', ]
 
-    return to_tsv(header, result)
+    return to_tsv(header, chain([first], result))
 
 
 def to_tsv(header, results):
-    """Joing headers with result rows in a tsv format"""
-    tsv = ''
-    for row in [header] + results:
-        row = '\t'.join(export_formatter(cell) for cell in row)
-        tsv += row + '\n'
+    """Joing headers with result rows, from any iterable, in a tsv format"""
+    tsv = '\n'.join('\t'.join(export_formatter(cell) for cell in row)
+                    for row in chain([header], results))
 
     return tsv.strip()
 
 
-@anvil.server.callable
+@server_callable
 def erase_positions(positions):
     """Removes a set of positions from the database
 
@@ -877,36 +1036,48 @@ def erase_positions(positions):
 
 
     The manually added toponyms are first disconnected from the positions, and
-    the comment is updated with a message to reflect this action.
+    their history is updated with a message to reflect this action.
     Then the toponyms still connected to it (from seeding the database) are
     then removed.
     Next each suggestion linking to the positions are removed.
     Finally, the positions themselves are removed.
-    """
 
-    for position in set(positions):
-        # reset the added, hence long source name, toponyms linked to it
-        execute('UPDATE toponym SET position_fk=NULL, comment=:message '
-                '|| "\n" || comment where position_fk==:position and '
-                'length(source_fk) > 6 ',
-                values={'position': position,
-                        'message': f'Position: {position} was removed..'})
+    Each step covers all the positions at once, and all of them are
+    committed together in a single transaction.
+    """
 
-        # remove current suggestions to position
+    # json_each turns the list into a table, regardless of its length.
+    values = {'positions': json.dumps(list(set(positions)))}
+    selected = ' in (select value from json_each(:positions)) '
+
+    with transaction():
+        # reset the added, hence long source name, toponyms linked to them
+        execute('INSERT INTO toponym_event (toponym_fk, match_state, '
+                'comment, event_created) SELECT toponym_id, "unmatched", '
+                '"Position: " || (SELECT external_id FROM position WHERE '
+                'position_id == position_fk) || " was removed..", '
+                'datetime("now") FROM toponym '
+                'where position_fk' + selected + 'and length(source_fk) > 6 ',
+                values=values)
+        execute('UPDATE toponym SET position_fk=NULL, match_state="unmatched" '
+                'where position_fk' + selected + 'and length(source_fk) > 6 ',
+                values=values)
+
+        # remove current suggestions to the positions
         execute('DELETE FROM suggestion where stable_toponym_fk in '
-                '(select toponym_id from toponym where position_fk == '
-                ':position)', values={'position': position})
+                '(select toponym_id from toponym where position_fk'
+                + selected + ')', values=values)
 
         # remove remaining toponyms
-        execute('DELETE FROM toponym WHERE position_fk == :position',
-                values={'position': position})
+        execute('DELETE FROM toponym WHERE position_fk' + selected,
+                values=values)
 
-        # remove position
-        execute('DELETE FROM position where position_id == :position',
-                values={'position': position})
+        # remove positions
+        execute('DELETE FROM position where position_id' + selected,
+                values=values)
 
 
-@anvil.server.callable
+@server_callable
 def make_position_for_toponym(toponym_id, latitude, longitude, source):
     """Record a new position for a particular toponym
 
@@ -916,8 +1087,8 @@ def make_position_for_toponym(toponym_id, latitude, longitude, source):
         source - the source of this new position - typically the same as the
             toponym as it was probably approximated by studying the book.
 
-    The position_id is created by concatenating "M_" with the toponym_id, so
-    first it checks that there is no such position.
+    The position's external_id is created by concatenating "M_" with the
+    toponym_id, so first it checks that there is no such position.
 
     Then the position is recorded with the supplied coordinates and a comment
     that it has been created manually.
@@ -926,52 +1097,58 @@ def make_position_for_toponym(toponym_id, latitude, longitude, source):
     comment that the position was created for the toponym.
     """
 
-    position_id = f'M_{toponym_id}'
-
-    id_used_count = execute('select count(position_id) from position where '
-                            'position_id == :position_id',
-                            values={'position_id': position_id})[0][0]
+    external_id = f'M_{toponym_id}'
 
-    if id_used_count > 0:
-        logging.critical(f'{position_id=} is already registered.')
-        raise ValueError('position_id already exists')
+    with transaction():
+        if position_key(external_id) is not None:
+            logging.critical(f'{external_id=} is already registered.')
+            raise ValueError('position_id already exists')
 
-    add_position(position_id, source=source, latitude=latitude,
-                 longitude=longitude, parent_id='Manual',
-                 comment='Created manually')
+        position_id = add_position(external_id, source=source,
+                                   latitude=latitude, longitude=longitude,
+                                   parent_id='Manual',
+                                   comment='Created manually')
 
-    # connect the toponym
-    connect_toponym(toponym_id=toponym_id,
-                    position_fk=position_id,
-                    comment=f'Created position {position_id} for toponym')
+        # connect the toponym
+        connect_toponym(toponym_id=toponym_id,
+                        position_fk=position_id,
+                        comment=f'Created position {external_id} for toponym',
+                        match_state='manual')
 
 
-@anvil.server.callable
+@server_callable
 def rename_toponym(toponym_id, toponym):
     """Changes the recorded name and derivatives of a toponym"""
-    tokens, asciiname, asciitokens, pattern = preprocess_toponym(toponym)
-
-    execute('UPDATE toponym SET name = :toponym, comment = :message || '
-            'name ||  "\n" || comment , tokens = :tokens, '
-            'asciiname = :asciiname, asciitokens = :asciitokens, '
-            'pattern = :pattern where toponym_id == :toponym_id and '
-            'name != :toponym',
-            values={'toponym': toponym.strip(), 'toponym_id': toponym_id,
-                    'message': 'Updated manually from ',
-                    'tokens': tokens,
-                    'asciiname': asciiname,
-                    'asciitokens': asciitokens,
-                    'pattern': pattern})
-
-
-@anvil.server.callable
+    tokens, asciiname, asciitokens, pattern = \
+        preprocess_many([toponym.strip()])[0]
+
+    with transaction():
+        old_name = execute('SELECT name FROM toponym WHERE toponym_id == '
+                           ':toponym_id and name != :toponym',
+                           values={'toponym': toponym.strip(),
+                                   'toponym_id': toponym_id})
+        if len(old_name) == 0:
+            return
+
+        execute('UPDATE toponym SET name = :toponym, tokens = :tokens, '
+                'asciiname = :asciiname, asciitokens = :asciitokens, '
+                'pattern = :pattern where toponym_id == :toponym_id',
+                values={'toponym': toponym.strip(), 'toponym_id': toponym_id,
+                        'tokens': tokens,
+                        'asciiname': asciiname,
+                        'asciitokens': asciitokens,
+                        'pattern': pattern})
+        log_event(toponym_id, f'Updated manually from {old_name[0][0]}')
+
+
+@server_callable
 def connect_created_position(toponym_id, position_fk, comment):
     """Connects a (created) position to the toponym"""
     connect_toponym(toponym_id=toponym_id, position_fk=position_fk,
-                    comment=comment)
+                    comment=comment, match_state='manual')
 
 
-@anvil.server.callable
+@server_callable
 def cluster(sources, radius):
     """Clusters points based on distance and returns it in TSV format
     Takes:
@@ -1000,7 +1177,7 @@ def cluster(sources, radius):
     p_query = 'select position_id, latitude, longitude from position where '\
               'position_id in (select position_fk from toponym where '\
               ' ' + source_grp + ' '\
-              'and comment not like "%Declared%" group by position_fk)'
+              'and match_state is not "foreign" group by position_fk)'
 
     c_query = 'select cluster_nr, lat, lng from cluster where '\
               'lat between :lat_lo and :lat_hi '\
@@ -1010,8 +1187,8 @@ def cluster(sources, radius):
     # In the worst case: At the equator each degree is a 111km radius,
     equator_radius = radius/111
 
-    for position_id, latitude, longitude in execute(p_query,
-                                                    status='P for Clustering'):
+    for position_id, latitude, longitude in iterate(
+            p_query, status='P for Clustering', profile='read-heavy export'):
         # for some reason including this in the query grinds it to a halt.
         if position_id == 0:
             continue
@@ -1063,14 +1240,16 @@ def cluster(sources, radius):
                'where ' + source_grp + ' group by cluster_nr '\
                'order by s'
 
-    result = execute(e_query, status='Cluster-export')
-    if len(result) == 0:
+    result = iterate(e_query, status='Cluster-export',
+                     profile='read-heavy export')
+    first = next(result, None)
+    if first is None:
         return 'No results found'
 
     header = ['sources', 'Latitude', 'Longitude', 'cnt_points', 'cnt_sources']
     header += [f'cnt_{source}' for source in sources]
 
-    return to_tsv(header, result)
+    return to_tsv(header, chain([first], result))
 
 
 if __name__ == '__main__':
@@ -1082,11 +1261,13 @@ if __name__ == '__main__':
         force=True
         )
 
-    create_tables()
+    migrate()
 
     # Starting server with settings.server_token
     #
-    anvil.server.connect(settings.server_token)
+    import anvil.server
+
+    connect_uplink(settings.server_token)
 
     make_nemo_list()
 
@@ -1,10 +1,16 @@
 # coding=<utf-8>
-import requests
 import os
 import logging
-from qwikidata.sparql import return_sparql_query_results as sparql
+import random
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from email.utils import parsedate_to_datetime
+from itertools import islice
+from time import monotonic, sleep, time
+from urllib.parse import unquote, urlsplit
 from settings import settings
-from tqdm import tqdm
 from collections import defaultdict
 
 from string import Template
@@ -17,78 +23,325 @@ query_template = Template("SELECT ?item ?language"
                           " filter(lang(?label)=?language) } "
                           "group by ?item ?language")
 
+# The titles resolved so far, the .txt file is only read to fill the cache
 wiki_title_2_base_item = 'wiki_title_2_base_item.txt'
+title_cache_path = 'wiki_title_2_base_item.sqlite3'
 
-if not os.path.exists(wiki_title_2_base_item):
-    with open(wiki_title_2_base_item, 'w') as f:
-        pass
+# The HTTP layer, which can be replaced, e.g. by a local stand-in server.
+# requests is only imported by the first request, through requests.get
+# unless http_get is set.
+wikipedia_api = 'https://{language}.wikipedia.org/w/api.php'
+sparql_endpoint = 'https://query.wikidata.org/sparql'
+http_get = None
 
-wiki_dict_dir = 'wiki_dictionaries'
+# The most titles the MediaWiki API takes in one query, and the most items
+# asked for in one SPARQL query
+max_titles = 50
+max_items = 50
 
-os.makedirs(wiki_dict_dir, exist_ok=True)
+# Retrying the requests which are refused or fail, after a Retry-After or
+# an exponentially growing delay, starting at backoff seconds. Longer
+# Retry-After delays than max_delay seconds are cut down to it.
+retry_statuses = {429, 500, 502, 503, 504}
+max_retries = 6
+backoff = 1
+max_delay = 300
 
 
-def extract_base_item(response_dict):
-    """Recursive function to find the 'wikibase_item' from nested dict"""
-    for key, item in response_dict.items():
-        if key == 'wikibase_item':
-            return item
-        elif type(item) == dict:
-            item2 = extract_base_item(item)
-            return item2
+class RateLimiter():
+    """A token bucket, shared by the threads making requests
 
+    Takes:
+        rate - float, the number of requests per second
+        burst - int, the number of requests which can be made at once
+    """
 
-def fetch_base_item(link):
-    """Takes a wikipedia link and puts the wikidata identifier in a txt file"""
-    if 'wikipedia.org' not in link:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Waits for a token"""
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+    def pause(self, seconds):
+        """Holds back all the requests for a while, e.g. after a refusal"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+            self.tokens = 0
+
+
+# The limiter shared by all requests, made from the settings by get_limiter
+limiter = None
+_limiter_lock = threading.Lock()
+
+
+def get_limiter():
+    """Returns the shared RateLimiter, creating it on first use"""
+    global limiter
+    with _limiter_lock:
+        if limiter is None:
+            limiter = RateLimiter(settings.wiki_requests_per_second,
+                                  settings.wiki_workers)
+        return limiter
+
+
+def retry_after(response):
+    """The delay asked for by the Retry-After header, in seconds, or None
+
+    The delay is at most max_delay, whatever the header says, since it holds
+    back all the requests.
+    """
+    value = response.headers.get('Retry-After')
+    if value is None:
         return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = parsedate_to_datetime(value).timestamp() - time()
+        except (TypeError, ValueError):
+            return None
+    return min(max_delay, max(0, delay))
+
 
-    name = link.split('/')[-1]
-    lang = link.split('.')[0][-2:]
+def get(url, params):
+    """Makes a rate limited GET request, retrying the failed ones
 
-    # later: simple but inefficient. -- but I cannot be sure that titles make acceptable filepaths  # noqa: E501
-    with open(wiki_title_2_base_item, 'r', encoding='utf8') as f:
-        for line in f.readlines():
-            if line != '':
-                title, base_item = line.split('___')
-                if title == name:
-                    return base_item.strip()
+    The requests carry the wiki_user_agent from the settings, since
+    Wikimedia throttles, or refuses, the clients which do not say who they
+    are. Requests refused for their rate, or failing on the remote side, are
+    retried after the delay from their Retry-After header, if any, or after
+    an exponential backoff. Either way all the threads are held back.
 
-    url = f'https://{lang}.wikipedia.org/w/api.php?action=query&prop='\
-          f'pageprops&format=json&titles={name}'
-    logging.debug(f'Could not find {name} in record, downloading.')
+    Returns:
+        The response
+    """
+    import requests
 
-    response = requests.get(url)
+    limiter = get_limiter()
+    for attempt in range(max_retries + 1):
+        limiter.acquire()
+        try:
+            response = (http_get or requests.get)(
+                url, params=params, timeout=60,
+                headers={'User-Agent': settings.wiki_user_agent})
+        except (requests.ConnectionError, requests.Timeout) as e:
+            response, delay = e, None
+        else:
+            if response.status_code not in retry_statuses:
+                break
+            delay = retry_after(response)
 
+        if attempt == max_retries:
+            break
+        if delay is None:
+            delay = backoff * 2 ** attempt * random.uniform(1, 1.5)
+        logging.info(f'{url} failed with {response}, retrying in '
+                     f'{delay:.1f}s')
+        limiter.pause(delay)
+
+    if isinstance(response, Exception):
+        raise response
     if response.status_code != 200:
         raise requests.HTTPError(f'{url=} led to {response.status_code=}')
+    return response
+
+
+def run_concurrently(func, batches):
+    """Runs func over the batches in a pool of threads, yielding the results
+
+    The results come in the order of the batches.
+    """
+    batches = list(batches)
+    if len(batches) <= 1 or settings.wiki_workers <= 1:
+        yield from map(func, batches)
+        return
+    with ThreadPoolExecutor(settings.wiki_workers,
+                            thread_name_prefix='wiki') as pool:
+        yield from pool.map(func, batches)
+
+
+def parse_link(link):
+    """Splits a Wikipedia link into its (language, title)
+
+    Returns None for any other link.
+    """
+    parts = urlsplit(link)
+    if not parts.netloc.endswith('wikipedia.org') or \
+            '/wiki/' not in parts.path:
+        return None
+    language = parts.netloc.split('.')[0]
+    title = unquote(parts.path.split('/wiki/', 1)[1])
+    return language, title
+
+
+def open_title_cache():
+    """Opens the title cache, creating it when necessary
+
+    The cache maps the (language, title) of Wikipedia pages to their
+    WikiData item, or NULL for pages without one. A new cache is filled
+    with the titles from the older .txt file, which were recorded without
+    their language and are kept under the language ''.
+
+    Returns:
+        sqlite3.Connection
+    """
+    new = not os.path.exists(title_cache_path)
+    conn = sqlite3.connect(title_cache_path, timeout=30)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS title_item '
+                 '(language text not null, title text not null, '
+                 'base_item text, primary key (language, title)) '
+                 'WITHOUT ROWID')
+    if new and os.path.exists(wiki_title_2_base_item):
+        with open(wiki_title_2_base_item, 'r', encoding='utf8') as f:
+            items = (line.rstrip('\n').split('___') for line in f)
+            conn.executemany('INSERT OR IGNORE INTO title_item values '
+                             '("", ?, nullif(?, "None"))',
+                             (item for item in items if len(item) == 2))
+        conn.commit()
+    return conn
+
+
+def query_base_items(language, titles):
+    """Asks Wikipedia for the WikiData items of up to max_titles pages
+
+    Takes:
+        language - the language code of the Wikipedia
+        titles - list of page titles, as in the links
+
+    Returns:
+        dict of title: base_item, None for the pages without an item, or
+        which do not exist. The titles are mapped back from the normalised,
+        and redirected, titles of the response.
+    """
+    url = wikipedia_api.format(language=language)
+    params = {'action': 'query', 'prop': 'pageprops', 'ppprop':
+              'wikibase_item', 'redirects': 1, 'format': 'json',
+              'titles': '|'.join(titles)}
+    query = get(url, params).json().get('query', {})
+    found = {page['title']: page.get('pageprops', {}).get('wikibase_item')
+             for page in query.get('pages', {}).values()}
+
+    # Following the title of each link to the page in the response
+    renamed = {}
+    for mapping in ('normalized', 'redirects'):
+        for step in query.get(mapping, []):
+            renamed[step['from']] = step['to']
+
+    base_items = {}
+    for title in titles:
+        page = title
+        for _ in range(3):
+            if page not in renamed:
+                break
+            page = renamed[page]
+        base_items[title] = found.get(page)
+    return base_items
+
+
+def fetch_base_items(links):
+    """Finds the WikiData items of a set of Wikipedia links
+
+    Takes:
+        links - iterable of Wikipedia links
+
+    The titles missing from the cache are looked up max_titles at a time
+    per language, concurrently, and recorded in the cache.
+
+    Returns:
+        dict of link: base_item, None for links to pages without an item, or
+        to anything other than Wikipedia.
+    """
+    parsed = {link: parse_link(link) for link in links}
+    resolved = {}
+
+    with closing(open_title_cache()) as conn:
+        missing = defaultdict(set)
+        for page in set(parsed.values()) - {None}:
+            cached = conn.execute('SELECT base_item FROM title_item '
+                                  'WHERE title == ? and language in (?, "") '
+                                  'ORDER BY language DESC LIMIT 1',
+                                  page[::-1]).fetchone()
+            if cached is None:
+                missing[page[0]].add(page[1])
+            else:
+                resolved[page] = cached[0]
+
+        batches = [(language, batch) for language, titles in missing.items()
+                   for batch in chunks(sorted(titles), max_titles)]
+        logging.debug(f'Downloading {len(batches)} batches of titles.')
+        for (language, batch), found in zip(batches, run_concurrently(
+                lambda batch: query_base_items(*batch), batches)):
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO title_item '
+                                 'values (?, ?, ?)',
+                                 ((language, title, base_item) for
+                                  title, base_item in found.items()))
+            resolved.update(((language, title), base_item) for
+                            title, base_item in found.items())
+
+    return {link: resolved.get(page) for link, page in parsed.items()}
+
+
+def fetch_base_item(link):
+    """Takes a wikipedia link and returns its wikidata identifier"""
+    return fetch_base_items([link])[link]
+
 
-    result_dict = response.json()
+def chunks(items, size):
+    """Splits a list into lists of at most size items"""
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
 
-    base_item = extract_base_item(result_dict)
 
-    # if base_item is None or not base_item.startswith('Q'):
-    #     logging.debug(f'{link=} has not additional data.')
-    #     return None
+def sparql(query):
+    """Runs a SPARQL query against WikiData and returns the parsed result"""
+    return get(sparql_endpoint, {'query': query, 'format': 'json'}).json()
 
-    with open(wiki_title_2_base_item, 'a', encoding='utf8') as f:
-        f.write(f'{name}___{base_item}\n')
 
-    return base_item
+def get_wiki_names(identifiers, languages=None):
+    """Queries WikiData for all names in a set of languages for the IDs
 
+    The IDs are queried max_items at a time, concurrently, in
+    settings.languages unless other languages are given.
+    """
+    from tqdm import tqdm
 
-def get_wiki_names(identifiers, languages=settings.languages):
-    """Queries WikiData for all names in a set of languages for the IDs"""
-    items = ' '.join(f'wd:{q.upper()}' for q in identifiers)
+    if languages is None:
+        languages = settings.languages
     languages = ' '.join(f"'{lang}'" for lang in languages)
 
-    query = query_template.substitute(items=items, languages=languages)
+    def query_names(batch):
+        items = ' '.join(f'wd:{q.upper()}' for q in batch)
+        query = query_template.substitute(items=items, languages=languages)
+        return sparql(query)['results']['bindings']
 
     result_dict = defaultdict(list)
-    for row in tqdm(sparql(query)['results']['bindings'],
-                    desc='Parsing SPARQL query result.'):
-        identifier = row['item']['value'].split('/')[-1]
-        toponyms = row['toponym']['value']
-        language = row['language']['value']
-        result_dict[identifier.lower()].append((toponyms, language.lower()))
+    for bindings in run_concurrently(query_names,
+                                     chunks(identifiers, max_items)):
+        for row in tqdm(bindings, desc='Parsing SPARQL query result.'):
+            identifier = row['item']['value'].split('/')[-1]
+            toponyms = row['toponym']['value']
+            language = row['language']['value']
+            result_dict[identifier.lower()].append((toponyms,
+                                                    language.lower()))
     return result_dict